@@ -0,0 +1,51 @@
+# albums.py
+
+import asyncio
+import logging
+
+from aiogram import BaseMiddleware
+from aiogram.dispatcher.flags import get_flag
+
+logger = logging.getLogger(__name__)
+
+
+class AlbumMiddleware(BaseMiddleware):
+    """
+    Собирает альбом (сообщения с одним media_group_id) в один вызов хэндлера.
+    Telegram шлёт фото альбома отдельными апдейтами почти одновременно:
+    первое ждёт, пока новые перестанут приходить (latency секунд тишины),
+    остальные добавляются к нему и хэндлер не вызывают.
+    Работает для хэндлеров с флагом album; список сообщений - в data["album"]
+    """
+
+    def __init__(self, latency=0.5):
+        self.latency = latency
+        # (chat_id, media_group_id) -> сообщения альбома
+        self._albums = {}
+
+    async def __call__(self, handler, event, data):
+        if not get_flag(data, "album"):
+            return await handler(event, data)
+
+        if event.media_group_id is None:
+            data["album"] = [event]
+            return await handler(event, data)
+
+        key = (event.chat.id, event.media_group_id)
+        album = self._albums.get(key)
+        if album is not None:
+            album.append(event)
+            return None
+
+        album = self._albums[key] = [event]
+        try:
+            # Ждём, пока альбом не перестанет расти
+            size = 0
+            while len(album) != size:
+                size = len(album)
+                await asyncio.sleep(self.latency)
+        finally:
+            del self._albums[key]
+
+        data["album"] = sorted(album, key=lambda message: message.message_id)
+        return await handler(event, data)
@@ -0,0 +1,627 @@
+# benchmark.py
+"""
+Замеры производительности PhotoUniqulizer.
+
+Запуск:
+    python benchmark.py                          # все эффекты и задачи
+    python benchmark.py --suite effects --sizes small,1080p
+    python benchmark.py --suite caps --sizes 4k  # ограничение рабочего разрешения
+    python benchmark.py --suite encode           # форматы, лимит размера, потоки
+    python benchmark.py --suite alloc            # аллокации на вариант
+    python benchmark.py --suite stack            # пачка вариантов стеком
+    python benchmark.py --suite blur             # размытие: точное и быстрое
+    python benchmark.py --suite tile --sizes 8k  # большой кадр целиком и полосами
+    python benchmark.py --json results.json      # машиночитаемый отчёт
+    python benchmark.py --baseline results.json  # сравнение с эталоном
+
+При сравнении с эталоном код выхода 1, если какой-то замер
+стал медленнее больше чем на --threshold.
+"""
+
+import argparse
+import json
+import math
+import platform
+import random
+import resource
+import sys
+import time
+import tracemalloc
+from io import BytesIO
+
+import numpy as np
+from PIL import Image, ImageEnhance, ImageFilter
+
+import encoder
+from uniqualizer import PhotoUniqulizer, SMOOTH_VARIANCE, gaussian_blur
+
+# Размеры синтетических изображений
+SIZES = {
+    'small': (640, 480),
+    '1080p': (1920, 1080),
+    '4k': (3840, 2160),
+    '8k': (7680, 4320),
+}
+
+# Размеры по умолчанию (8k - только явно, для --suite tile)
+DEFAULT_SIZES = ('small', '1080p', '4k')
+
+MODES = ('RGB', 'RGBA')
+
+BG_TYPES = ('solid', 'gradient', 'noise')
+
+BLUR_RADII = (1, 3, 5, 10)
+
+# Радиусы при сравнении gaussian_blur с точным размытием
+BLUR_ENGINE_RADII = (1, 2, 3, 5, 7, 10)
+
+JOB_COUNTS = (1, 10, 50)
+
+# Ограничения рабочего разрешения (длинная сторона; 0 - без ограничения)
+WORKING_CAPS = (0, 2560, 1920, 1280)
+
+# Вариантов в задаче при замере ограничений
+CAPS_JOB_COUNT = 5
+
+# Лимиты размера результата при замере кодирования (0 - без лимита)
+OUTPUT_LIMITS = (0, 1024 * 1024, 300 * 1024)
+
+# Потоков кодирования при замере задачи
+ENCODE_THREADS = (0, 2, 4)
+
+# Вариантов в задаче при замере потоков кодирования
+ENCODE_JOB_COUNT = 10
+
+# Память под стек вариантов при замере стека (0 - по одному варианту)
+STACK_MEMORY = (0, 64 * 1024 * 1024, 256 * 1024 * 1024)
+
+# Вариантов в пачке при замере стека
+STACK_JOB_COUNT = 10
+
+# Бюджет на полосы кадра при замере полос (0 - кадр целиком)
+TILE_MEMORY = (0, 64 * 1024 * 1024, 16 * 1024 * 1024)
+
+# Эффекты, которые считаются на весь стек сразу
+STACK_PARAMS = {'background': True, 'noise': True}
+
+# Ручной режим: все эффекты включены
+MANUAL_PARAMS = {
+    'noise': True,
+    'stripes': True,
+    'smiles': True,
+    'background': True,
+    'blur_radius': 2,
+}
+
+# Наборы эффектов при замере аллокаций (к ним всегда добавляются базовые)
+ALLOC_CASES = {
+    'basic': {},
+    'background': {'background': True},
+    'noise': {'noise': True},
+    'stripes': {'stripes': True},
+    'smiles': {'smiles': True},
+    'blur': {'noise': True, 'blur_radius': 2},
+    'manual': MANUAL_PARAMS,
+}
+
+
+def make_image(size, mode='RGB'):
+    """Синтетическое изображение: градиенты + шум, чтобы JPEG не вырождался"""
+    width, height = size
+    y, x = np.mgrid[0:height, 0:width]
+    channels = [
+        (x * 255 // max(1, width - 1)),
+        (y * 255 // max(1, height - 1)),
+        ((x + y) % 256),
+    ]
+    if mode == 'RGBA':
+        channels.append(np.full_like(x, 255))
+    array = np.stack(channels, axis=-1).astype('uint8')
+    array = np.clip(array + np.random.randint(0, 16, array.shape), 0, 255).astype('uint8')
+    return Image.fromarray(array, mode)
+
+
+def encode_jpeg(image, quality=90):
+    output = BytesIO()
+    image.save(output, format='JPEG', quality=quality)
+    return output.getvalue()
+
+
+def measure(func, repeat=5, warmup=1):
+    """Среднее время вызова func в секундах"""
+    for _ in range(warmup):
+        func()
+    start = time.perf_counter()
+    for _ in range(repeat):
+        func()
+    return (time.perf_counter() - start) / repeat
+
+
+class PeakRSS:
+    """
+    Пиковый RSS внутри блока. На Linux пик сбрасывается через
+    /proc/self/clear_refs, иначе берётся пик за всё время процесса
+    """
+
+    def __enter__(self):
+        self.resettable = False
+        try:
+            with open('/proc/self/clear_refs', 'w') as f:
+                f.write('5')
+            self.resettable = True
+        except OSError:
+            pass
+        return self
+
+    def __exit__(self, *exc):
+        self.peak_mb = self._read_peak() / 1024
+
+    def _read_peak(self):
+        if self.resettable:
+            with open('/proc/self/status') as f:
+                for line in f:
+                    if line.startswith('VmHWM:'):
+                        return int(line.split()[1])
+        peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+        # macOS отдаёт байты, Linux - килобайты
+        return peak / 1024 if sys.platform == 'darwin' else peak
+
+
+def run_case(group, name, size_name, mode, func, repeat, units, unit_name):
+    """Замер одного случая: время, пропускная способность, пиковый RSS"""
+    func()  # прогрев: шрифты, атлас эмодзи, кэши Pillow
+    times = []
+    with PeakRSS() as rss:
+        for _ in range(repeat):
+            start = time.perf_counter()
+            func()
+            times.append(time.perf_counter() - start)
+
+    mean = sum(times) / len(times)
+    return {
+        'key': f"{group}/{name}/{size_name}/{mode}",
+        'group': group,
+        'name': name,
+        'size': size_name,
+        'mode': mode,
+        'repeat': repeat,
+        'mean_s': mean,
+        'min_s': min(times),
+        'throughput': units / mean if mean else 0.0,
+        'throughput_unit': unit_name,
+        'peak_rss_mb': rss.peak_mb,
+    }
+
+
+def on_canvas(uniqualizer, image, effect, *args):
+    """
+    Эффекты меняют рабочий буфер по месту - каждый раз заливаем в него
+    исходник заново (копия входит в замер, как и в apply_effects)
+    """
+    canvas = uniqualizer.load_canvas(image)
+    try:
+        effect(canvas, *args)
+    finally:
+        uniqualizer.release_canvas(canvas)
+
+
+def effect_cases(uniqualizer, image):
+    """(имя, функция) для каждого эффекта на данном изображении"""
+    cases = [
+        ('basic_modifications', lambda: uniqualizer.basic_modifications(image)),
+    ]
+    for bg_type in BG_TYPES:
+        cases.append((
+            f"change_background[{bg_type}]",
+            lambda bg_type=bg_type: on_canvas(
+                uniqualizer, image, uniqualizer.change_background, bg_type
+            )
+        ))
+    cases += [
+        ('add_noise', lambda: on_canvas(uniqualizer, image, uniqualizer.add_noise)),
+        ('add_stripes', lambda: on_canvas(uniqualizer, image, uniqualizer.add_stripes)),
+        ('add_smiles', lambda: on_canvas(uniqualizer, image, uniqualizer.add_smiles)),
+    ]
+    for radius in BLUR_RADII:
+        cases.append((
+            f"apply_blur[{radius}]",
+            lambda radius=radius: on_canvas(uniqualizer, image, uniqualizer.apply_blur, radius)
+        ))
+    cases.append(('jpeg_encode', lambda: encode_jpeg(image.convert('RGB'))))
+    return cases
+
+
+def bench_effects(uniqualizer, sizes, modes, repeat):
+    results = []
+    for size_name in sizes:
+        for mode in modes:
+            image = make_image(SIZES[size_name], mode)
+            megapixels = image.width * image.height / 1e6
+            for name, func in effect_cases(uniqualizer, image):
+                results.append(run_case(
+                    'effect', name, size_name, mode, func, repeat, megapixels, 'MP/s'
+                ))
+                print_result(results[-1])
+    return results
+
+
+def bench_jobs(uniqualizer, sizes, counts, repeat):
+    """Полный uniqualize_batch из JPEG для ручного и авто режимов"""
+    # Авто-режим берём у бота, чтобы параметры совпадали с продакшеном
+    from bot import get_auto_params
+
+    results = []
+    for size_name in sizes:
+        image_bytes = encode_jpeg(make_image(SIZES[size_name]))
+        for count in counts:
+            for mode_name in ('manual', 'auto'):
+                def job(count=count, mode_name=mode_name):
+                    if mode_name == 'auto':
+                        params_list = [get_auto_params() for _ in range(count)]
+                    else:
+                        params_list = [MANUAL_PARAMS] * count
+                    return uniqualizer.uniqualize_batch(image_bytes, params_list)
+
+                results.append(run_case(
+                    'job', f"{mode_name}[count={count}]", size_name, 'RGB',
+                    job, repeat, count, 'variants/s'
+                ))
+                print_result(results[-1])
+    return results
+
+
+def bench_caps(uniqualizer, sizes, repeat):
+    """
+    Задача в ручном режиме при разных ограничениях рабочего разрешения:
+    эффекты в уменьшенном размере и с растяжением обратно при кодировании
+    """
+    results = []
+    for size_name in sizes:
+        width, height = SIZES[size_name]
+        image_bytes = encode_jpeg(make_image((width, height)))
+        params_list = [MANUAL_PARAMS] * CAPS_JOB_COUNT
+        for cap in WORKING_CAPS:
+            if cap >= max(width, height):
+                continue
+            for upscale in ((False, True) if cap else (False,)):
+                def job(cap=cap, upscale=upscale):
+                    return uniqualizer.uniqualize_batch(image_bytes, params_list, cap, upscale)
+
+                name = f"max_side={cap}" + (",upscale" if upscale else "")
+                results.append(run_case(
+                    'cap', name, size_name, 'RGB', job, repeat, CAPS_JOB_COUNT, 'variants/s'
+                ))
+                print_result(results[-1])
+    return results
+
+
+def bench_encode(sizes, repeat):
+    """
+    Кодирование результата: время и размер по форматам и лимитам размера,
+    затем задача целиком при разном числе потоков кодирования
+    """
+    results = []
+    for size_name in sizes:
+        image = make_image(SIZES[size_name])
+        for output_format in encoder.FORMATS:
+            for max_bytes in OUTPUT_LIMITS:
+                def encode(output_format=output_format, max_bytes=max_bytes):
+                    return encoder.encode(image, output_format, 92, max_bytes)
+
+                name = f"{output_format},max={max_bytes // 1024}KB"
+                result = run_case('encode', name, size_name, 'RGB', encode, repeat, 1, 'images/s')
+                result['output_kb'] = len(encode()) / 1024
+                results.append(result)
+                print_result(result)
+
+        image_bytes = encode_jpeg(image)
+        params_list = [MANUAL_PARAMS] * ENCODE_JOB_COUNT
+        for threads in ENCODE_THREADS:
+            uniqualizer = PhotoUniqulizer(threads)
+
+            def job(uniqualizer=uniqualizer):
+                return uniqualizer.uniqualize_batch(image_bytes, params_list)
+
+            results.append(run_case(
+                'encode', f"threads={threads}", size_name, 'RGB', job, repeat,
+                ENCODE_JOB_COUNT, 'variants/s'
+            ))
+            print_result(results[-1])
+            uniqualizer.encoder.shutdown()
+    return results
+
+
+def bench_stack(uniqualizer, sizes, repeat):
+    """Пачка вариантов с фоном и шумом: по одному и стеками разного размера"""
+    results = []
+    params_list = [STACK_PARAMS] * STACK_JOB_COUNT
+    stack_bytes = uniqualizer.stack_bytes
+    try:
+        for size_name in sizes:
+            base = np.asarray(make_image(SIZES[size_name]))
+            height, width = base.shape[:2]
+            for memory in STACK_MEMORY:
+                uniqualizer.stack_bytes = memory
+
+                def job():
+                    return uniqualizer.render_batch(base, params_list)
+
+                frames = uniqualizer.stack_frames(width, height, STACK_JOB_COUNT)
+                results.append(run_case(
+                    'stack', f"memory={memory >> 20}MB,frames={frames}", size_name, 'RGB',
+                    job, repeat, STACK_JOB_COUNT, 'variants/s'
+                ))
+                print_result(results[-1])
+    finally:
+        uniqualizer.stack_bytes = stack_bytes
+    return results
+
+
+def bench_tile(uniqualizer, sizes, repeat):
+    """Вариант со всеми эффектами: кадр целиком и полосами под разный бюджет"""
+    results = []
+    tile_pixels, tile_bytes = uniqualizer.tile_pixels, uniqualizer.tile_bytes
+    try:
+        for size_name in sizes:
+            base = np.asarray(make_image(SIZES[size_name]))
+            for memory in TILE_MEMORY:
+                uniqualizer.tile_pixels = 1 if memory else 0
+                uniqualizer.tile_bytes = memory
+
+                def job():
+                    return uniqualizer.render_batch(base, [MANUAL_PARAMS])
+
+                name = f"memory={memory >> 20}MB" if memory else "whole"
+                results.append(run_case('tile', name, size_name, 'RGB', job, repeat, 1, 'variants/s'))
+                print_result(results[-1])
+    finally:
+        uniqualizer.tile_pixels, uniqualizer.tile_bytes = tile_pixels, tile_bytes
+    return results
+
+
+def blur_test_image(size):
+    """Худший случай для размытия на уменьшенной копии: штрихи в 1 px поверх градиентов"""
+    array = np.array(make_image(size, 'RGBA'))
+    array[::7, :, :3] = 255 - array[::7, :, :3]
+    array[:, ::13, :3] = 0
+    return Image.fromarray(array, 'RGBA')
+
+
+def bench_blur(sizes, repeat):
+    """
+    gaussian_blur против точного ImageFilter.GaussianBlur по радиусам:
+    время и отклонение (среднее и максимум, без полосы у края кадра)
+    """
+    results = []
+    for size_name in sizes:
+        image = blur_test_image(SIZES[size_name])
+        megapixels = image.width * image.height / 1e6
+        for radius in BLUR_ENGINE_RADII:
+            def exact(radius=radius):
+                return image.filter(ImageFilter.GaussianBlur(radius))
+
+            def fast(radius=radius):
+                return gaussian_blur(image, radius)
+
+            border = int(3 * radius) + 8
+            reference = np.asarray(exact()).astype(np.int16)[border:-border, border:-border, :3]
+            error = np.abs(
+                np.asarray(fast()).astype(np.int16)[border:-border, border:-border, :3] - reference
+            )
+            for name, func in (('exact', exact), ('engine', fast)):
+                result = run_case(
+                    'blur', f"{name}[{radius}]", size_name, 'RGBA', func, repeat, megapixels, 'MP/s'
+                )
+                if name == 'engine':
+                    result['mean_error'] = float(error.mean())
+                    result['max_error'] = int(error.max())
+                results.append(result)
+                print_result(result)
+    return results
+
+
+def count_allocations(func, count):
+    """
+    Аллокации на вызов func: картинок Pillow, блоков памяти Pillow,
+    взятых у системы (не из кэша блоков), и пик памяти numpy/Python в МБ
+    """
+    func()  # прогрев
+    Image.core.reset_stats()
+    tracemalloc.start()
+    try:
+        for _ in range(count):
+            func()
+        _, peak = tracemalloc.get_traced_memory()
+    finally:
+        tracemalloc.stop()
+    stats = Image.core.get_stats()
+    return stats['new_count'] / count, stats['allocated_blocks'] / count, peak / 2 ** 20
+
+
+def bench_allocations(uniqualizer, sizes, repeat):
+    """Время и аллокации на один вариант из готового исходника"""
+    results = []
+    for size_name in sizes:
+        base, _ = uniqualizer.prepare_source(encode_jpeg(make_image(SIZES[size_name])))
+        megapixels = base.shape[0] * base.shape[1] / 1e6
+        for name, params in ALLOC_CASES.items():
+            def variant(params=params):
+                return uniqualizer.render_variant(base, params)
+
+            result = run_case('alloc', name, size_name, 'RGB', variant, repeat, megapixels, 'MP/s')
+            images, blocks, numpy_mb = count_allocations(variant, repeat)
+            result.update(pil_images=images, pil_blocks=blocks, numpy_peak_mb=numpy_mb)
+            results.append(result)
+            print_result(result)
+    return results
+
+
+def print_result(result):
+    print(
+        f"{result['group']:>6} {result['name']:<28} {result['size']:>6} {result['mode']:>4} "
+        f"{result['mean_s'] * 1000:>10.1f} ms {result['throughput']:>9.2f} {result['throughput_unit']:<10} "
+        f"{result['peak_rss_mb']:>8.1f} MB"
+        + (f" {result['output_kb']:>8.0f} KB out" if 'output_kb' in result else "")
+        + (
+            f" {result['pil_images']:>5.1f} img {result['pil_blocks']:>5.1f} blk"
+            f" {result['numpy_peak_mb']:>7.1f} MB np"
+            if 'pil_images' in result else ""
+        )
+        + (
+            f" err {result['mean_error']:>5.2f} mean {result['max_error']:>3} max"
+            if 'mean_error' in result else ""
+        )
+    )
+
+
+def compare(results, baseline, threshold):
+    """Замеры, ставшие медленнее эталона больше чем на threshold"""
+    reference = {result['key']: result for result in baseline['results']}
+    regressions = []
+    for result in results:
+        base = reference.get(result['key'])
+        if base is None:
+            continue
+        ratio = result['mean_s'] / base['mean_s'] if base['mean_s'] else math.inf
+        if ratio > 1 + threshold:
+            regressions.append((result['key'], base['mean_s'], result['mean_s'], ratio))
+    return regressions
+
+
+def legacy_color_stage(image, brightness, contrast, color, sharpness):
+    """Прежняя цепочка ImageEnhance - эталон для сравнения"""
+    image = ImageEnhance.Brightness(image).enhance(brightness)
+    image = ImageEnhance.Contrast(image).enhance(contrast)
+    image = ImageEnhance.Color(image).enhance(color)
+    return ImageEnhance.Sharpness(image).enhance(sharpness)
+
+
+def fused_color_stage(uniqualizer, image, brightness, contrast, color, sharpness):
+    """Цветовая матрица + одно ядро резкости"""
+    image = uniqualizer.adjust_colors(image, brightness, contrast, color)
+    return image.filter(uniqualizer.sharpness_kernel(sharpness))
+
+
+def legacy_color_blur_stage(image, factors, radius):
+    """Прежняя цепочка + отдельное гауссово размытие"""
+    image = legacy_color_stage(image, *factors)
+    return image.filter(ImageFilter.GaussianBlur(radius))
+
+
+def fused_color_blur_stage(uniqualizer, image, factors, radius):
+    """Цветовая матрица + резкость, свёрнутая в размытие"""
+    brightness, contrast, color, sharpness = factors
+    image = uniqualizer.adjust_colors(image, brightness, contrast, color)
+    variance = radius ** 2 + (1 - sharpness) * SMOOTH_VARIANCE
+    return gaussian_blur(image, math.sqrt(variance))
+
+
+def random_color_factors():
+    """Коэффициенты в тех же диапазонах, что и в basic_modifications"""
+    return (
+        random.uniform(0.95, 1.05),
+        random.uniform(0.95, 1.05),
+        random.uniform(0.95, 1.05),
+        random.uniform(0.9, 1.1),
+    )
+
+
+def bench_color_stage(uniqualizer, sizes):
+    """Цветовая стадия basic_modifications: до и после слияния"""
+    print("Color stage (brightness/contrast/color/sharpness), s per variant")
+    print(f"{'size':>8} {'legacy':>10} {'fused':>10} {'speedup':>8}")
+
+    for name in sizes:
+        image = make_image(SIZES[name])
+        factors = random_color_factors()
+        legacy = measure(lambda: legacy_color_stage(image, *factors))
+        fused = measure(lambda: fused_color_stage(uniqualizer, image, *factors))
+        print(f"{name:>8} {legacy:>10.4f} {fused:>10.4f} {legacy / fused:>7.2f}x")
+
+    print()
+    print("Color stage + blur (radius 3, no overlays), s per variant")
+    print(f"{'size':>8} {'legacy':>10} {'fused':>10} {'speedup':>8}")
+
+    for name in sizes:
+        image = make_image(SIZES[name])
+        factors = random_color_factors()
+        legacy = measure(lambda: legacy_color_blur_stage(image, factors, 3))
+        fused = measure(lambda: fused_color_blur_stage(uniqualizer, image, factors, 3))
+        print(f"{name:>8} {legacy:>10.4f} {fused:>10.4f} {legacy / fused:>7.2f}x")
+
+
+def parse_list(value, allowed):
+    items = [item.strip() for item in value.split(',') if item.strip()]
+    for item in items:
+        if item not in allowed:
+            raise argparse.ArgumentTypeError(f"{item!r} не из {sorted(allowed)}")
+    return items
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="Бенчмарки PhotoUniqulizer")
+    parser.add_argument('--suite', choices=('all', 'effects', 'jobs', 'caps', 'encode', 'alloc', 'stack', 'blur', 'tile', 'color'), default='all')
+    parser.add_argument('--sizes', default=','.join(DEFAULT_SIZES),
+                        type=lambda v: parse_list(v, SIZES))
+    parser.add_argument('--modes', default=','.join(MODES),
+                        type=lambda v: parse_list(v, MODES))
+    parser.add_argument('--counts', default=','.join(map(str, JOB_COUNTS)),
+                        type=lambda v: [int(c) for c in v.split(',')])
+    parser.add_argument('--repeat', type=int, default=3)
+    parser.add_argument('--json', help="куда записать результаты в JSON")
+    parser.add_argument('--baseline', help="JSON прошлого прогона для сравнения")
+    parser.add_argument('--threshold', type=float, default=0.2,
+                        help="допустимое замедление относительно эталона (0.2 = 20%%)")
+    args = parser.parse_args(argv)
+
+    uniqualizer = PhotoUniqulizer()
+
+    if args.suite == 'color':
+        bench_color_stage(uniqualizer, args.sizes)
+        return 0
+
+    results = []
+    if args.suite in ('all', 'effects'):
+        results += bench_effects(uniqualizer, args.sizes, args.modes, args.repeat)
+    if args.suite in ('all', 'jobs'):
+        results += bench_jobs(uniqualizer, args.sizes, args.counts, args.repeat)
+    if args.suite in ('all', 'caps'):
+        results += bench_caps(uniqualizer, args.sizes, args.repeat)
+    if args.suite in ('all', 'encode'):
+        results += bench_encode(args.sizes, args.repeat)
+    if args.suite in ('all', 'alloc'):
+        results += bench_allocations(uniqualizer, args.sizes, args.repeat)
+    if args.suite in ('all', 'stack'):
+        results += bench_stack(uniqualizer, args.sizes, args.repeat)
+    if args.suite in ('all', 'blur'):
+        results += bench_blur(args.sizes, args.repeat)
+    if args.suite in ('all', 'tile'):
+        results += bench_tile(uniqualizer, args.sizes, args.repeat)
+
+    report = {
+        'python': platform.python_version(),
+        'platform': platform.platform(),
+        'machine': platform.machine(),
+        'numpy': np.__version__,
+        'pillow': Image.__version__,
+        'results': results,
+    }
+    if args.json:
+        with open(args.json, 'w') as f:
+            json.dump(report, f, indent=2)
+
+    if args.baseline:
+        with open(args.baseline) as f:
+            baseline = json.load(f)
+        regressions = compare(results, baseline, args.threshold)
+        for key, before, after, ratio in regressions:
+            print(f"REGRESSION {key}: {before * 1000:.1f} ms -> {after * 1000:.1f} ms ({ratio:.2f}x)")
+        if regressions:
+            return 1
+        print(f"No regressions over {args.threshold:.0%} against {args.baseline}")
+
+    return 0
+
+
+if __name__ == "__main__":
+    sys.exit(main())
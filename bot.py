@@ -2,24 +2,40 @@ import asyncio
 import logging
 import os
 import random
+import secrets
+import time
 from datetime import datetime
 from io import BytesIO
 
 from aiogram import Bot, Dispatcher, F, Router
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.filters import Command, StateFilter
 from aiogram.fsm.context import FSMContext
 from aiogram.fsm.state import State, StatesGroup
-from aiogram.fsm.storage.memory import MemoryStorage
 from aiogram.types import (
     Message, 
     CallbackQuery, 
     InlineKeyboardMarkup, 
     InlineKeyboardButton,
     BufferedInputFile,
-    FSInputFile
+    FSInputFile,
+    InputMediaPhoto,
+    InputMediaDocument
 )
+from aiohttp import web
 
-from uniqualizer import PhotoUniqulizer
+import metrics
+import variants
+from albums import AlbumMiddleware
+from encoder import extension
+from downloads import FileTooLarge, cleanup_temp_dir, download_to_temp, remove_temp_file
+from job_queue import QueueRenderEngine
+from render_engine import RenderEngine
+from scheduler import JobScheduler, JobLimitExceeded
+from source_cache import DiskSourceCache
+from sender import TelegramSender
+from storage import KVStorage, UserSettingsStore, create_backend
+from webserver import UpdateLimiter, create_web_app, setup_webhook, start_web_server
 from config import config
 
 logging.basicConfig(
@@ -36,8 +52,90 @@ class UniqueStates(StatesGroup):
     setting_params = State()
     processing = State()
 
-uniqualizer = PhotoUniqulizer()
-user_data = {}
+if config.RENDER_BACKEND == 'queue':
+    render_engine = QueueRenderEngine(
+        config.RENDER_WORKERS,
+        config.RENDER_CHUNK_SIZE,
+        token=config.RENDER_QUEUE_TOKEN,
+        lease_timeout=config.RENDER_LEASE_TIMEOUT,
+        max_attempts=config.RENDER_MAX_ATTEMPTS,
+        max_side=config.MAX_WORKING_SIDE,
+        upscale=config.UPSCALE_OUTPUT,
+        output_format=config.OUTPUT_FORMAT,
+        max_output_bytes=config.MAX_OUTPUT_BYTES
+    )
+else:
+    render_engine = RenderEngine(
+        config.RENDER_WORKERS,
+        config.RENDER_CHUNK_SIZE,
+        max_side=config.MAX_WORKING_SIDE,
+        upscale=config.UPSCALE_OUTPUT,
+        cache_bytes=config.SOURCE_CACHE_MEMORY,
+        output_format=config.OUTPUT_FORMAT,
+        max_output_bytes=config.MAX_OUTPUT_BYTES,
+        encode_threads=config.ENCODE_THREADS,
+        stack_bytes=config.RENDER_STACK_MEMORY,
+        tile_pixels=config.RENDER_TILE_PIXELS,
+        tile_bytes=config.RENDER_TILE_MEMORY
+    )
+# Скачанные исходники по file_unique_id - повторная отправка не качается заново
+source_disk_cache = (
+    DiskSourceCache(os.path.join(config.TEMP_DIR, "sources"), config.SOURCE_CACHE_DISK)
+    if config.SOURCE_CACHE_DISK else None
+)
+scheduler = JobScheduler(
+    render_engine,
+    max_inflight=config.MAX_INFLIGHT_RENDERS,
+    max_jobs_per_user=config.MAX_JOBS_PER_USER,
+    max_queued_variants_per_user=config.MAX_QUEUED_VARIANTS_PER_USER,
+    max_waiting_jobs=config.MAX_WAITING_JOBS
+)
+sender = TelegramSender(
+    global_rate=config.SEND_GLOBAL_RATE,
+    chat_rate=config.SEND_CHAT_RATE,
+    chat_burst=config.SEND_CHAT_BURST,
+    max_retries=config.SEND_MAX_RETRIES
+)
+update_limiter = UpdateLimiter(config.MAX_PENDING_UPDATES)
+# Общий backend для настроек пользователей и FSM
+storage_backend = create_backend(
+    config.STORAGE,
+    sqlite_path=config.SQLITE_PATH,
+    redis_url=config.REDIS_URL,
+    cache_size=config.STORAGE_CACHE_SIZE,
+    cache_ttl=config.STORAGE_CACHE_TTL
+)
+
+# Глубина очередей снимается в момент выгрузки метрик
+metrics.registry.gauge(
+    "uniq_render_queued_variants", "Вариантов в очереди на рендер",
+    func=lambda: scheduler.queued
+)
+metrics.registry.gauge(
+    "uniq_render_inflight_variants", "Вариантов в рендере",
+    func=lambda: scheduler.inflight
+)
+metrics.registry.gauge(
+    "uniq_send_queue_depth", "Отправок, ждущих лимитов Telegram",
+    func=lambda: sender.queue_depth
+)
+metrics.registry.gauge(
+    "uniq_pending_updates", "Апдейтов, ещё не принятых в работу",
+    func=lambda: update_limiter.pending
+)
+if isinstance(render_engine, QueueRenderEngine):
+    metrics.registry.gauge(
+        "uniq_queue_pending_tasks", "Пачек ждёт воркера",
+        func=lambda: render_engine.pending
+    )
+    metrics.registry.gauge(
+        "uniq_queue_leased_tasks", "Пачек в аренде у воркеров",
+        func=lambda: render_engine.leased
+    )
+    metrics.registry.gauge(
+        "uniq_queue_active_workers", "Воркеров, приходивших за задачами",
+        func=lambda: render_engine.active_workers
+    )
 
 def get_user_default_params():
     """Дефолтные параметры"""
@@ -51,15 +149,20 @@ def get_user_default_params():
         'mode': 'manual'  # manual или auto
     }
 
-def get_auto_params():
-    """Генерирует случайные параметры для авто-режима"""
+user_settings = UserSettingsStore(storage_backend, get_user_default_params)
+
+def get_auto_params(rng=random):
+    """
+    Генерирует случайные параметры для авто-режима;
+    rng - random.Random варианта (variants.variant_rngs) или модуль random
+    """
     return {
-        'noise': random.choice([True, False]),
-        'stripes': random.choice([True, False]),
-        'smiles': random.choice([True, True, False]),  # Чаще True
-        'background': random.choice([True, False]),
-        'blur_radius': random.randint(0, 5),
-        'count': random.randint(3, 10)
+        'noise': rng.choice([True, False]),
+        'stripes': rng.choice([True, False]),
+        'smiles': rng.choice([True, True, False]),  # Чаще True
+        'background': rng.choice([True, False]),
+        'blur_radius': rng.randint(0, 5),
+        'count': rng.randint(3, 10)
     }
 
 def get_mode_keyboard():
@@ -116,10 +219,8 @@ def get_auto_settings_keyboard():
     ]
     return InlineKeyboardMarkup(inline_keyboard=keyboard)
 
-def get_params_keyboard(user_id: int):
+def get_params_keyboard(params: dict):
     """Генерирует клавиатуру с параметрами для ручного режима"""
-    params = user_data.get(user_id, get_user_default_params())
-    
     keyboard = [
         [
             InlineKeyboardButton(
@@ -250,11 +351,6 @@ def get_auto_count_keyboard():
 @router.message(Command("start"))
 async def cmd_start(message: Message, state: FSMContext):
     """Обработчик команды /start"""
-    user_id = message.from_user.id
-    
-    if user_id not in user_data:
-        user_data[user_id] = get_user_default_params()
-    
     await message.answer(
         f"🔥 <b>Привет, {message.from_user.first_name}!</b>\n\n"
         f"Я бот для уникализации фото 📸\n\n"
@@ -282,7 +378,7 @@ async def cmd_help(message: Message):
         "2️⃣ Выбери режим:\n"
         "   • 🎲 АВТО - бот сам генерирует параметры\n"
         "   • ⚙️ РУЧНОЙ - настраиваешь всё сам\n"
-        "3️⃣ Отправь фото\n"
+        "3️⃣ Отправь фото (можно файлом - без сжатия)\n"
         "4️⃣ Получи уникализированные версии!\n\n"
         "<b>🎲 Авто-режим:</b>\n"
         "Бот случайно выбирает какие эффекты применить.\n"
@@ -301,11 +397,6 @@ async def cmd_help(message: Message):
 @router.message(Command("unique"))
 async def cmd_unique(message: Message, state: FSMContext):
     """Начало уникализации"""
-    user_id = message.from_user.id
-    
-    if user_id not in user_data:
-        user_data[user_id] = get_user_default_params()
-    
     await state.set_state(UniqueStates.choosing_mode)
     
     await message.answer(
@@ -332,11 +423,10 @@ async def mode_help(callback: CallbackQuery):
 async def mode_auto(callback: CallbackQuery, state: FSMContext):
     """Выбран авто-режим"""
     user_id = callback.from_user.id
-    user_data[user_id]['mode'] = 'auto'
     
     # Генерируем начальные параметры
     auto_params = get_auto_params()
-    user_data[user_id].update(auto_params)
+    await user_settings.update(user_id, {**auto_params, 'mode': 'auto'})
     
     await state.set_state(UniqueStates.setting_params)
     
@@ -363,7 +453,7 @@ async def auto_generate(callback: CallbackQuery):
     user_id = callback.from_user.id
     
     auto_params = get_auto_params()
-    user_data[user_id].update(auto_params)
+    await user_settings.update(user_id, auto_params)
     
     params_text = "🎲 <b>АВТО РЕЖИМ</b>\n\n"
     params_text += "Новые параметры сгенерированы! 🎰\n\n"
@@ -398,9 +488,8 @@ async def auto_count_selected(callback: CallbackQuery):
     user_id = callback.from_user.id
     count_value = int(callback.data.split("_")[2])
     
-    user_data[user_id]['count'] = count_value
+    params = await user_settings.update(user_id, {'count': count_value})
     
-    params = user_data[user_id]
     params_text = "🎲 <b>АВТО РЕЖИМ</b>\n\n"
     params_text += f"🔊 Шумы: {'✅' if params['noise'] else '❌'}\n"
     params_text += f"📊 Полосы: {'✅' if params['stripes'] else '❌'}\n"
@@ -421,7 +510,7 @@ async def auto_count_selected(callback: CallbackQuery):
 async def back_to_auto(callback: CallbackQuery):
     """Возврат к авто-настройкам"""
     user_id = callback.from_user.id
-    params = user_data[user_id]
+    params = await user_settings.get(user_id)
     
     params_text = "🎲 <b>АВТО РЕЖИМ</b>\n\n"
     params_text += f"🔊 Шумы: {'✅' if params['noise'] else '❌'}\n"
@@ -444,7 +533,7 @@ async def auto_ready(callback: CallbackQuery, state: FSMContext):
     await state.set_state(UniqueStates.waiting_for_photo)
     
     user_id = callback.from_user.id
-    params = user_data[user_id]
+    params = await user_settings.get(user_id)
     
     params_text = "🎲 <b>АВТО РЕЖИМ АКТИВИРОВАН!</b>\n\n"
     params_text += "Текущие параметры:\n"
@@ -463,14 +552,14 @@ async def auto_ready(callback: CallbackQuery, state: FSMContext):
 async def mode_manual(callback: CallbackQuery, state: FSMContext):
     """Выбран ручной режим"""
     user_id = callback.from_user.id
-    user_data[user_id]['mode'] = 'manual'
+    params = await user_settings.update(user_id, {'mode': 'manual'})
     
     await state.set_state(UniqueStates.setting_params)
     
     await callback.message.edit_text(
         "⚙️ <b>РУЧНОЙ РЕЖИМ</b>\n\n"
         "Настрой параметры кнопками ниже 👇",
-        reply_markup=get_params_keyboard(user_id),
+        reply_markup=get_params_keyboard(params),
         parse_mode="HTML"
     )
     await callback.answer()
@@ -496,29 +585,37 @@ async def back_to_mode(callback: CallbackQuery, state: FSMContext):
 @router.callback_query(F.data == "toggle_noise")
 async def toggle_noise(callback: CallbackQuery):
     user_id = callback.from_user.id
-    user_data[user_id]['noise'] = not user_data[user_id]['noise']
-    await callback.message.edit_reply_markup(reply_markup=get_params_keyboard(user_id))
+    params = await user_settings.get(user_id)
+    params['noise'] = not params['noise']
+    await user_settings.save(user_id, params)
+    await callback.message.edit_reply_markup(reply_markup=get_params_keyboard(params))
     await callback.answer("🔊 Шумы переключены!")
 
 @router.callback_query(F.data == "toggle_stripes")
 async def toggle_stripes(callback: CallbackQuery):
     user_id = callback.from_user.id
-    user_data[user_id]['stripes'] = not user_data[user_id]['stripes']
-    await callback.message.edit_reply_markup(reply_markup=get_params_keyboard(user_id))
+    params = await user_settings.get(user_id)
+    params['stripes'] = not params['stripes']
+    await user_settings.save(user_id, params)
+    await callback.message.edit_reply_markup(reply_markup=get_params_keyboard(params))
     await callback.answer("📊 Полосы переключены!")
 
 @router.callback_query(F.data == "toggle_smiles")
 async def toggle_smiles(callback: CallbackQuery):
     user_id = callback.from_user.id
-    user_data[user_id]['smiles'] = not user_data[user_id]['smiles']
-    await callback.message.edit_reply_markup(reply_markup=get_params_keyboard(user_id))
+    params = await user_settings.get(user_id)
+    params['smiles'] = not params['smiles']
+    await user_settings.save(user_id, params)
+    await callback.message.edit_reply_markup(reply_markup=get_params_keyboard(params))
     await callback.answer("😀 Эмодзи переключены!")
 
 @router.callback_query(F.data == "toggle_background")
 async def toggle_background(callback: CallbackQuery):
     user_id = callback.from_user.id
-    user_data[user_id]['background'] = not user_data[user_id]['background']
-    await callback.message.edit_reply_markup(reply_markup=get_params_keyboard(user_id))
+    params = await user_settings.get(user_id)
+    params['background'] = not params['background']
+    await user_settings.save(user_id, params)
+    await callback.message.edit_reply_markup(reply_markup=get_params_keyboard(params))
     await callback.answer("🎨 Фон переключен!")
 
 @router.callback_query(F.data == "set_blur")
@@ -534,11 +631,11 @@ async def set_blur(callback: CallbackQuery):
 async def blur_selected(callback: CallbackQuery):
     user_id = callback.from_user.id
     blur_value = int(callback.data.split("_")[1])
-    user_data[user_id]['blur_radius'] = blur_value
+    params = await user_settings.update(user_id, {'blur_radius': blur_value})
     
     await callback.message.edit_text(
         "⚙️ <b>РУЧНОЙ РЕЖИМ</b>\n\nНастрой параметры кнопками ниже 👇",
-        reply_markup=get_params_keyboard(user_id),
+        reply_markup=get_params_keyboard(params),
         parse_mode="HTML"
     )
     await callback.answer(f"🌫 Размытие: {blur_value}")
@@ -561,11 +658,11 @@ async def count_selected(callback: CallbackQuery):
         await callback.answer(f"❌ Максимум {config.MAX_UNIQUALIZATIONS}!", show_alert=True)
         return
     
-    user_data[user_id]['count'] = count_value
+    params = await user_settings.update(user_id, {'count': count_value})
     
     await callback.message.edit_text(
         "⚙️ <b>РУЧНОЙ РЕЖИМ</b>\n\nНастрой параметры кнопками ниже 👇",
-        reply_markup=get_params_keyboard(user_id),
+        reply_markup=get_params_keyboard(params),
         parse_mode="HTML"
     )
     await callback.answer(f"🔢 Количество: {count_value}")
@@ -573,19 +670,19 @@ async def count_selected(callback: CallbackQuery):
 @router.callback_query(F.data == "reset_params")
 async def reset_params(callback: CallbackQuery):
     user_id = callback.from_user.id
-    user_data[user_id] = get_user_default_params()
-    user_data[user_id]['mode'] = 'manual'
+    params = await user_settings.reset(user_id)
     
-    await callback.message.edit_reply_markup(reply_markup=get_params_keyboard(user_id))
+    await callback.message.edit_reply_markup(reply_markup=get_params_keyboard(params))
     await callback.answer("🔄 Параметры сброшены!")
 
 @router.callback_query(F.data == "back_to_params")
 async def back_to_params(callback: CallbackQuery):
     user_id = callback.from_user.id
+    params = await user_settings.get(user_id)
     
     await callback.message.edit_text(
         "⚙️ <b>РУЧНОЙ РЕЖИМ</b>\n\nНастрой параметры кнопками ниже 👇",
-        reply_markup=get_params_keyboard(user_id),
+        reply_markup=get_params_keyboard(params),
         parse_mode="HTML"
     )
     await callback.answer()
@@ -595,7 +692,7 @@ async def params_ready(callback: CallbackQuery, state: FSMContext):
     await state.set_state(UniqueStates.waiting_for_photo)
     
     user_id = callback.from_user.id
-    params = user_data[user_id]
+    params = await user_settings.get(user_id)
     
     params_text = "⚙️ <b>РУЧНОЙ РЕЖИМ</b>\n\n"
     params_text += "Выбранные параметры:\n\n"
@@ -610,132 +707,406 @@ async def params_ready(callback: CallbackQuery, state: FSMContext):
     await callback.message.edit_text(params_text, parse_mode="HTML")
     await callback.answer()
 
-@router.message(StateFilter(UniqueStates.waiting_for_photo), F.photo)
-async def process_photo(message: Message, state: FSMContext, bot: Bot):
-    """Обработка фото"""
+def format_eta(seconds: float) -> str:
+    """Человекочитаемая оценка времени"""
+    if seconds < 60:
+        return f"~{max(1, round(seconds))} сек"
+    return f"~{round(seconds / 60)} мин"
+
+class JobProgress:
+    """Прогресс задачи в статус-сообщении: очередь, рендер и отправка"""
+    
+    # Не правим статус чаще раза в секунду (лимиты Telegram на edit)
+    MIN_EDIT_INTERVAL = 1.0
+    
+    def __init__(self, status_msg: Message, mode_emoji: str, job):
+        self.status_msg = status_msg
+        self.mode_emoji = mode_emoji
+        self.job = job
+        self.total = job.total
+        self.sent = 0
+        self._last_text = None
+        self._last_edit = 0.0
+    
+    def text(self) -> str:
+        position = self.job.position()
+        if position > 0:
+            return (
+                f"{self.mode_emoji} <b>В очереди...</b>\n"
+                f"Позиция: {position} ⏳\n"
+                f"Готово будет через {format_eta(self.job.eta())}"
+            )
+        
+        text = (
+            f"{self.mode_emoji} <b>Обработка...</b>\n"
+            f"Готово: {self.job.done}/{self.total} 📊\n"
+            f"Отправлено: {self.sent}/{self.total} 📤"
+        )
+        if self.job.remaining:
+            text += f"\nОсталось {format_eta(self.job.eta())}"
+        return text
+    
+    async def update(self):
+        text = self.text()
+        now = time.monotonic()
+        if text == self._last_text or now - self._last_edit < self.MIN_EDIT_INTERVAL:
+            return
+        
+        self._last_text = text
+        self._last_edit = now
+        try:
+            await sender.send(self.status_msg.chat.id, self.status_msg.edit_text, text, parse_mode="HTML")
+        except TelegramBadRequest as e:
+            logger.warning(f"Status update failed: {e}")
+    
+    async def run_ticker(self, interval: float = 3.0):
+        """Периодически обновляет статус (позиция и ETA меняются сами по себе)"""
+        while True:
+            await asyncio.sleep(interval)
+            await self.update()
+
+async def render_results(job, queue: asyncio.Queue, progress: JobProgress):
+    """Производитель: забирает готовые варианты задачи и кладёт в ограниченную очередь"""
+    try:
+        async for index, img_bytes in job.results():
+            if img_bytes is None:
+                logger.error(f"Error processing image {index}")
+                continue
+            
+            # Очередь ограничена: если отправка не успевает, рендер ждёт
+            await queue.put((index, img_bytes))
+            await progress.update()
+    except Exception:
+        await queue.put(None)
+        raise
+    
+    await queue.put(None)
+
+async def send_results(message: Message, queue: asyncio.Queue, mode_emoji: str,
+                       progress: JobProgress, album_size: int = 1, as_documents: bool = False):
+    """
+    Потребитель: отправляет варианты по мере готовности, возвращает число отправленных.
+    album_size > 1 - на входе был альбом: каждый вариант уходит таким же альбомом;
+    as_documents - файлами, без пережатия и лимитов Telegram на размер фото
+    """
+    chat_id = message.chat.id
+    mode = progress.job.mode
+    batch = []
+    
+    async def send(method, cost=1, **kwargs):
+        # Время отправки вместе с ожиданием лимитов Telegram
+        started = time.monotonic()
+        await sender.send(chat_id, method, cost=cost, **kwargs)
+        metrics.STAGE_SECONDS.observe(time.monotonic() - started, stage='send', mode=mode)
+    
+    async def send_one(index, img_bytes, caption):
+        input_file = BufferedInputFile(img_bytes, filename=f"unique_{index + 1}{extension(config.OUTPUT_FORMAT)}")
+        if as_documents:
+            await send(message.answer_document, document=input_file, caption=caption)
+        else:
+            await send(message.answer_photo, photo=input_file, caption=caption)
+    
+    async def send_batch(caption):
+        if len(batch) == 1:
+            # Альбом из одного фото Telegram не принимает
+            index, img_bytes = batch[0]
+            await send_one(index, img_bytes, caption)
+        else:
+            media_type = InputMediaDocument if as_documents else InputMediaPhoto
+            media_group = []
+            for pos, (index, img_bytes) in enumerate(batch):
+                input_file = BufferedInputFile(img_bytes, filename=f"unique_{index + 1}{extension(config.OUTPUT_FORMAT)}")
+                media_group.append(media_type(
+                    media=input_file,
+                    caption=caption if pos == 0 else None
+                ))
+            await send(message.answer_media_group, media=media_group, cost=len(media_group))
+        
+        progress.sent += len(batch)
+        batch.clear()
+        await progress.update()
+    
+    while True:
+        item = await queue.get()
+        if item is None:
+            break
+        
+        if album_size > 1:
+            # Вариант #k всех фото альбома - одним альбомом (упавшие пропускаем)
+            if batch and item[0] // album_size != batch[0][0] // album_size:
+                await send_batch(f"{mode_emoji} #{batch[0][0] // album_size + 1}")
+            batch.append(item)
+        elif progress.total <= 10:
+            # Немного фото - шлём по одному, как только готово
+            index, img_bytes = item
+            await send_one(index, img_bytes, f"{mode_emoji} Уникализация #{index + 1}")
+            progress.sent += 1
+            await progress.update()
+        else:
+            # Много фото - альбомами по 10
+            batch.append(item)
+            if len(batch) == 10:
+                await send_batch(f"{mode_emoji} #{batch[0][0] + 1}")
+    
+    if batch:
+        if album_size > 1:
+            await send_batch(f"{mode_emoji} #{batch[0][0] // album_size + 1}")
+        else:
+            await send_batch(f"{mode_emoji} #{batch[0][0] + 1}")
+    
+    return progress.sent
+
+@router.message(
+    StateFilter(UniqueStates.waiting_for_photo),
+    F.photo | F.document.mime_type.startswith("image/"),
+    flags={"album": True}
+)
+async def process_photo(message: Message, state: FSMContext, bot: Bot, album: list[Message] = None,
+                        admitted=None):
+    """
+    Обработка фото или картинки, отправленной файлом (без сжатия).
+    Альбом (собирает AlbumMiddleware) уникализируется одной задачей.
+    admitted (UpdateLimiter) - задача начала рендериться, апдейт больше
+    не держит место в лимите webhook
+    """
     user_id = message.from_user.id
-    params = user_data.get(user_id, get_user_default_params())
+    params = await user_settings.get(user_id)
     
     await state.set_state(UniqueStates.processing)
     
-    photo = message.photo[-1]
+    items = [
+        item for item in (album or [message])
+        if item.photo or (item.document and (item.document.mime_type or "").startswith("image/"))
+    ]
+    photos = [item.photo[-1] if item.photo else item.document for item in items]
+    # Картинки файлом и возвращаются файлами в исходном размере: эффекты -
+    # в рабочем разрешении, результат растягивается до исходника. Фото Telegram
+    # сжимает до 2560 и на входе, и на выходе - их растягивает только UPSCALE_OUTPUT
+    as_documents = not any(item.photo for item in items)
+    upscales = [config.UPSCALE_OUTPUT or as_documents] * len(items)
     
-    if photo.file_size > config.MAX_FILE_SIZE:
+    # Размер известен из апдейта - большие файлы отсекаем до скачивания
+    if any(photo.file_size and photo.file_size > config.MAX_FILE_SIZE for photo in photos):
         await message.answer(
             f"❌ Файл слишком большой!\nМаксимум: {config.MAX_FILE_SIZE // 1024 // 1024}MB"
         )
         await state.set_state(UniqueStates.waiting_for_photo)
         return
     
-    mode_emoji = "🎲" if params.get('mode') == 'auto' else "⚙️"
+    mode = params.get('mode', 'manual')
+    mode_emoji = "🎲" if mode == 'auto' else "⚙️"
+    album_text = f" альбома из {len(photos)} фото" if len(photos) > 1 else ""
     status_msg = await message.answer(
         f"{mode_emoji} <b>Обработка...</b>\n"
-        f"Создаю {params['count']} версий 🔄",
+        f"Создаю {params['count']} версий{album_text} 🔄",
         parse_mode="HTML"
     )
     
+    # Текущая стадия - для метрики ошибок
+    stage = 'download'
+    started = time.monotonic()
+    # file_unique_id одинаков у одного файла для всех ботов и отправок:
+    # уже декодированные исходники берём из кэша движка, не скачивая
+    keys = [photo.file_unique_id for photo in photos]
+    images = [
+        render_engine.cached_source(key, upscale)
+        for key, upscale in zip(keys, upscales)
+    ]
+    job = None
     try:
-        file = await bot.get_file(photo.file_id)
-        photo_bytes = await bot.download_file(file.file_path)
-        image_data = photo_bytes.read()
+        # Остальные исходники качаются параллельно, на диск кусками,
+        # и декодируются прямо из файлов
+        missing = [i for i, image in enumerate(images) if image is None]
+        downloads = await asyncio.gather(*(
+            download_to_temp(
+                bot, photos[i].file_id, config.TEMP_DIR, config.MAX_FILE_SIZE,
+                cache=source_disk_cache, key=keys[i]
+            )
+            for i in missing
+        ), return_exceptions=True)
+        for i, item in zip(missing, downloads):
+            if not isinstance(item, BaseException):
+                images[i] = item[0]
+        for item in downloads:
+            if isinstance(item, BaseException):
+                raise item
+        if downloads:
+            metrics.STAGE_SECONDS.observe(time.monotonic() - started, stage='download', mode=mode)
+            metrics.BYTES.inc(sum(size for _, size in downloads), direction='in', mode=mode)
         
-        results = []
+        stage = 'render'
+        
+        # Параметры всех вариантов готовим заранее, рендер идёт в пуле процессов.
+        # Всё случайное в задаче выводится из её seed: и параметры авто-режима,
+        # и рендер - любой вариант можно повторить по его ID
+        seed = variants.new_job_seed()
+        params_list = []
         for i in range(params['count']):
-            try:
-                # Если авто-режим - генерируем новые параметры для КАЖДОГО фото!
-                if params.get('mode') == 'auto':
-                    current_params = {
-                        'noise': random.choice([True, False]),
-                        'stripes': random.choice([True, False]),
-                        'smiles': random.choice([True, True, False]),
-                        'background': random.choice([True, False]),
-                        'blur_radius': random.randint(0, 5)
-                    }
-                else:
-                    current_params = params
-                
-                unique_image = uniqualizer.uniqualize(image_data, current_params)
-                results.append(unique_image)
-                
-                if (i + 1) % 5 == 0:
-                    await status_msg.edit_text(
-                        f"{mode_emoji} <b>Обработка...</b>\n"
-                        f"Готово: {i + 1}/{params['count']} 📊",
-                        parse_mode="HTML"
-                    )
-            except Exception as e:
-                logger.error(f"Error processing image {i}: {e}")
-                continue
+            # Если авто-режим - генерируем новые параметры для КАЖДОГО фото!
+            if mode == 'auto':
+                rng, _ = variants.variant_rngs(variants.variant_id(seed, i), variants.PARAMS)
+                current_params = get_auto_params(rng)
+                del current_params['count']
+            else:
+                current_params = params
+            params_list.append(current_params)
         
-        await status_msg.edit_text(
-            f"📤 <b>Отправка...</b>\nВсего: {len(results)} фото",
-            parse_mode="HTML"
-        )
+        try:
+            job = scheduler.submit(
+                user_id, images, params_list, mode=mode, keys=keys, seed=seed,
+                upscales=upscales
+            )
+        except JobLimitExceeded as e:
+            metrics.JOBS.inc(mode=mode, status='rejected')
+            await status_msg.edit_text(
+                f"⏳ <b>Подожди!</b>\n\n{e}.\n"
+                f"Отправь фото, когда закончатся текущие задачи.",
+                parse_mode="HTML"
+            )
+            await state.set_state(UniqueStates.waiting_for_photo)
+            return
+        if admitted is not None:
+            # Ждущая в очереди задача держит место в лимите апдейтов,
+            # начавшую рендериться ограничивает планировщик
+            job_started = asyncio.create_task(job.wait_started())
+            job_started.add_done_callback(lambda _: admitted())
         
-        # Отправка результатов
-        if len(results) <= 10:
-            for idx, img_bytes in enumerate(results, 1):
-                input_file = BufferedInputFile(img_bytes, filename=f"unique_{idx}.jpg")
-                await message.answer_photo(
-                    photo=input_file,
-                    caption=f"{mode_emoji} Уникализация #{idx}"
-                )
-                await asyncio.sleep(0.3)
-        else:
-            from aiogram.types import InputMediaPhoto
-            
-            for i in range(0, len(results), 10):
-                batch = results[i:i+10]
-                media_group = []
-                
-                for idx, img_bytes in enumerate(batch, i+1):
-                    input_file = BufferedInputFile(img_bytes, filename=f"unique_{idx}.jpg")
-                    media = InputMediaPhoto(
-                        media=input_file,
-                        caption=f"{mode_emoji} #{idx}" if idx == i+1 else None
-                    )
-                    media_group.append(media)
-                
-                await message.answer_media_group(media=media_group)
-                await asyncio.sleep(0.5)
+        # Рендер и отправка идут параллельно: первые фото уходят,
+        # пока последние ещё рендерятся
+        progress = JobProgress(status_msg, mode_emoji, job)
+        await progress.update()
+        queue = asyncio.Queue(maxsize=config.SEND_QUEUE_SIZE)
+        producer = asyncio.create_task(render_results(job, queue, progress))
+        ticker = asyncio.create_task(progress.run_ticker())
+        stage = 'send'
+        try:
+            sent = await send_results(message, queue, mode_emoji, progress, len(images), as_documents)
+            await producer
+        finally:
+            ticker.cancel()
+            if not producer.done():
+                producer.cancel()
+            job.cancel()
+        
+        elapsed = time.monotonic() - started
+        metrics.JOB_SECONDS.observe(elapsed, mode=mode)
+        metrics.JOB_VARIANTS_PER_SECOND.observe(sent / elapsed, mode=mode)
+        metrics.JOBS.inc(mode=mode, status='ok')
         
         await status_msg.delete()
         
-        mode_text = "🎲 АВТО" if params.get('mode') == 'auto' else "⚙️ РУЧНОЙ"
-        await message.answer(
+        mode_text = "🎲 АВТО" if mode == 'auto' else "⚙️ РУЧНОЙ"
+        await sender.send(
+            message.chat.id, message.answer,
             f"✅ <b>Готово!</b>\n\n"
             f"Режим: {mode_text}\n"
-            f"Создано: {len(results)} версий 🎉\n\n"
+            f"Создано: {sent} версий 🎉\n\n"
             f"Ещё? → /unique",
             parse_mode="HTML"
         )
         
+    except FileTooLarge as e:
+        # В апдейте размера не было, а файл оказался больше лимита
+        metrics.JOBS.inc(mode=mode, status='rejected')
+        await status_msg.edit_text(
+            f"❌ Файл слишком большой!\nМаксимум: {e.max_size // 1024 // 1024}MB"
+        )
+        await state.set_state(UniqueStates.waiting_for_photo)
+        return
+    
     except Exception as e:
         logger.error(f"Error: {e}")
+        metrics.ERRORS.inc(stage=stage, mode=mode)
+        metrics.JOBS.inc(mode=mode, status='error')
         await status_msg.edit_text(
             f"❌ <b>Ошибка!</b>\n\nПопробуй /unique",
             parse_mode="HTML"
         )
     
+    finally:
+        for image in images:
+            if isinstance(image, str):
+                remove_temp_file(image)
+            elif image is not None and job is None:
+                # Исходник из кэша, до задачи дело не дошло - отдаём ссылку
+                render_engine.close_source(image)
+    
     await state.clear()
 
 @router.message(StateFilter(UniqueStates.waiting_for_photo))
 async def wrong_content_type(message: Message):
     await message.answer(
-        "❌ Отправь <b>фото</b>!\n\nДокументы не поддерживаются.",
+        "❌ Отправь <b>фото</b>!\n\nМожно и картинкой-файлом, другие документы не поддерживаются.",
         parse_mode="HTML"
     )
 
+async def health_handler(request):
+    """Состояние бота для проверок живости и балансировщика"""
+    return web.json_response({
+        'status': 'ok',
+        'mode': 'webhook' if config.USE_WEBHOOK else 'polling',
+        'render_backend': config.RENDER_BACKEND,
+        'render_workers': render_engine.workers,
+        'render_inflight': scheduler.inflight,
+        'render_queued': scheduler.queued,
+        'pending_updates': update_limiter.pending,
+        'send_queue_depth': sender.queue_depth,
+    })
+
+async def run_webhook(dp: Dispatcher, bot: Bot, app: web.Application):
+    """Принимает апдейты через webhook до остановки процесса"""
+    if not config.WEBHOOK_URL:
+        raise RuntimeError("USE_WEBHOOK=1 требует WEBHOOK_URL")
+    
+    secret = config.WEBHOOK_SECRET or secrets.token_urlsafe(32)
+    setup_webhook(app, dp, bot, config.WEBHOOK_PATH, secret, update_limiter)
+    runner = await start_web_server(app, config.WEBHOOK_HOST, config.WEBHOOK_PORT)
+    try:
+        await bot.set_webhook(
+            url=config.WEBHOOK_URL.rstrip('/') + config.WEBHOOK_PATH,
+            secret_token=secret,
+            max_connections=config.WEBHOOK_MAX_CONNECTIONS,
+            allowed_updates=dp.resolve_used_update_types()
+        )
+        logger.info(f"Webhook set: {config.WEBHOOK_URL}{config.WEBHOOK_PATH}")
+        await asyncio.Event().wait()
+    finally:
+        await runner.cleanup()
+
 async def main():
     bot = Bot(token=config.BOT_TOKEN)
-    dp = Dispatcher(storage=MemoryStorage())
+    dp = Dispatcher(storage=KVStorage(storage_backend))
+    dp.update.outer_middleware(update_limiter)
+    # Фото альбома приходят отдельными апдейтами - собираем их в одну задачу
+    router.message.middleware(AlbumMiddleware(config.ALBUM_LATENCY))
     dp.include_router(router)
     
+    render_engine.start()
+    cleanup_temp_dir(config.TEMP_DIR)
+    # Пачка от воркера - до RENDER_CHUNK_SIZE JPEG размером с исходник
+    app = create_web_app(health_handler, client_max_size=config.RENDER_CHUNK_SIZE * config.MAX_FILE_SIZE)
+    if isinstance(render_engine, QueueRenderEngine):
+        # Воркеры забирают пачки с того же HTTP-сервера
+        render_engine.setup_routes(app)
     logger.info("🚀 Бот запущен!")
     
     try:
-        await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+        if config.USE_WEBHOOK:
+            await run_webhook(dp, bot, app)
+        else:
+            runner = None
+            if isinstance(render_engine, QueueRenderEngine) and not config.METRICS_PORT:
+                raise RuntimeError("RENDER_BACKEND=queue требует HTTP-сервер: задай METRICS_PORT")
+            if config.METRICS_PORT:
+                runner = await start_web_server(app, config.METRICS_HOST, config.METRICS_PORT)
+            try:
+                await dp.start_polling(bot, allowed_updates=dp.resolve_used_update_types())
+            finally:
+                if runner is not None:
+                    await runner.cleanup()
     finally:
+        render_engine.shutdown()
+        await storage_backend.close()
         await bot.session.close()
 
 if __name__ == "__main__":
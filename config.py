@@ -8,7 +8,101 @@ class BotConfig:
     
     TEMP_DIR: str = "temp"
     MAX_UNIQUALIZATIONS: int = 50
+    # Лимиты пользователя: задач одновременно и версий в очереди
+    # (версия альбома - одна на все его фото)
+    MAX_JOBS_PER_USER: int = 2
+    MAX_QUEUED_VARIANTS_PER_USER: int = 100
+    # Задач всех пользователей, ждущих начала рендера (0 = без ограничения)
+    MAX_WAITING_JOBS: int = 50
+    # Глобальный лимит вариантов в рендере (0 = воркеры * размер пачки)
+    MAX_INFLIGHT_RENDERS: int = 0
     MAX_FILE_SIZE: int = 20 * 1024 * 1024
+    # Рабочее разрешение: длинная сторона, до которой уменьшается исходник
+    # перед эффектами (JPEG - сразу при декодировании); 0 = без ограничения.
+    # 2560 - максимум фото в Telegram, меньше - быстрее и экономнее по памяти
+    MAX_WORKING_SIDE: int = int(os.getenv("MAX_WORKING_SIDE", "2560"))
+    # Растягивать результат до размера исходника при кодировании.
+    # Картинки, присланные файлом, растягиваются всегда и возвращаются
+    # файлами; фото уходят фото - Telegram всё равно сжимает их до 2560
+    # (и не принимает больше 10MB или с шириной + высотой больше 10000)
+    UPSCALE_OUTPUT: bool = os.getenv("UPSCALE_OUTPUT", "0") == "1"
+    # Кэш исходников по file_unique_id для повторных отправок того же фото:
+    # декодированные в памяти (shared memory) и скачанные файлы на диске
+    # в TEMP_DIR/sources; бюджеты в байтах, 0 = уровень выключен.
+    # Кэш в памяти живёт в /dev/shm вместе с исходниками и результатами задач
+    # в работе (кадр 2560x1440 - ~11MB), а Docker по умолчанию даёт
+    # контейнеру 64MB: включая кэш, увеличь /dev/shm (--shm-size, например
+    # 512m) на его бюджет сверх обычного расхода
+    SOURCE_CACHE_MEMORY: int = int(os.getenv("SOURCE_CACHE_MEMORY", "0"))
+    SOURCE_CACHE_DISK: int = int(os.getenv("SOURCE_CACHE_DISK", "0"))
+    # Формат результатов: jpeg, progressive (прогрессивный JPEG) или webp
+    OUTPUT_FORMAT: str = os.getenv("OUTPUT_FORMAT", "jpeg")
+    # Лимит размера результата в байтах: качество подбирается под него
+    # (0 = без лимита). Меньше файлы - быстрее загрузка в Telegram
+    MAX_OUTPUT_BYTES: int = int(os.getenv("MAX_OUTPUT_BYTES", "0"))
+    # Потоков кодирования в каждом процессе рендера (0 = кодировать без пула).
+    # Помогает, когда процессов рендера меньше, чем ядер: кодирование
+    # вариантов идёт параллельно с эффектами следующих
+    ENCODE_THREADS: int = int(os.getenv("ENCODE_THREADS", "0"))
+    # Память под стек буферов в каждом процессе рендера: варианты пачки,
+    # которые в неё влезают (8 байт на пиксель), рендерятся одним стеком,
+    # фон и шум - сразу на весь стек (0 = по одному варианту)
+    RENDER_STACK_MEMORY: int = int(os.getenv("RENDER_STACK_MEMORY", str(128 * 1024 * 1024)))
+    # Кадры от RENDER_TILE_PIXELS пикселей (рабочее разрешение) рендерятся
+    # полосами: поворот, цвет, резкость и размытие не держат копий кадра
+    # целиком, промежуточные полосы - до RENDER_TILE_MEMORY байт на вариант
+    # (0 = всегда целиком). С MAX_WORKING_SIDE 2560 порог не достигается
+    RENDER_TILE_PIXELS: int = int(os.getenv("RENDER_TILE_PIXELS", str(12 * 1000 * 1000)))
+    RENDER_TILE_MEMORY: int = int(os.getenv("RENDER_TILE_MEMORY", str(32 * 1024 * 1024)))
+
+    # Где рендерить: local - пул процессов бота, queue - внешние worker.py
+    # забирают пачки через HTTP-сервер бота (/render/...)
+    RENDER_BACKEND: str = os.getenv("RENDER_BACKEND", "local")
+    RENDER_QUEUE_TOKEN: str = os.getenv("RENDER_QUEUE_TOKEN", "")
+    # Через сколько секунд несданная пачка возвращается в очередь
+    RENDER_LEASE_TIMEOUT: float = 60.0
+    RENDER_MAX_ATTEMPTS: int = 3
+    # Количество процессов рендера (0 = по числу ядер);
+    # для queue - сколько всего процессов у воркеров
+    RENDER_WORKERS: int = int(os.getenv("RENDER_WORKERS", "0"))
+    # Максимум вариантов в одной задаче воркера
+    RENDER_CHUNK_SIZE: int = 5
+    # Очередь готовых вариантов между рендером и отправкой
+    SEND_QUEUE_SIZE: int = 10
+    # Сколько секунд ждать следующее фото альбома, прежде чем начать задачу
+    ALBUM_LATENCY: float = 0.5
+
+    # Лимиты отправки в Telegram (сообщений в секунду)
+    SEND_GLOBAL_RATE: float = 30.0
+    SEND_CHAT_RATE: float = 2.0
+    SEND_CHAT_BURST: int = 20
+    SEND_MAX_RETRIES: int = 5
+
+    # Локальный HTTP /metrics и /health в режиме polling (порт 0 = выключено)
+    METRICS_HOST: str = os.getenv("METRICS_HOST", "127.0.0.1")
+    METRICS_PORT: int = int(os.getenv("METRICS_PORT", "9090"))
+
+    # Хранилище настроек и FSM: memory, sqlite или redis
+    STORAGE: str = os.getenv("STORAGE", "sqlite")
+    SQLITE_PATH: str = os.getenv("SQLITE_PATH", "bot.db")
+    REDIS_URL: str = os.getenv("REDIS_URL", "redis://localhost:6379/0")
+    # LRU-кэш горячих пользователей; TTL > 0, если хранилище общее
+    # у нескольких процессов без привязки чата к процессу
+    STORAGE_CACHE_SIZE: int = 10000
+    STORAGE_CACHE_TTL: float = float(os.getenv("STORAGE_CACHE_TTL", "0"))
+
+    # Webhook вместо polling; /metrics и /health тогда на том же сервере
+    USE_WEBHOOK: bool = os.getenv("USE_WEBHOOK", "0") == "1"
+    # Публичный адрес, на который Telegram шлёт апдейты (https://example.com)
+    WEBHOOK_URL: str = os.getenv("WEBHOOK_URL", "")
+    WEBHOOK_PATH: str = os.getenv("WEBHOOK_PATH", "/webhook")
+    # Пусто = случайный секрет на каждый запуск
+    WEBHOOK_SECRET: str = os.getenv("WEBHOOK_SECRET", "")
+    WEBHOOK_HOST: str = os.getenv("WEBHOOK_HOST", "0.0.0.0")
+    WEBHOOK_PORT: int = int(os.getenv("WEBHOOK_PORT", "8080"))
+    # Параллельных соединений от Telegram и апдейтов в обработке
+    WEBHOOK_MAX_CONNECTIONS: int = 40
+    MAX_PENDING_UPDATES: int = 100
 
 config = BotConfig()
 
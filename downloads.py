@@ -0,0 +1,103 @@
+# downloads.py
+
+import logging
+import os
+import time
+import uuid
+from contextlib import aclosing
+
+import aiofiles
+
+logger = logging.getLogger(__name__)
+
+
+class FileTooLarge(Exception):
+    """Файл больше MAX_FILE_SIZE"""
+
+    def __init__(self, max_size):
+        self.max_size = max_size
+        super().__init__(f"Файл больше {max_size // 1024 // 1024}MB")
+
+
+async def download_to_file(bot, file_path, destination, max_size, timeout=60, chunk_size=64 * 1024):
+    """
+    Скачивает файл Telegram на диск кусками по chunk_size - целиком
+    в памяти он не бывает. Обрывает загрузку, как только файл
+    превысил max_size. Возвращает размер в байтах
+    """
+    if bot.session.api.is_local:
+        # Локальный Bot API server: файл уже на диске, aiogram копирует его сам
+        await bot.download_file(file_path, destination, timeout=timeout, chunk_size=chunk_size)
+        size = os.path.getsize(destination)
+        if size > max_size:
+            raise FileTooLarge(max_size)
+        return size
+
+    url = bot.session.api.file_url(bot.token, file_path)
+    stream = bot.session.stream_content(url=url, timeout=timeout, chunk_size=chunk_size)
+    size = 0
+    async with aclosing(stream), aiofiles.open(destination, 'wb') as f:
+        async for chunk in stream:
+            size += len(chunk)
+            if size > max_size:
+                raise FileTooLarge(max_size)
+            await f.write(chunk)
+    return size
+
+
+async def download_to_temp(bot, file_id, temp_dir, max_size, suffix="", cache=None, key=None):
+    """
+    Скачивает файл по file_id во временный файл в temp_dir.
+    cache (DiskSourceCache) и key (file_unique_id) - сначала взять файл
+    из дискового кэша, скачанный - положить туда.
+    Возвращает (путь, размер); удалять - remove_temp_file.
+    При ошибке недокачанный файл удаляется сразу
+    """
+    path = os.path.join(temp_dir, f"{uuid.uuid4().hex}{suffix}")
+    use_cache = cache is not None and key is not None
+    if use_cache:
+        size = cache.fetch(key, path)
+        if size is not None:
+            return path, size
+
+    file = await bot.get_file(file_id)
+    if file.file_size and file.file_size > max_size:
+        raise FileTooLarge(max_size)
+
+    try:
+        size = await download_to_file(bot, file.file_path, path, max_size)
+    except BaseException:
+        remove_temp_file(path)
+        raise
+
+    if use_cache:
+        try:
+            cache.store(key, path)
+        except OSError as e:
+            logger.warning(f"Can't cache source {key}: {e}")
+    return path, size
+
+
+def remove_temp_file(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+    except OSError as e:
+        logger.warning(f"Can't remove temp file {path}: {e}")
+
+
+def cleanup_temp_dir(temp_dir, max_age=3600.0):
+    """Удаляет временные файлы, оставшиеся от упавших процессов"""
+    deadline = time.time() - max_age
+    removed = 0
+    for entry in os.scandir(temp_dir):
+        try:
+            if entry.is_file() and entry.stat().st_mtime < deadline:
+                os.remove(entry.path)
+                removed += 1
+        except OSError as e:
+            logger.warning(f"Can't remove temp file {entry.path}: {e}")
+    if removed:
+        logger.info(f"Removed {removed} stale temp files from {temp_dir}")
+    return removed
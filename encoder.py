@@ -0,0 +1,93 @@
+# encoder.py
+
+import logging
+from concurrent.futures import Future, ThreadPoolExecutor
+from io import BytesIO
+
+logger = logging.getLogger(__name__)
+
+# Форматы результата: имя -> (формат Pillow, расширение файла, опции save)
+FORMATS = {
+    'jpeg': ('JPEG', '.jpg', {}),
+    # Прогрессивный JPEG обычно на несколько процентов меньше обычного
+    'progressive': ('JPEG', '.jpg', {'progressive': True}),
+    # WebP заметно меньше JPEG того же качества, но кодируется во много раз дольше
+    'webp': ('WEBP', '.webp', {}),
+}
+
+# Ниже этого качества не опускаемся, подгоняя результат под размер
+MIN_QUALITY = 40
+
+
+def extension(output_format):
+    """Расширение файла для формата результата"""
+    return FORMATS[output_format][1]
+
+
+def _save(image, output_format, quality):
+    pil_format, _, options = FORMATS[output_format]
+    output = BytesIO()
+    image.save(output, format=pil_format, quality=quality, **options)
+    return output.getvalue()
+
+
+def encode(image, output_format='jpeg', quality=90, max_bytes=0):
+    """
+    Кодирует RGB-изображение в output_format с качеством quality.
+    max_bytes > 0 - если результат не влезает, бинарным поиском ищет
+    самое высокое качество ниже quality, при котором влезает;
+    не влезает и на MIN_QUALITY - возвращает результат на MIN_QUALITY
+    """
+    data = _save(image, output_format, quality)
+    if not max_bytes or len(data) <= max_bytes or quality <= MIN_QUALITY:
+        return data
+
+    # Размер растёт с качеством монотонно (почти) - ищем границу
+    low, high = MIN_QUALITY, quality - 1
+    best = None
+    while low <= high:
+        middle = (low + high) // 2
+        candidate = _save(image, output_format, middle)
+        if len(candidate) <= max_bytes:
+            best = candidate
+            low = middle + 1
+        else:
+            high = middle - 1
+
+    if best is None:
+        # Не влезло ни разу - последней проверялась как раз MIN_QUALITY
+        logger.debug(f"Can't fit {output_format} into {max_bytes} bytes")
+        best = candidate
+    return best
+
+
+class Encoder:
+    """
+    Стадия кодирования на пуле потоков: Pillow отпускает GIL в кодеке,
+    так что варианты кодируются параллельно друг с другом и с эффектами
+    следующих вариантов. threads = 0 - кодировать сразу в вызывающем потоке
+    """
+
+    def __init__(self, threads=0):
+        self.threads = threads
+        self._executor = None
+
+    def submit(self, func, *args):
+        """Запускает func(*args) в пуле, возвращает concurrent.futures.Future"""
+        if self.threads <= 0:
+            future = Future()
+            try:
+                future.set_result(func(*args))
+            except Exception as e:
+                future.set_exception(e)
+            return future
+
+        if self._executor is None:
+            # Пул создаётся лениво - уже внутри процесса-воркера, после fork
+            self._executor = ThreadPoolExecutor(self.threads, thread_name_prefix='encode')
+        return self._executor.submit(func, *args)
+
+    def shutdown(self):
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
@@ -0,0 +1,290 @@
+# job_queue.py
+
+import asyncio
+import itertools
+import json
+import logging
+import os
+import secrets
+import struct
+import time
+import uuid
+from collections import deque
+
+from aiohttp import web
+
+import metrics
+from encoder import FORMATS
+from render_engine import RenderEngine
+
+logger = logging.getLogger(__name__)
+
+REQUEUED = metrics.registry.counter(
+    "uniq_queue_requeued_total", "Пачки, возвращённые в очередь после истёкшей аренды"
+)
+
+# Длина JSON-заголовка в ответе воркера
+_HEADER = struct.Struct(">I")
+
+
+def encode_results(results, timings):
+    """
+    Упаковывает результаты пачки в одно тело запроса:
+    длина заголовка, JSON {sizes, timings}, затем результаты подряд
+    """
+    sizes = [len(result) if result is not None else -1 for result in results]
+    header = json.dumps({'sizes': sizes, 'timings': timings}).encode()
+    payload = b"".join(result for result in results if result is not None)
+    return _HEADER.pack(len(header)) + header + payload
+
+
+def decode_results(body):
+    """Обратное к encode_results: (results, timings)"""
+    (length,) = _HEADER.unpack_from(body)
+    header = json.loads(body[_HEADER.size:_HEADER.size + length])
+    offset = _HEADER.size + length
+
+    results = []
+    for size in header['sizes']:
+        if size < 0:
+            results.append(None)
+        else:
+            results.append(body[offset:offset + size])
+            offset += size
+    return results, [tuple(timing) for timing in header['timings']]
+
+
+class RenderTask:
+    """Пачка вариантов в очереди"""
+
+    def __init__(self, task_id, source_id, params_chunk, mode, future):
+        self.task_id = task_id
+        self.source_id = source_id
+        self.params_chunk = params_chunk
+        self.mode = mode
+        self.future = future
+        self.attempts = 0
+        self.leased_until = 0.0
+
+    def to_json(self):
+        return {
+            'task_id': self.task_id,
+            'source_id': self.source_id,
+            'params': self.params_chunk,
+            'mode': self.mode,
+        }
+
+
+class QueueRenderEngine:
+    """
+    Движок рендера с интерфейсом RenderEngine, но рендерят внешние
+    процессы worker.py (на этой или других машинах) через HTTP:
+    - исходник хранится один раз на задачу, воркер скачивает его по source_id;
+    - воркер арендует пачку на lease_timeout секунд и возвращает результаты;
+    - не вернул вовремя (упал, перезапустился) - пачка снова в очереди,
+      после max_attempts попыток варианты считаются упавшими
+    """
+
+    # Сколько держим long-poll запрос воркера без задач, сек
+    POLL_TIMEOUT = 20.0
+
+    def __init__(self, workers=1, chunk_size=5, token="", lease_timeout=60.0, max_attempts=3,
+                 max_side=0, upscale=False, output_format='jpeg', max_output_bytes=0):
+        # Ожидаемое число процессов рендера у всех воркеров - для лимитов и ETA
+        self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+        self.chunk_size = max(1, chunk_size)
+        # Рабочее разрешение и формат результатов передаются воркерам вместе с пачкой
+        if output_format not in FORMATS:
+            raise ValueError(f"Unknown output format: {output_format}")
+        self.max_side = max_side
+        self.upscale = upscale
+        self.output_format = output_format
+        self.max_output_bytes = max_output_bytes
+        self.token = token
+        self.lease_timeout = lease_timeout
+        self.max_attempts = max_attempts
+
+        self._sources = {}  # source_id -> bytes или путь к файлу
+        self._upscale = {}  # source_id -> upscale, если задан для исходника
+        self._tasks = {}  # task_id -> RenderTask (в очереди или в аренде)
+        self._pending = deque()
+        self._task_ids = itertools.count(1)
+        self._task_added = asyncio.Event()
+        self._workers_seen = {}  # worker_id -> время последнего запроса
+        self._reaper = None
+
+    @property
+    def active_workers(self):
+        """Воркеры, приходившие за задачами в последние lease_timeout секунд"""
+        deadline = time.monotonic() - self.lease_timeout
+        return sum(1 for seen in self._workers_seen.values() if seen > deadline)
+
+    @property
+    def pending(self):
+        return len(self._pending)
+
+    @property
+    def leased(self):
+        return len(self._tasks) - len(self._pending)
+
+    def start(self):
+        if not self.token:
+            raise RuntimeError("Очередь рендера без токена доступна кому угодно - задай RENDER_QUEUE_TOKEN")
+        if self._reaper is None:
+            self._reaper = asyncio.get_running_loop().create_task(self._reap_expired())
+            logger.info(f"Render queue started: expecting {self.workers} worker processes")
+
+    def shutdown(self):
+        if self._reaper is not None:
+            self._reaper.cancel()
+            self._reaper = None
+        for task in self._tasks.values():
+            if not task.future.done():
+                task.future.cancel()
+        self._tasks.clear()
+        self._pending.clear()
+        self._sources.clear()
+        self._upscale.clear()
+
+    # Та же нарезка на пачки, что и у локального пула
+    split = RenderEngine.split
+
+    def cached_source(self, key, upscale=None):
+        # Декодируют воркеры - у них свой кэш исходников, здесь держать нечего
+        return None
+
+    def open_source(self, image, mode='manual', upscale=None, key=None):
+        """
+        Регистрирует исходник задачи (байты или путь к файлу) для воркеров.
+        upscale по умолчанию - настройка очереди
+        """
+        source_id = uuid.uuid4().hex
+        self._sources[source_id] = image
+        if upscale is not None:
+            self._upscale[source_id] = upscale
+        return source_id
+
+    def close_source(self, source_id):
+        """Задача закончилась или отменена: исходник и её пачки больше не нужны"""
+        self._sources.pop(source_id, None)
+        self._upscale.pop(source_id, None)
+        for task in [t for t in self._tasks.values() if t.source_id == source_id]:
+            self._drop(task)
+            if not task.future.done():
+                task.future.cancel()
+
+    def submit(self, source_id, params_chunk, mode='manual'):
+        """Ставит пачку в очередь, возвращает asyncio.Future со списком результатов"""
+        future = asyncio.get_running_loop().create_future()
+        task = RenderTask(next(self._task_ids), source_id, list(params_chunk), mode, future)
+        self._tasks[task.task_id] = task
+        self._pending.append(task)
+        self._task_added.set()
+        return future
+
+    def _drop(self, task):
+        self._tasks.pop(task.task_id, None)
+        try:
+            self._pending.remove(task)
+        except ValueError:
+            pass
+
+    def _next_task(self):
+        while self._pending:
+            task = self._pending.popleft()
+            if task.future.done():
+                # Отменили, пока стояла в очереди
+                self._tasks.pop(task.task_id, None)
+                continue
+            task.attempts += 1
+            task.leased_until = time.monotonic() + self.lease_timeout
+            return task
+        return None
+
+    async def _reap_expired(self):
+        """Возвращает в очередь пачки, которые воркер не сдал вовремя"""
+        while True:
+            await asyncio.sleep(min(5.0, self.lease_timeout / 4))
+            now = time.monotonic()
+            pending = set(self._pending)
+            for task in list(self._tasks.values()):
+                if task in pending or task.leased_until > now:
+                    continue
+                if task.future.done():
+                    self._drop(task)
+                elif task.attempts >= self.max_attempts:
+                    logger.error(f"Render task {task.task_id} failed {task.attempts} times, giving up")
+                    self._drop(task)
+                    metrics.ERRORS.inc(stage='render', mode=task.mode)
+                    task.future.set_result([None] * len(task.params_chunk))
+                else:
+                    logger.warning(f"Render task {task.task_id} lease expired, requeueing")
+                    REQUEUED.inc()
+                    self._pending.appendleft(task)
+                    self._task_added.set()
+
+    # HTTP API для worker.py
+
+    def setup_routes(self, app, prefix="/render"):
+        app.router.add_post(f"{prefix}/lease", self._handle_lease)
+        app.router.add_get(f"{prefix}/sources/{{source_id}}", self._handle_source)
+        app.router.add_post(f"{prefix}/tasks/{{task_id}}/result", self._handle_result)
+
+    def _authorize(self, request):
+        expected = f"Bearer {self.token}"
+        if not secrets.compare_digest(request.headers.get("Authorization", ""), expected):
+            raise web.HTTPUnauthorized()
+        worker_id = request.headers.get("X-Worker-Id", request.remote)
+        self._workers_seen[worker_id] = time.monotonic()
+
+    async def _handle_lease(self, request):
+        """Long-poll: отдаёт пачку или 204, если задач не появилось"""
+        self._authorize(request)
+        deadline = time.monotonic() + self.POLL_TIMEOUT
+        while True:
+            task = self._next_task()
+            if task is not None:
+                return web.json_response({
+                    **task.to_json(), 'max_side': self.max_side,
+                    'upscale': self._upscale.get(task.source_id, self.upscale),
+                    'output_format': self.output_format, 'max_output_bytes': self.max_output_bytes
+                })
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                return web.Response(status=204)
+            self._task_added.clear()
+            try:
+                await asyncio.wait_for(self._task_added.wait(), remaining)
+            except asyncio.TimeoutError:
+                return web.Response(status=204)
+
+    async def _handle_source(self, request):
+        self._authorize(request)
+        image = self._sources.get(request.match_info["source_id"])
+        if image is None:
+            # Задача уже закончилась или отменена
+            raise web.HTTPNotFound()
+        if isinstance(image, (bytes, bytearray)):
+            return web.Response(body=image, content_type="application/octet-stream")
+        if not os.path.exists(image):
+            raise web.HTTPNotFound()
+        # Файл отдаётся с диска кусками, в память целиком не читается
+        return web.FileResponse(image, headers={"Content-Type": "application/octet-stream"})
+
+    async def _handle_result(self, request):
+        self._authorize(request)
+        task = self._tasks.get(int(request.match_info["task_id"]))
+        if task is None or task.future.done():
+            # Пачку уже сдал другой воркер или задачу отменили
+            raise web.HTTPGone()
+
+        body = await request.read()
+        if task.future.done():
+            # Задачу отменили, пока читали тело
+            raise web.HTTPGone()
+
+        results, timings = decode_results(body)
+        self._drop(task)
+        metrics.observe_render_chunk(results, timings, task.mode)
+        task.future.set_result(results)
+        return web.Response(status=204)
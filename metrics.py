@@ -0,0 +1,227 @@
+# metrics.py
+
+import bisect
+import logging
+import math
+import threading
+
+from aiohttp import web
+
+logger = logging.getLogger(__name__)
+
+# Границы бакетов гистограмм по умолчанию, сек
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0, 60.0)
+
+
+def _format_value(value):
+    if value == math.inf:
+        return "+Inf"
+    if float(value).is_integer():
+        return str(int(value))
+    return repr(float(value))
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('\n', '\\n').replace('"', '\\"')
+
+
+def _format_labels(names, values, extra=()):
+    pairs = list(zip(names, values)) + list(extra)
+    if not pairs:
+        return ""
+    return "{" + ",".join(f'{name}="{_escape(value)}"' for name, value in pairs) + "}"
+
+
+class Metric:
+    """Базовая метрика: значения по кортежам меток"""
+
+    type = None
+
+    def __init__(self, name, documentation, labelnames=(), func=None):
+        self.name = name
+        self.documentation = documentation
+        self.labelnames = tuple(labelnames)
+        # func - значение берётся в момент выгрузки (без меток)
+        self.func = func
+        self._values = {}
+        self._lock = threading.Lock()
+
+    def _key(self, labels):
+        if set(labels) != set(self.labelnames):
+            raise ValueError(f"{self.name}: ожидались метки {self.labelnames}, получены {tuple(labels)}")
+        return tuple(str(labels[name]) for name in self.labelnames)
+
+    def samples(self):
+        """(суффикс имени, значения меток, доп. метки, значение)"""
+        if self.func is not None:
+            yield "", (), (), self.func()
+            return
+        with self._lock:
+            items = list(self._values.items())
+        for key, value in items:
+            yield "", key, (), value
+
+    def render(self):
+        lines = [
+            f"# HELP {self.name} {self.documentation}",
+            f"# TYPE {self.name} {self.type}",
+        ]
+        for suffix, key, extra, value in self.samples():
+            labels = _format_labels(self.labelnames, key, extra)
+            lines.append(f"{self.name}{suffix}{labels} {_format_value(value)}")
+        return "\n".join(lines)
+
+
+class Counter(Metric):
+    """Монотонный счётчик"""
+
+    type = "counter"
+
+    def inc(self, amount=1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    """Текущее значение"""
+
+    type = "gauge"
+
+    def set(self, value, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = value
+
+
+class Histogram(Metric):
+    """Гистограмма с фиксированными бакетами"""
+
+    type = "histogram"
+
+    def __init__(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        super().__init__(name, documentation, labelnames)
+        self.buckets = tuple(sorted(buckets))
+
+    def observe(self, value, **labels):
+        key = self._key(labels)
+        index = bisect.bisect_left(self.buckets, value)
+        with self._lock:
+            state = self._values.get(key)
+            if state is None:
+                # [счётчики по бакетам (+Inf последним), сумма]
+                state = self._values[key] = [[0] * (len(self.buckets) + 1), 0.0]
+            state[0][index] += 1
+            state[1] += value
+
+    def samples(self):
+        with self._lock:
+            items = [(key, list(counts), total) for key, (counts, total) in self._values.items()]
+        for key, counts, total in items:
+            cumulative = 0
+            for bound, count in zip(self.buckets + (math.inf,), counts):
+                cumulative += count
+                yield "_bucket", key, (("le", _format_value(bound)),), cumulative
+            yield "_sum", key, (), total
+            yield "_count", key, (), cumulative
+
+
+class MetricsRegistry:
+    """Набор метрик и выгрузка в текстовом формате Prometheus"""
+
+    def __init__(self):
+        self._metrics = {}
+
+    def register(self, metric):
+        if metric.name in self._metrics:
+            raise ValueError(f"Метрика {metric.name} уже зарегистрирована")
+        self._metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name, documentation, labelnames=(), func=None):
+        return self.register(Counter(name, documentation, labelnames, func))
+
+    def gauge(self, name, documentation, labelnames=(), func=None):
+        return self.register(Gauge(name, documentation, labelnames, func))
+
+    def histogram(self, name, documentation, labelnames=(), buckets=DEFAULT_BUCKETS):
+        return self.register(Histogram(name, documentation, labelnames, buckets))
+
+    def render(self):
+        blocks = []
+        for metric in self._metrics.values():
+            try:
+                blocks.append(metric.render())
+            except Exception as e:
+                logger.error(f"Failed to render metric {metric.name}: {e}")
+        return "\n".join(blocks) + "\n"
+
+
+registry = MetricsRegistry()
+
+# Метрики бота. Стадии задачи: download, decode, encode, send;
+# эффекты PhotoUniqulizer: basic, background, noise, stripes, smiles, blur
+STAGE_SECONDS = registry.histogram(
+    "uniq_stage_seconds", "Время стадии обработки", ("stage", "mode")
+)
+EFFECT_SECONDS = registry.histogram(
+    "uniq_effect_seconds", "Время эффекта на один вариант", ("effect", "mode")
+)
+JOB_SECONDS = registry.histogram(
+    "uniq_job_seconds", "Время задачи от постановки в очередь до отправки",
+    ("mode",), buckets=(1, 2.5, 5, 10, 20, 30, 60, 120, 300, 600)
+)
+JOB_VARIANTS_PER_SECOND = registry.histogram(
+    "uniq_job_variants_per_second", "Скорость задачи, вариантов в секунду",
+    ("mode",), buckets=(0.1, 0.25, 0.5, 1, 2, 5, 10, 20, 50)
+)
+BYTES = registry.counter(
+    "uniq_bytes_total", "Байт скачано (in) и отрендерено (out)", ("direction", "mode")
+)
+VARIANTS = registry.counter(
+    "uniq_variants_total", "Отрендеренные варианты", ("mode", "status")
+)
+JOBS = registry.counter(
+    "uniq_jobs_total", "Завершённые задачи", ("mode", "status")
+)
+ERRORS = registry.counter(
+    "uniq_errors_total", "Ошибки по стадиям", ("stage", "mode")
+)
+SEND_WAIT_SECONDS = registry.histogram(
+    "uniq_send_wait_seconds", "Ожидание лимитов Telegram перед отправкой"
+)
+SEND_RETRIES = registry.counter(
+    "uniq_send_retries_total", "Повторы отправки"
+)
+SEND_FLOOD_WAITS = registry.counter(
+    "uniq_send_flood_waits_total", "Флуд-лимиты Telegram"
+)
+
+
+def observe_render_chunk(results, timings, mode):
+    """
+    Метрики готовой пачки: замеры из воркера ((kind, name, seconds), ...)
+    в гистограммы, результаты - в счётчики вариантов и байт
+    """
+    for kind, name, seconds in timings:
+        if kind == 'effect':
+            EFFECT_SECONDS.observe(seconds, effect=name, mode=mode)
+        else:
+            STAGE_SECONDS.observe(seconds, stage=name, mode=mode)
+
+    for result in results:
+        if result is None:
+            VARIANTS.inc(mode=mode, status='error')
+        else:
+            VARIANTS.inc(mode=mode, status='ok')
+            BYTES.inc(len(result), direction='out', mode=mode)
+
+
+async def metrics_handler(request):
+    return web.Response(text=registry.render(), content_type="text/plain", charset="utf-8")
+
+
+def setup_metrics_routes(app, path="/metrics"):
+    """Подключает /metrics к существующему aiohttp-приложению"""
+    app.router.add_get(path, metrics_handler)
+
@@ -0,0 +1,320 @@
+# render_engine.py
+
+import asyncio
+import logging
+import math
+import multiprocessing
+import os
+import time
+from concurrent.futures import ProcessPoolExecutor
+from multiprocessing import shared_memory
+
+import numpy as np
+
+import metrics
+from encoder import FORMATS
+from source_cache import SizedLRU
+from uniqualizer import PhotoUniqulizer, decode_source
+
+logger = logging.getLogger(__name__)
+
+# Экземпляр уникализатора внутри процесса-воркера
+_worker_uniqualizer = None
+
+# Воркеры стартуют через forkserver: fork прямо из бота, где уже крутятся
+# потоки (декодирование исходников, executor'ы), может унаследовать чужую
+# захваченную блокировку и зависнуть. Сервер заранее импортирует только
+# этот модуль (numpy, Pillow), без __main__ бота. Где forkserver нет
+# (Windows) - spawn: он тоже не наследует потоки родителя
+if 'forkserver' in multiprocessing.get_all_start_methods():
+    _mp_context = multiprocessing.get_context('forkserver')
+    _mp_context.set_forkserver_preload([__name__])
+else:
+    _mp_context = multiprocessing.get_context('spawn')
+
+
+def _init_worker(encode_threads=0, stack_bytes=0, tile_pixels=0, tile_bytes=0):
+    """Инициализация процесса-воркера"""
+    global _worker_uniqualizer
+    _worker_uniqualizer = PhotoUniqulizer(encode_threads, stack_bytes, tile_pixels, tile_bytes)
+    _worker_uniqualizer.warm_glyphs()
+
+
+def _render_chunk(shm_name, shape, params_chunk, output_size=None, output_format='jpeg', max_bytes=0):
+    """
+    Рендерит пачку вариантов внутри воркера из исходника в shared memory:
+    воркер только отображает блок в память, без копирования и декодирования.
+    output_size - размер, до которого растянуть результаты при кодировании,
+    output_format и max_bytes - формат и лимит размера результатов.
+    Результаты пачки возвращаются тоже через shared memory:
+    (имя блока или None, размеры, timings)
+    """
+    shm = shared_memory.SharedMemory(name=shm_name)
+    try:
+        base = np.ndarray(shape, dtype=np.uint8, buffer=shm.buf)
+        base.flags.writeable = False
+        # Воркер живёт долго - в ответ только замеры этой пачки
+        _worker_uniqualizer.timings = []
+        results = _worker_uniqualizer.render_batch(
+            base, params_chunk, output_size, output_format, max_bytes
+        )
+        # Пока на буфер есть ссылки, блок не закрыть
+        del base
+    finally:
+        shm.close()
+
+    sizes = [len(result) if result is not None else -1 for result in results]
+    total = sum(size for size in sizes if size > 0)
+    if not total:
+        return None, sizes, _worker_uniqualizer.timings
+
+    output = shared_memory.SharedMemory(create=True, size=total)
+    offset = 0
+    for result in results:
+        if result is not None:
+            output.buf[offset:offset + len(result)] = result
+            offset += len(result)
+    name = output.name
+    output.close()
+    return name, sizes, _worker_uniqualizer.timings
+
+
+def _read_output(name, sizes):
+    """Забирает результаты пачки из блока воркера и освобождает блок"""
+    if name is None:
+        return [None] * len(sizes)
+
+    output = shared_memory.SharedMemory(name=name)
+    try:
+        results = []
+        offset = 0
+        for size in sizes:
+            if size < 0:
+                results.append(None)
+            else:
+                results.append(bytes(output.buf[offset:offset + size]))
+                offset += size
+        return results
+    finally:
+        output.close()
+        output.unlink()
+
+
+def _discard_output(future):
+    """Пачку отменили, пока она рендерилась: блок с результатами никто не заберёт"""
+    if future.cancelled() or future.exception() is not None:
+        return
+    name = future.result()[0]
+    if name is not None:
+        try:
+            output = shared_memory.SharedMemory(name=name)
+        except FileNotFoundError:
+            return
+        output.close()
+        output.unlink()
+
+
+class SharedSource:
+    """
+    Декодированный исходник задачи в shared memory: декодируется один раз
+    в потоке родителя, воркеры отображают его read-only без pickle.
+    Счётчик ссылок - задача плюс каждая пачка в работе; блок освобождается,
+    когда задача закончилась или отменена и последняя пачка дорендерилась
+    """
+
+    def __init__(self, image, mode='manual', max_side=0, upscale=False):
+        self.refs = 1
+        self.shm = None
+        self.shape = None
+        # Исходный размер, если результаты растягиваются обратно при кодировании
+        self.output_size = None
+        self.ready = asyncio.ensure_future(
+            asyncio.to_thread(self._load, image, mode, max_side, upscale)
+        )
+
+    def _load(self, image, mode, max_side, upscale):
+        started = time.perf_counter()
+        array, original_size = decode_source(image, max_side)
+        metrics.STAGE_SECONDS.observe(time.perf_counter() - started, stage='decode', mode=mode)
+        if upscale and original_size != (array.shape[1], array.shape[0]):
+            self.output_size = original_size
+
+        shm = shared_memory.SharedMemory(create=True, size=max(1, array.nbytes))
+        np.ndarray(array.shape, dtype=np.uint8, buffer=shm.buf)[...] = array
+        self.shm = shm
+        self.shape = array.shape
+
+    def acquire(self):
+        self.refs += 1
+
+    def release(self):
+        self.refs -= 1
+        if self.refs == 0:
+            # Декодирование могло ещё не закончиться - освободим после него
+            self.ready.add_done_callback(self._free)
+
+    def _free(self, ready):
+        if not ready.cancelled():
+            # Ошибку декодирования уже получили пачки (или их не было)
+            ready.exception()
+        if self.refs > 0:
+            # Пока декодировали, исходник взял кэш
+            return
+        if self.shm is not None:
+            self.shm.close()
+            self.shm.unlink()
+            self.shm = None
+
+
+class RenderEngine:
+    """Пул процессов для уникализации, не блокирующий event loop"""
+
+    def __init__(self, workers=0, chunk_size=5, max_side=0, upscale=False, cache_bytes=0,
+                 output_format='jpeg', max_output_bytes=0, encode_threads=0, stack_bytes=0,
+                 tile_pixels=0, tile_bytes=0):
+        self.workers = workers if workers > 0 else (os.cpu_count() or 1)
+        self.chunk_size = max(1, chunk_size)
+        # Рабочее разрешение (длинная сторона, 0 - как есть) и растяжение обратно
+        self.max_side = max_side
+        self.upscale = upscale
+        # Формат результатов, лимит их размера (0 - без лимита),
+        # потоков кодирования и память под стек вариантов в каждом воркере
+        if output_format not in FORMATS:
+            raise ValueError(f"Unknown output format: {output_format}")
+        self.output_format = output_format
+        self.max_output_bytes = max_output_bytes
+        self.encode_threads = encode_threads
+        self.stack_bytes = stack_bytes
+        # Большие кадры (от tile_pixels) - полосами под бюджет tile_bytes
+        self.tile_pixels = tile_pixels
+        self.tile_bytes = tile_bytes
+        # Декодированные исходники между задачами: (ключ, max_side, upscale) -> SharedSource.
+        # Кэш держит свою ссылку, вытеснение её отпускает
+        self.cache = SizedLRU(cache_bytes, 'memory', on_evict=SharedSource.release)
+        self._executor = None
+
+    def start(self):
+        """Запускает пул воркеров"""
+        if self._executor is None:
+            self._executor = ProcessPoolExecutor(
+                max_workers=self.workers,
+                mp_context=_mp_context,
+                initializer=_init_worker,
+                initargs=(self.encode_threads, self.stack_bytes, self.tile_pixels, self.tile_bytes)
+            )
+            logger.info(f"Render engine started: {self.workers} workers")
+
+    def shutdown(self):
+        """Останавливает пул воркеров"""
+        self.cache.clear()
+        if self._executor is not None:
+            self._executor.shutdown(wait=True, cancel_futures=True)
+            self._executor = None
+
+    def split(self, params_list):
+        """
+        Делит варианты задачи на пачки: не больше chunk_size вариантов,
+        но так, чтобы пачек хватило на все воркеры
+        """
+        chunk_size = min(self.chunk_size, math.ceil(len(params_list) / self.workers))
+        return [
+            (start, params_list[start:start + chunk_size])
+            for start in range(0, len(params_list), chunk_size)
+        ]
+
+    def _cache_key(self, key, max_side=None, upscale=None):
+        return (
+            key,
+            self.max_side if max_side is None else max_side,
+            self.upscale if upscale is None else upscale
+        )
+
+    def cached_source(self, key, upscale=None):
+        """
+        Уже декодированный исходник из кэша (со своей ссылкой - передать
+        в open_source или закрыть close_source) или None.
+        upscale - как в open_source: растянутый и нет кэшируются отдельно
+        """
+        if not self.cache.max_bytes:
+            return None
+        source = self.cache.get(self._cache_key(key, upscale=upscale))
+        if source is not None:
+            source.acquire()
+        return source
+
+    def open_source(self, image, mode='manual', max_side=None, upscale=None, key=None):
+        """
+        Кладёт исходник задачи (байты или путь к файлу) в shared memory
+        (декодирование - в фоне; файл нужен только до его конца).
+        max_side/upscale по умолчанию - настройки движка.
+        key (file_unique_id) - запомнить декодированный исходник в кэше.
+        Исходник из cached_source возвращается как есть
+        """
+        if isinstance(image, SharedSource):
+            return image
+
+        source = SharedSource(
+            image, mode,
+            self.max_side if max_side is None else max_side,
+            self.upscale if upscale is None else upscale
+        )
+        if key is not None and self.cache.max_bytes:
+            cache_key = self._cache_key(key, max_side, upscale)
+            source.ready.add_done_callback(lambda ready: self._remember(cache_key, source, ready))
+        return source
+
+    def _remember(self, cache_key, source, ready):
+        if ready.cancelled() or ready.exception() is not None:
+            return
+        source.acquire()
+        self.cache.put(cache_key, source, source.shm.size)
+
+    def close_source(self, source):
+        """Исходник задачи больше не нужен (пачки в работе держат свои ссылки)"""
+        source.release()
+
+    def submit_raw(self, source, params_chunk, output_format=None, max_output_bytes=None):
+        """
+        Отправляет пачку в пул, возвращает asyncio.Future с (results, timings).
+        output_format/max_output_bytes по умолчанию - настройки движка
+        """
+        self.start()
+        return asyncio.ensure_future(self._run(
+            source, params_chunk,
+            self.output_format if output_format is None else output_format,
+            self.max_output_bytes if max_output_bytes is None else max_output_bytes
+        ))
+
+    async def _run(self, source, params_chunk, output_format, max_output_bytes):
+        await source.ready
+
+        # Пачка держит исходник, пока воркер его читает - даже если её отменят
+        source.acquire()
+        loop = asyncio.get_running_loop()
+        future = self._executor.submit(
+            _render_chunk, source.shm.name, source.shape, params_chunk, source.output_size,
+            output_format, max_output_bytes
+        )
+        future.add_done_callback(lambda _: loop.call_soon_threadsafe(source.release))
+
+        try:
+            name, sizes, timings = await asyncio.wrap_future(future)
+        except asyncio.CancelledError:
+            # Воркер мог уже начать - его блок с результатами освободим, когда допишет
+            future.add_done_callback(_discard_output)
+            raise
+        return _read_output(name, sizes), timings
+
+    def submit(self, source, params_chunk, mode='manual'):
+        """
+        Отправляет пачку вариантов в пул, возвращает asyncio.Future со списком результатов.
+        mode - метка режима (auto/manual) для метрик
+        """
+        return asyncio.ensure_future(self._collect(self.submit_raw(source, params_chunk), mode))
+
+    @staticmethod
+    async def _collect(future, mode):
+        """Дожидается пачки и переносит её замеры в метрики"""
+        results, timings = await future
+        metrics.observe_render_chunk(results, timings, mode)
+        return results
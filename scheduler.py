@@ -0,0 +1,349 @@
+# scheduler.py
+
+import asyncio
+import itertools
+import logging
+import time
+from collections import OrderedDict, deque
+
+import metrics
+import variants
+
+logger = logging.getLogger(__name__)
+
+
+class JobLimitExceeded(Exception):
+    """Пользователь упёрся в свои лимиты очереди или очередь переполнена"""
+
+
+class RenderJob:
+    """
+    Задача пользователя: набор вариантов одного исходника или альбома.
+    Для альбома из n фото вариант k фото s лежит под индексом k * n + s -
+    результаты идут готовыми альбомами. seed задачи вместе с индексом
+    задаёт все случайные величины варианта (variants.variant_id)
+    """
+
+    def __init__(self, scheduler, job_id, user_id, images, chunks, total, max_buffered,
+                 mode='manual', seed=0):
+        self.scheduler = scheduler
+        self.job_id = job_id
+        self.user_id = user_id
+        self.mode = mode
+        self.seed = seed
+        # Исходники для engine.open_source: (image, key, upscale)
+        self.images = images
+        # Исходники, зарегистрированные в движке рендера: открываются
+        # при запуске первой пачки, ждущая задача не держит shared memory
+        self.sources = None
+        # Пачки: (индексы результатов, номер исходника, параметры)
+        self.chunks = deque(chunks)
+        self.total = total
+        self.max_buffered = max_buffered
+        self.submitted_at = time.monotonic()
+
+        self.started = False
+        self.cancelled = False
+        self.in_flight = 0  # вариантов в рендере
+        self.done = 0  # вариантов отрендерено
+        self._results = {}
+        self._next_index = 0
+        self._changed = asyncio.Event()
+
+    @property
+    def remaining(self):
+        """Вариантов ещё не отрендерено"""
+        return self.total - self.done
+
+    @property
+    def remaining_variants(self):
+        """Версий ещё не отрендерено (версия альбома - одна на все его фото)"""
+        return -(-self.remaining // len(self.images))
+
+    @property
+    def buffered(self):
+        """Готовых вариантов, которые потребитель ещё не забрал"""
+        return len(self._results)
+
+    def can_dispatch(self):
+        """Есть пачки и буфер результатов не переполнен (backpressure)"""
+        return (
+            not self.cancelled
+            and bool(self.chunks)
+            and self.buffered + self.in_flight < self.max_buffered
+        )
+
+    def position(self):
+        """Позиция в очереди (0 - задача уже рендерится)"""
+        return self.scheduler.position(self)
+
+    def eta(self):
+        """Оценка секунд до окончания рендера задачи"""
+        return self.scheduler.eta(self)
+
+    def _store(self, indices, results):
+        for index, result in zip(indices, results):
+            self._results[index] = result
+        self._changed.set()
+
+    async def results(self):
+        """Async-генератор (index, bytes) в порядке вариантов"""
+        try:
+            while self._next_index < self.total:
+                while self._next_index not in self._results:
+                    if self.cancelled:
+                        return
+                    self._changed.clear()
+                    await self._changed.wait()
+
+                result = self._results.pop(self._next_index)
+                self._next_index += 1
+                # Освободили место в буфере - можно запускать следующие пачки
+                self.scheduler._dispatch()
+                yield self._next_index - 1, result
+        finally:
+            if self._next_index < self.total:
+                self.cancel()
+
+    async def wait_started(self):
+        """Ждёт, пока задача не начнёт рендериться"""
+        while not self.started and not self.cancelled:
+            self._changed.clear()
+            await self._changed.wait()
+
+    def cancel(self):
+        """Снимает задачу: новые пачки не запускаются, буфер очищается"""
+        if not self.cancelled and self._next_index < self.total:
+            self.cancelled = True
+            self.chunks.clear()
+            self._results.clear()
+            self.scheduler._remove(self)
+            self._changed.set()
+
+
+class JobScheduler:
+    """
+    Планировщик между хэндлерами и RenderEngine:
+    - глобальный лимит вариантов в рендере;
+    - round-robin между пользователями (по пачке за ход);
+    - лимиты пользователя на число задач и вариантов в очереди
+      (вариант альбома - один на все его фото);
+    - глобальный лимит задач, ждущих начала рендера
+    """
+
+    # Оценка времени рендера одного варианта до первых замеров, сек
+    DEFAULT_VARIANT_TIME = 1.0
+
+    def __init__(self, engine, max_inflight=0, max_jobs_per_user=2, max_queued_variants_per_user=100,
+                 max_waiting_jobs=0):
+        self.engine = engine
+        self.max_inflight = max_inflight or engine.workers * engine.chunk_size
+        self.max_jobs_per_user = max_jobs_per_user
+        self.max_queued_variants_per_user = max_queued_variants_per_user
+        # 0 = без ограничения
+        self.max_waiting_jobs = max_waiting_jobs
+
+        # user_id -> очередь задач; порядок ключей = порядок round-robin
+        self._users = OrderedDict()
+        self._inflight = 0
+        self._job_ids = itertools.count(1)
+        self._variant_time = self.DEFAULT_VARIANT_TIME
+
+    @property
+    def inflight(self):
+        """Вариантов сейчас в рендере"""
+        return self._inflight
+
+    @property
+    def queued(self):
+        """Вариантов в очереди (ещё не отрендерено)"""
+        return sum(job.remaining for jobs in self._users.values() for job in jobs)
+
+    @property
+    def waiting(self):
+        """Задач, ещё не начавших рендериться"""
+        return sum(1 for jobs in self._users.values() for job in jobs if not job.started)
+
+    def submit(self, user_id, images, params_list, mode='manual', keys=None, seed=None,
+               upscales=None):
+        """
+        Ставит задачу в очередь или кидает JobLimitExceeded.
+        images - исходник или список исходников альбома: байты, путь
+        к файлу (нужен до конца задачи) или исходник из engine.cached_source.
+        Каждый вариант params_list рендерится для всех исходников.
+        mode - режим (auto/manual), метка для метрик;
+        keys - ключи исходников для кэша движка (file_unique_id);
+        upscales - растягивать ли результат до размера исходника, по исходникам
+        (None - настройка движка);
+        seed - seed задачи (variants.new_job_seed, по умолчанию новый):
+        в параметры каждого варианта добавляется его ID
+        """
+        if not isinstance(images, (list, tuple)):
+            images = [images]
+        keys = keys or [None] * len(images)
+        upscales = upscales or [None] * len(images)
+        total = len(params_list) * len(images)
+        if total > variants.MAX_VARIANTS:
+            raise JobLimitExceeded(f"Не больше {variants.MAX_VARIANTS} фото в задаче")
+        if seed is None:
+            seed = variants.new_job_seed()
+
+        jobs = self._users.get(user_id, ())
+        if len(jobs) >= self.max_jobs_per_user:
+            raise JobLimitExceeded(f"Не больше {self.max_jobs_per_user} задач одновременно")
+
+        # Лимит - по версиям, а не по фото результата: альбом из n фото
+        # иначе упирался бы в лимит уже на max / n версиях
+        queued = sum(job.remaining_variants for job in jobs)
+        if queued + len(params_list) > self.max_queued_variants_per_user:
+            raise JobLimitExceeded(
+                f"Не больше {self.max_queued_variants_per_user} версий в очереди "
+                f"(версия альбома считается за одну): уже ждут {queued}, "
+                f"новая задача - ещё {len(params_list)}"
+            )
+
+        # Общий лимит на всех: ждущие задачи копят скачанные исходники
+        # (в polling их не сдерживает и лимит апдейтов webhook)
+        if self.max_waiting_jobs and self.waiting >= self.max_waiting_jobs:
+            raise JobLimitExceeded(f"Очередь рендера заполнена: ждут {self.waiting} задач")
+
+        # Пачки идут по кругу между исходниками - альбомы собираются по порядку
+        chunks = []
+        for start, params_chunk in self.engine.split(params_list):
+            for number in range(len(images)):
+                indices = [
+                    (start + offset) * len(images) + number
+                    for offset in range(len(params_chunk))
+                ]
+                chunks.append((indices, number, [
+                    dict(params, variant=variants.variant_id(seed, index))
+                    for params, index in zip(params_chunk, indices)
+                ]))
+
+        job = RenderJob(
+            self, next(self._job_ids), user_id, list(zip(images, keys, upscales)), chunks, total,
+            # Буфер вмещает целый круг пачек, иначе выдача по порядку встанет
+            max_buffered=2 * self.engine.chunk_size * len(images),
+            mode=mode, seed=seed
+        )
+        self._users.setdefault(user_id, deque()).append(job)
+        self._dispatch()
+        return job
+
+    def _remove(self, job):
+        jobs = self._users.get(job.user_id)
+        if jobs is None or job not in jobs:
+            return
+        jobs.remove(job)
+        if not jobs:
+            del self._users[job.user_id]
+        if job.sources is not None:
+            for source in job.sources:
+                self.engine.close_source(source)
+        else:
+            # Не начавшаяся задача: ссылки держат только исходники из кэша
+            for image, _, _ in job.images:
+                if not isinstance(image, (bytes, bytearray, str)):
+                    self.engine.close_source(image)
+
+    def _next_job(self):
+        """Следующая задача по round-robin между пользователями"""
+        for jobs in self._users.values():
+            for job in jobs:
+                if job.can_dispatch():
+                    return job
+        return None
+
+    def _dispatch(self):
+        """Запускает пачки, пока есть место в глобальном лимите"""
+        while True:
+            job = self._next_job()
+            if job is None:
+                return
+
+            indices, number, params_chunk = job.chunks[0]
+            size = len(params_chunk)
+            if self._inflight and self._inflight + size > self.max_inflight:
+                return
+
+            # Обслужили пользователя - он уходит в конец round-robin
+            job.chunks.popleft()
+            self._users.move_to_end(job.user_id)
+
+            self._inflight += size
+            job.in_flight += size
+            if not job.started:
+                job.sources = [
+                    self.engine.open_source(image, job.mode, upscale=upscale, key=key)
+                    for image, key, upscale in job.images
+                ]
+                job.started = True
+                job._changed.set()
+
+            started_at = time.monotonic()
+            future = self.engine.submit(job.sources[number], params_chunk, job.mode)
+            future.add_done_callback(
+                lambda f, job=job, indices=indices, started_at=started_at:
+                    self._on_chunk_done(job, indices, started_at, f)
+            )
+
+    def _on_chunk_done(self, job, indices, started_at, future):
+        size = len(indices)
+        self._inflight -= size
+        job.in_flight -= size
+        job.done += size
+
+        if future.cancelled():
+            results = [None] * size
+        elif future.exception() is not None:
+            logger.error(f"Render chunk failed: {future.exception()}")
+            metrics.ERRORS.inc(stage='render', mode=job.mode)
+            results = [None] * size
+        else:
+            results = future.result()
+            # Скользящее среднее времени одного варианта
+            per_variant = (time.monotonic() - started_at) / size
+            self._variant_time = 0.8 * self._variant_time + 0.2 * per_variant
+
+        if not job.cancelled:
+            job._store(indices, results)
+            if not job.chunks and not job.in_flight:
+                self._remove(job)
+
+        self._dispatch()
+
+    def position(self, job):
+        """
+        Позиция задачи в очереди: 0 - уже рендерится, иначе
+        1 + задачи, которые по round-robin пойдут раньше неё
+        """
+        if job.started or job.cancelled:
+            return 0
+
+        ahead = 0
+        for user_id, jobs in self._users.items():
+            if user_id == job.user_id:
+                ahead += list(jobs).index(job) if job in jobs else 0
+            elif any(other.chunks for other in jobs):
+                ahead += 1
+        return ahead + 1
+
+    def eta(self, job):
+        """
+        Секунды до окончания рендера задачи. При честном разделении
+        до её конца каждый пользователь успеет отрендерить не больше,
+        чем осталось этому пользователю вместе с его задачами впереди
+        """
+        own = 0
+        for other in self._users.get(job.user_id, ()):
+            own += other.remaining
+            if other is job:
+                break
+
+        work = own
+        for user_id, jobs in self._users.items():
+            if user_id != job.user_id:
+                work += min(own, sum(other.remaining for other in jobs))
+
+        throughput = self.engine.workers / self._variant_time
+        return work / throughput
@@ -0,0 +1,143 @@
+# sender.py
+
+import asyncio
+import logging
+import random
+import time
+
+from aiogram.exceptions import TelegramNetworkError, TelegramRetryAfter, TelegramServerError
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+
+class TokenBucket:
+    """
+    Token bucket с резервированием: токены можно уйти в минус,
+    тогда вызывающий ждёт, пока ведро не восполнится
+    """
+
+    def __init__(self, rate, capacity):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+        self.blocked_until = 0.0
+
+    def _refill(self, now):
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def reserve(self, cost, now):
+        """Резервирует cost токенов и возвращает, сколько секунд ждать"""
+        self._refill(now)
+        self.tokens -= cost
+        wait = -self.tokens / self.rate if self.tokens < 0 else 0.0
+        return max(wait, self.blocked_until - now)
+
+    def block(self, seconds, now):
+        """Блокирует ведро (Telegram попросил подождать) и сжигает запас"""
+        self._refill(now)
+        self.blocked_until = max(self.blocked_until, now + seconds)
+        self.tokens = min(self.tokens, 0)
+
+    def is_idle(self, now):
+        """Ведро полное и не заблокировано - его можно выкинуть"""
+        self._refill(now)
+        return self.tokens >= self.capacity and self.blocked_until <= now
+
+
+class TelegramSender:
+    """
+    Общий для всех хэндлеров отправитель: глобальный и per-chat token bucket,
+    уважение TelegramRetryAfter и повторы с backoff.
+    Скорость чата адаптивная: при флуд-лимите падает вдвое,
+    после успешных отправок понемногу растёт обратно
+    """
+
+    # Сколько бакетов чатов держим до чистки простаивающих
+    MAX_CHAT_BUCKETS = 10000
+
+    def __init__(self, global_rate=30.0, chat_rate=1.0, chat_burst=20, max_retries=5):
+        self.global_bucket = TokenBucket(global_rate, global_rate)
+        self.chat_rate = chat_rate
+        self.chat_burst = chat_burst
+        self.max_retries = max_retries
+        self._chat_buckets = {}
+
+        # Отправок, ждущих токенов (ожидания и повторы - в metrics)
+        self.queue_depth = 0
+
+    def _chat_bucket(self, chat_id, now):
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            if len(self._chat_buckets) >= self.MAX_CHAT_BUCKETS:
+                self._chat_buckets = {
+                    cid: b for cid, b in self._chat_buckets.items() if not b.is_idle(now)
+                }
+            bucket = TokenBucket(self.chat_rate, self.chat_burst)
+            self._chat_buckets[chat_id] = bucket
+        return bucket
+
+    @staticmethod
+    async def _wait(bucket, wait):
+        """Спит по резерву; если пока ждали, ведро заблокировали - ждёт и блокировку"""
+        while wait > 0:
+            await asyncio.sleep(wait)
+            wait = bucket.blocked_until - time.monotonic()
+
+    async def _acquire(self, chat_id, cost):
+        """Ждёт токены сначала в ведре чата, потом в глобальном"""
+        started = time.monotonic()
+        self.queue_depth += 1
+        try:
+            bucket = self._chat_bucket(chat_id, started)
+            await self._wait(bucket, bucket.reserve(cost, started))
+            await self._wait(self.global_bucket, self.global_bucket.reserve(cost, time.monotonic()))
+        finally:
+            self.queue_depth -= 1
+
+        waited = time.monotonic() - started
+        metrics.SEND_WAIT_SECONDS.observe(waited)
+        if waited > 5:
+            logger.info(
+                f"Send to chat {chat_id} waited {waited:.1f}s "
+                f"(queue depth {self.queue_depth})"
+            )
+
+    async def send(self, chat_id, method, *args, cost=1, **kwargs):
+        """
+        Вызывает корутину отправки (message.answer_photo и т.п.) с учётом лимитов.
+        cost - сколько сообщений это для Telegram (альбом из N фото = N)
+        """
+        attempt = 0
+        while True:
+            await self._acquire(chat_id, cost)
+            try:
+                result = await method(*args, **kwargs)
+            except TelegramRetryAfter as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                now = time.monotonic()
+                bucket = self._chat_bucket(chat_id, now)
+                bucket.block(e.retry_after, now)
+                bucket.rate = max(self.chat_rate / 8, bucket.rate / 2)
+                metrics.SEND_FLOOD_WAITS.inc()
+                logger.warning(
+                    f"Flood limit in chat {chat_id}: retry after {e.retry_after}s, "
+                    f"rate -> {bucket.rate:.2f}/s"
+                )
+            except (TelegramNetworkError, TelegramServerError) as e:
+                attempt += 1
+                if attempt > self.max_retries:
+                    raise
+                delay = min(30.0, 2 ** (attempt - 1)) * random.uniform(0.8, 1.2)
+                logger.warning(f"Send failed ({e}), retry {attempt} in {delay:.1f}s")
+                await asyncio.sleep(delay)
+            else:
+                bucket = self._chat_bucket(chat_id, time.monotonic())
+                bucket.rate = min(self.chat_rate, bucket.rate + self.chat_rate / 20)
+                return result
+            metrics.SEND_RETRIES.inc()
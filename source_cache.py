@@ -0,0 +1,162 @@
+# source_cache.py
+
+import logging
+import os
+import shutil
+import uuid
+from collections import OrderedDict
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+LOOKUPS = metrics.registry.counter(
+    "uniq_source_cache_lookups_total", "Обращения к кэшу исходников", ("tier", "result")
+)
+EVICTIONS = metrics.registry.counter(
+    "uniq_source_cache_evictions_total", "Вытесненные из кэша исходники", ("tier",)
+)
+CACHED_BYTES = metrics.registry.gauge(
+    "uniq_source_cache_bytes", "Занято кэшем исходников", ("tier",)
+)
+
+
+class SizedLRU:
+    """
+    LRU с бюджетом по суммарному размеру значений, а не по их числу.
+    Значение переходит во владение кэша: on_evict(value) вызывается,
+    когда его вытеснили, заменили или оно не влезло в бюджет.
+    tier - метка для метрик (memory/disk)
+    """
+
+    def __init__(self, max_bytes, tier, on_evict=None):
+        self.max_bytes = max_bytes
+        self.tier = tier
+        self.on_evict = on_evict
+        self._items = OrderedDict()  # key -> (value, size)
+        self.bytes = 0
+        self.hits = 0
+        self.misses = 0
+
+    def __len__(self):
+        return len(self._items)
+
+    def __contains__(self, key):
+        return key in self._items
+
+    def get(self, key):
+        item = self._items.get(key)
+        if item is None:
+            self.misses += 1
+            LOOKUPS.inc(tier=self.tier, result='miss')
+            return None
+        self._items.move_to_end(key)
+        self.hits += 1
+        LOOKUPS.inc(tier=self.tier, result='hit')
+        return item[0]
+
+    def put(self, key, value, size):
+        """Кладёт значение, вытесняя самые старые; False - больше всего бюджета"""
+        self.pop(key)
+        if size > self.max_bytes:
+            self._evict(value)
+            return False
+
+        self._items[key] = (value, size)
+        self.bytes += size
+        while self.bytes > self.max_bytes:
+            _, (old, old_size) = self._items.popitem(last=False)
+            self.bytes -= old_size
+            EVICTIONS.inc(tier=self.tier)
+            self._evict(old)
+        CACHED_BYTES.set(self.bytes, tier=self.tier)
+        return True
+
+    def pop(self, key):
+        """Убирает ключ из кэша (значение освобождается)"""
+        item = self._items.pop(key, None)
+        if item is not None:
+            self.bytes -= item[1]
+            CACHED_BYTES.set(self.bytes, tier=self.tier)
+            self._evict(item[0])
+
+    def clear(self):
+        for key in list(self._items):
+            self.pop(key)
+
+    def _evict(self, value):
+        if self.on_evict is not None:
+            try:
+                self.on_evict(value)
+            except Exception as e:
+                logger.warning(f"Source cache ({self.tier}) eviction failed: {e}")
+
+
+class DiskSourceCache:
+    """
+    Скачанные исходники в directory (под TEMP_DIR), LRU по размеру.
+    Задача получает свою жёсткую ссылку на файл кэша, так что вытеснение
+    не мешает идущим задачам, а удаление файла задачи не трогает кэш.
+    После рестарта файлы подхватываются в порядке mtime
+    """
+
+    def __init__(self, directory, max_bytes):
+        self.directory = directory
+        self.lru = SizedLRU(max_bytes, 'disk', on_evict=self._remove)
+        os.makedirs(directory, exist_ok=True)
+
+        entries = []
+        for entry in os.scandir(directory):
+            if entry.name.endswith(".part"):
+                # Недописанная копия от упавшего процесса
+                self._remove(entry.path)
+            elif entry.is_file():
+                stat = entry.stat()
+                entries.append((stat.st_mtime, entry.name, stat.st_size))
+        for _, name, size in sorted(entries):
+            self.lru.put(name, os.path.join(directory, name), size)
+
+    @staticmethod
+    def _remove(path):
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            pass
+
+    def _path(self, key):
+        # file_unique_id - base64url, безопасен как имя файла
+        return os.path.join(self.directory, key)
+
+    @staticmethod
+    def _link(source, destination):
+        try:
+            os.link(source, destination)
+        except OSError:
+            # Файловая система без жёстких ссылок
+            shutil.copyfile(source, destination)
+
+    def fetch(self, key, destination):
+        """Копия исходника из кэша в destination: размер или None, если нет в кэше"""
+        path = self.lru.get(key)
+        if path is None:
+            return None
+        try:
+            self._link(path, destination)
+        except FileNotFoundError:
+            # Файл удалили снаружи (например, чистка TEMP_DIR)
+            self.lru.pop(key)
+            return None
+        os.utime(path)
+        return os.path.getsize(destination)
+
+    def store(self, key, source):
+        """Кладёт скачанный файл в кэш (source остаётся у вызывающего)"""
+        size = os.path.getsize(source)
+        if key in self.lru or size > self.lru.max_bytes:
+            return
+        path = self._path(key)
+        # Через временное имя: файл в кэше появляется только целиком
+        partial = f"{path}.{uuid.uuid4().hex}.part"
+        self._link(source, partial)
+        os.replace(partial, path)
+        self.lru.put(key, path, size)
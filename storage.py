@@ -0,0 +1,401 @@
+# storage.py
+
+import asyncio
+import json
+import logging
+import sqlite3
+import time
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import unquote, urlsplit
+
+from aiogram.fsm.state import State
+from aiogram.fsm.storage.base import BaseStorage
+
+logger = logging.getLogger(__name__)
+
+
+class MemoryBackend:
+    """Key-value в памяти процесса (как раньше, без переживания рестарта)"""
+
+    def __init__(self):
+        self._data = {}
+
+    async def get(self, key):
+        return self._data.get(key)
+
+    async def set(self, key, value):
+        self._data[key] = value
+
+    async def delete(self, key):
+        self._data.pop(key, None)
+
+    async def close(self):
+        pass
+
+
+class SQLiteBackend:
+    """
+    Key-value в SQLite (WAL). Записи копятся в памяти и пишутся
+    одной транзакцией раз в flush_interval - set не ждёт диска.
+    Все запросы идут через один поток: соединение SQLite к нему привязано
+    """
+
+    def __init__(self, path, flush_interval=0.05):
+        self.path = path
+        self.flush_interval = flush_interval
+        self._executor = ThreadPoolExecutor(max_workers=1, thread_name_prefix="sqlite")
+        self._conn = None
+        # key -> JSON или None (удаление); _flushing - пачка, которая пишется сейчас
+        self._pending = {}
+        self._flushing = {}
+        self._flush_task = None
+        self._closed = False
+
+    def _connect(self):
+        if self._conn is None:
+            self._conn = sqlite3.connect(self.path, isolation_level=None, check_same_thread=False)
+            self._conn.execute("PRAGMA journal_mode=WAL")
+            self._conn.execute("PRAGMA synchronous=NORMAL")
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS kv (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+        return self._conn
+
+    async def _run(self, func, *args):
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(self._executor, func, *args)
+
+    def _select(self, key):
+        row = self._connect().execute("SELECT value FROM kv WHERE key = ?", (key,)).fetchone()
+        return row[0] if row else None
+
+    def _write(self, batch):
+        conn = self._connect()
+        upserts = [(key, value) for key, value in batch.items() if value is not None]
+        deletes = [(key,) for key, value in batch.items() if value is None]
+        conn.execute("BEGIN")
+        try:
+            conn.executemany(
+                "INSERT INTO kv (key, value) VALUES (?, ?) "
+                "ON CONFLICT(key) DO UPDATE SET value = excluded.value",
+                upserts
+            )
+            conn.executemany("DELETE FROM kv WHERE key = ?", deletes)
+        except Exception:
+            conn.execute("ROLLBACK")
+            raise
+        conn.execute("COMMIT")
+
+    async def get(self, key):
+        for batch in (self._pending, self._flushing):
+            if key in batch:
+                raw = batch[key]
+                break
+        else:
+            raw = await self._run(self._select, key)
+        return json.loads(raw) if raw is not None else None
+
+    async def set(self, key, value):
+        self._pending[key] = json.dumps(value, ensure_ascii=False)
+        self._schedule_flush()
+
+    async def delete(self, key):
+        self._pending[key] = None
+        self._schedule_flush()
+
+    def _schedule_flush(self):
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        try:
+            await self.flush()
+        except Exception as e:
+            # Пачка вернулась в _pending и уйдёт со следующей записью
+            logger.error(f"SQLite flush failed: {e}")
+
+    async def flush(self):
+        """Пишет накопленные изменения одной транзакцией"""
+        while self._pending:
+            # Параллельный flush дождётся, пока допишется текущая пачка
+            while self._flushing:
+                await asyncio.sleep(self.flush_interval)
+            if not self._pending:
+                return
+            batch = self._flushing = self._pending
+            self._pending = {}
+            try:
+                await self._run(self._write, batch)
+                batch = None
+            finally:
+                if batch is not None:
+                    # Не дописали (ошибка или отмена) - вернём пачку, новые записи важнее
+                    self._pending = {**batch, **self._pending}
+                self._flushing = {}
+
+    async def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        if self._flush_task is not None and not self._flush_task.done():
+            self._flush_task.cancel()
+        await self.flush()
+        if self._conn is not None:
+            await self._run(self._conn.close)
+        self._executor.shutdown(wait=True)
+
+
+class RedisError(Exception):
+    """Ошибка, которую вернул сервер Redis"""
+
+
+class RedisBackend:
+    """
+    Key-value поверх протокола Redis (RESP2) на голых asyncio-стримах.
+    Подходит любой сервер, говорящий на RESP: Redis, KeyDB, Dragonfly
+    или локальная заглушка. Одно соединение, команды по очереди
+    """
+
+    def __init__(self, url="redis://localhost:6379/0", prefix="uniq:", timeout=5.0):
+        parts = urlsplit(url)
+        self.host = parts.hostname or "localhost"
+        self.port = parts.port or 6379
+        self.password = unquote(parts.password) if parts.password else None
+        self.db = int(parts.path.lstrip("/") or 0)
+        self.prefix = prefix
+        self.timeout = timeout
+        self._reader = None
+        self._writer = None
+        self._lock = asyncio.Lock()
+
+    @staticmethod
+    def _encode(args):
+        chunks = [f"*{len(args)}\r\n".encode()]
+        for arg in args:
+            data = arg if isinstance(arg, bytes) else str(arg).encode()
+            chunks.append(f"${len(data)}\r\n".encode() + data + b"\r\n")
+        return b"".join(chunks)
+
+    async def _read_reply(self):
+        line = await self._reader.readline()
+        if not line:
+            raise ConnectionError("Redis closed connection")
+        kind, payload = line[:1], line[1:-2]
+        if kind == b"+":
+            return payload.decode()
+        if kind == b"-":
+            raise RedisError(payload.decode())
+        if kind == b":":
+            return int(payload)
+        if kind == b"$":
+            length = int(payload)
+            if length < 0:
+                return None
+            data = await self._reader.readexactly(length + 2)
+            return data[:-2]
+        if kind == b"*":
+            length = int(payload)
+            if length < 0:
+                return None
+            return [await self._read_reply() for _ in range(length)]
+        raise RedisError(f"Unexpected reply: {line!r}")
+
+    async def _connect(self):
+        self._reader, self._writer = await asyncio.wait_for(
+            asyncio.open_connection(self.host, self.port), self.timeout
+        )
+        try:
+            if self.password:
+                await self._call("AUTH", self.password)
+            if self.db:
+                await self._call("SELECT", self.db)
+        except BaseException:
+            # Не оставляем полуготовое (неавторизованное) соединение
+            await self._disconnect()
+            raise
+
+    async def _call(self, *args):
+        self._writer.write(self._encode(args))
+        await self._writer.drain()
+        return await asyncio.wait_for(self._read_reply(), self.timeout)
+
+    async def execute(self, *args):
+        """Выполняет команду; при обрыве соединения переподключается один раз"""
+        async with self._lock:
+            for attempt in range(2):
+                try:
+                    if self._writer is None:
+                        await self._connect()
+                    return await self._call(*args)
+                except (ConnectionError, asyncio.IncompleteReadError, asyncio.TimeoutError, OSError):
+                    await self._disconnect()
+                    if attempt:
+                        raise
+
+    async def _disconnect(self):
+        if self._writer is not None:
+            self._writer.close()
+            try:
+                await self._writer.wait_closed()
+            except Exception:
+                pass
+        self._reader = self._writer = None
+
+    async def get(self, key):
+        raw = await self.execute("GET", self.prefix + key)
+        return json.loads(raw) if raw is not None else None
+
+    async def set(self, key, value):
+        await self.execute("SET", self.prefix + key, json.dumps(value, ensure_ascii=False))
+
+    async def delete(self, key):
+        await self.execute("DEL", self.prefix + key)
+
+    async def close(self):
+        async with self._lock:
+            await self._disconnect()
+
+
+class CachedBackend:
+    """
+    LRU-кэш горячих ключей перед медленным backend: повторное чтение
+    не ходит на диск/в сеть. Кэшируются и отсутствующие ключи.
+    ttl > 0 - через сколько секунд перечитать ключ (когда backend
+    общий у нескольких процессов); 0 - кэшу верим всегда
+    """
+
+    # Отличает "в кэше None" от "нет в кэше"
+    _MISSING = object()
+
+    def __init__(self, backend, max_items=10000, ttl=0.0):
+        self.backend = backend
+        self.max_items = max_items
+        self.ttl = ttl
+        self._cache = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+
+    def _lookup(self, key):
+        entry = self._cache.get(key)
+        if entry is None:
+            return self._MISSING
+        value, stored_at = entry
+        if self.ttl and time.monotonic() - stored_at > self.ttl:
+            del self._cache[key]
+            return self._MISSING
+        self._cache.move_to_end(key)
+        return value
+
+    def _remember(self, key, value):
+        self._cache[key] = (value, time.monotonic())
+        self._cache.move_to_end(key)
+        while len(self._cache) > self.max_items:
+            self._cache.popitem(last=False)
+
+    async def get(self, key):
+        value = self._lookup(key)
+        if value is not self._MISSING:
+            self.hits += 1
+            return value
+        self.misses += 1
+        value = await self.backend.get(key)
+        self._remember(key, value)
+        return value
+
+    async def set(self, key, value):
+        self._remember(key, value)
+        await self.backend.set(key, value)
+
+    async def delete(self, key):
+        self._remember(key, None)
+        await self.backend.delete(key)
+
+    async def close(self):
+        await self.backend.close()
+
+
+def create_backend(kind, sqlite_path="bot.db", redis_url="redis://localhost:6379/0",
+                   cache_size=10000, cache_ttl=0.0):
+    """Backend по имени из конфига: memory, sqlite или redis"""
+    if kind == "memory":
+        return MemoryBackend()
+    if kind == "sqlite":
+        backend = SQLiteBackend(sqlite_path)
+    elif kind == "redis":
+        backend = RedisBackend(redis_url)
+    else:
+        raise ValueError(f"Неизвестное хранилище: {kind}")
+    return CachedBackend(backend, cache_size, cache_ttl)
+
+
+class UserSettingsStore:
+    """Настройки пользователей поверх key-value backend"""
+
+    def __init__(self, backend, defaults):
+        self.backend = backend
+        # Функция, возвращающая дефолтные настройки
+        self.defaults = defaults
+
+    @staticmethod
+    def _key(user_id):
+        return f"settings:{user_id}"
+
+    async def get(self, user_id):
+        """Настройки пользователя (копия; новые ключи берутся из дефолтов)"""
+        stored = await self.backend.get(self._key(user_id))
+        return {**self.defaults(), **(stored or {})}
+
+    async def save(self, user_id, params):
+        await self.backend.set(self._key(user_id), dict(params))
+
+    async def update(self, user_id, changes):
+        """Меняет часть настроек и возвращает их целиком"""
+        params = await self.get(user_id)
+        params.update(changes)
+        await self.save(user_id, params)
+        return params
+
+    async def reset(self, user_id):
+        params = self.defaults()
+        await self.save(user_id, params)
+        return params
+
+
+class KVStorage(BaseStorage):
+    """FSM-хранилище aiogram поверх того же key-value backend"""
+
+    def __init__(self, backend, prefix="fsm"):
+        self.backend = backend
+        self.prefix = prefix
+
+    def _key(self, key, part):
+        return ":".join(str(p) for p in (
+            self.prefix, key.bot_id, key.chat_id, key.user_id,
+            key.thread_id or "", key.destiny, part
+        ))
+
+    async def set_state(self, key, state=None):
+        state = state.state if isinstance(state, State) else state
+        if state is None:
+            await self.backend.delete(self._key(key, "state"))
+        else:
+            await self.backend.set(self._key(key, "state"), state)
+
+    async def get_state(self, key):
+        return await self.backend.get(self._key(key, "state"))
+
+    async def set_data(self, key, data):
+        if not data:
+            await self.backend.delete(self._key(key, "data"))
+        else:
+            await self.backend.set(self._key(key, "data"), dict(data))
+
+    async def get_data(self, key):
+        data = await self.backend.get(self._key(key, "data"))
+        return dict(data) if data else {}
+
+    async def close(self):
+        # Backend общий с настройками - закрывается в main
+        pass
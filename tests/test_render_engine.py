@@ -0,0 +1,32 @@
+import asyncio
+import io
+
+import benchmark
+from render_engine import RenderEngine
+
+
+def _jpeg(size=(320, 240)):
+    buffer = io.BytesIO()
+    benchmark.make_image(size).save(buffer, 'JPEG')
+    return buffer.getvalue()
+
+
+def test_chunk_timings_are_per_chunk():
+    """Воркер пула живёт долго: каждая пачка отдаёт только свои замеры"""
+    async def run():
+        engine = RenderEngine(1, chunk_size=4)
+        engine.start()
+        try:
+            source = engine.open_source(_jpeg())
+            counts = []
+            for count in (3, 5):
+                params = [dict(benchmark.MANUAL_PARAMS, variant=f'v{i}') for i in range(count)]
+                results, timings = await engine.submit_raw(source, params)
+                assert all(result is not None for result in results)
+                counts.append(sum(1 for kind, name, _ in timings if name == 'noise'))
+            engine.close_source(source)
+            return counts
+        finally:
+            engine.shutdown()
+
+    assert asyncio.run(run()) == [3, 5]
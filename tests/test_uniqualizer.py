@@ -0,0 +1,39 @@
+import random
+
+import numpy as np
+from PIL import ImageEnhance
+
+import benchmark
+from uniqualizer import LUMA, PhotoUniqulizer
+
+
+def _enhance_chain(image, brightness, contrast, color):
+    image = ImageEnhance.Brightness(image).enhance(brightness)
+    image = ImageEnhance.Contrast(image).enhance(contrast)
+    return ImageEnhance.Color(image).enhance(color)
+
+
+def test_adjust_colors_matches_enhance_chain():
+    """
+    Цветовая матрица повторяет цепочку ImageEnhance без сдвига яркости:
+    до 2 уровней на канал, больше 1 - не чаще 0.1% пикселей
+    """
+    uniqualizer = PhotoUniqulizer()
+    image = benchmark.make_image((1280, 720)).convert('RGB')
+    pixels = np.asarray(image).astype(float)
+    rng = random.Random(1)
+    for _ in range(8):
+        brightness, contrast, color = (rng.uniform(0.95, 1.05) for _ in range(3))
+        fused = np.asarray(uniqualizer.adjust_colors(image, brightness, contrast, color)).astype(int)
+        chain = np.asarray(_enhance_chain(image, brightness, contrast, color)).astype(int)
+
+        # Пиксели, которые цепочка обрезает на промежуточных стадиях, матрица не повторяет
+        brightened = pixels * brightness
+        mean = (brightened @ np.array(LUMA)).mean()
+        contrasted = mean + contrast * (brightened - mean)
+        unclipped = ((brightened < 255) & (contrasted >= 0) & (contrasted < 255)).all(axis=2)
+
+        diff = (fused - chain)[unclipped]
+        assert np.abs(diff).max() <= 2
+        assert (np.abs(diff) > 1).mean() < 0.001
+        assert abs(diff.mean()) < 0.1
@@ -1,13 +1,320 @@
 # uniqualizer.py
 
+import logging
+import math
 import random
 import os
-from PIL import Image, ImageDraw, ImageFont, ImageFilter, ImageEnhance
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from PIL import Image, ImageDraw, ImageFont, ImageFilter, ImageStat, ExifTags
 import numpy as np
 from io import BytesIO
 
+import encoder
+import variants
+
+logger = logging.getLogger(__name__)
+
+# Веса яркости ITU-R 601-2 (как в Image.convert('L'))
+LUMA = (0.299, 0.587, 0.114)
+
+# EXIF Orientation -> поворот к виду, в котором снимок показывают
+# (как в ImageOps.exif_transpose); 5-8 меняют местами ширину и высоту
+EXIF_TRANSPOSE = {
+    2: Image.Transpose.FLIP_LEFT_RIGHT,
+    3: Image.Transpose.ROTATE_180,
+    4: Image.Transpose.FLIP_TOP_BOTTOM,
+    5: Image.Transpose.TRANSPOSE,
+    6: Image.Transpose.ROTATE_270,
+    7: Image.Transpose.TRANSVERSE,
+    8: Image.Transpose.ROTATE_90,
+}
+
+# Дисперсия ядра ImageFilter.SMOOTH по одной оси (6 соседей на расстоянии 1, scale 13)
+SMOOTH_VARIANCE = 6 / 13
+
+# Шрифты для эмодзи в порядке приоритета: (путь, размер; None - случайный размер)
+EMOJI_FONTS = [
+    ("seguiemj.ttf", None),
+    ("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 30),
+    ("/System/Library/Fonts/Apple Color Emoji.ttc", 30),
+]
+
+# Блоков памяти в кэше Pillow: промежуточные картинки базовых модификаций
+# (поворот, цвет, резкость) и размытия берут память из кэша, а не у системы
+PIL_BLOCKS_MAX = 16
+
+def cache_size(level, default):
+    """Размер кэша данных процессора уровня level в байтах (sysfs Linux) или default"""
+    root = "/sys/devices/system/cpu/cpu0/cache"
+    try:
+        for entry in os.scandir(root):
+            if not entry.name.startswith("index"):
+                continue
+            with open(os.path.join(entry.path, "level")) as f:
+                if int(f.read()) != level:
+                    continue
+            with open(os.path.join(entry.path, "type")) as f:
+                if f.read().strip() == "Instruction":
+                    continue
+            with open(os.path.join(entry.path, "size")) as f:
+                size = f.read().strip()
+            units = {'K': 1 << 10, 'M': 1 << 20, 'G': 1 << 30}
+            if size[-1] in units:
+                return int(size[:-1]) * units[size[-1]]
+            return int(size)
+    except (OSError, ValueError):
+        pass
+    return default
+
+# Пикселей в куске при обработке буфера по частям: кусок кадра, случайные
+# байты шума и их сумма в int16 (16 байт на пиксель) занимают половину кэша L2
+SEGMENT_PIXELS = max(1 << 12, cache_size(2, 1 << 20) // 32)
+
+def segments(total):
+    """Куски кадра из total пикселей: (начало, конец) в байтах плоского буфера RGBA"""
+    for start in range(0, total, SEGMENT_PIXELS):
+        yield start * 4, min(start + SEGMENT_PIXELS, total) * 4
+
+def random_bytes(rng, count):
+    """
+    count случайных байт из генератора numpy: сырые 64-битные слова
+    без приведения к диапазону - в разы быстрее rng.integers для uint8
+    """
+    return rng.bit_generator.random_raw(-(-count // 8)).view(np.uint8)[:count]
+
+# Размытие с радиусом от 2 * BLUR_REDUCED_RADIUS считается на копии,
+# уменьшенной так, чтобы радиус на ней был не меньше BLUR_REDUCED_RADIUS
+BLUR_REDUCED_RADIUS = 2.5
+
+# Большой кадр (tile_pixels) обрабатывается полосами во всю ширину: одновременно
+# живёт до TILE_COPIES копий полосы вместе с запасом строк по краям
+TILE_COPIES = 4
+TILE_MIN_ROWS = 16
+
+# Шум по каналу - младшие NOISE_BITS бит случайного байта:
+# равномерно от -2 ** (NOISE_BITS - 1) до 2 ** (NOISE_BITS - 1) - 1
+NOISE_BITS = 6
+
+# Заливки фона (change_background)
+BACKGROUNDS = ('solid', 'gradient', 'noise')
+
+# Кэш шрифтов на процесс: (путь, размер) -> шрифт или None, если не загрузился
+_font_cache = {}
+
+def load_font(path, size):
+    """Загружает шрифт один раз на процесс (неудачные попытки тоже кэшируются)"""
+    key = (path, size)
+    if key not in _font_cache:
+        try:
+            _font_cache[key] = ImageFont.truetype(path, size)
+        except OSError:
+            _font_cache[key] = None
+    return _font_cache[key]
+
+def gaussian_blur(image, radius):
+    """
+    Гауссово размытие, radius - сигма (как у ImageFilter.GaussianBlur).
+    GaussianBlur в Pillow - три прохода box-blur, время от радиуса не зависит;
+    большие радиусы дешевле считать на уменьшенной копии: блоки factor x factor
+    усредняются (reduce), копия размывается и растягивается обратно билинейно.
+    factor выбран так, что радиус на копии >= BLUR_REDUCED_RADIUS: отклонение
+    от точного размытия даже на штрихах в 1 px - в среднем до 1 уровня из 255,
+    максимум до 4 (у самого края кадра больше: повторяется не крайний пиксель,
+    а среднее блока)
+    """
+    factor = int(radius / BLUR_REDUCED_RADIUS)
+    if factor < 2:
+        return image.filter(ImageFilter.GaussianBlur(radius))
+    
+    small = image.reduce(factor)
+    # Усреднение блоков и билинейное растяжение размывают сами:
+    # их дисперсии (f^2 - 1) / 12 и f^2 / 6 вычитаем из нужной
+    variance = radius ** 2 - (factor ** 2 - 1) / 12 - factor ** 2 / 6
+    small = small.filter(ImageFilter.GaussianBlur(math.sqrt(variance) / factor))
+    # Неполные блоки у края reduce усредняет как есть - растягиваем ровно
+    # ту часть копии, что соответствует кадру
+    box = (0, 0, image.width / factor, image.height / factor)
+    return small.resize(image.size, Image.Resampling.BILINEAR, box=box)
+
+def blur_halo(radius):
+    """
+    Запас строк над и под полосой, с которым gaussian_blur(radius) по полосам
+    даёт то же, что целиком, и кратность границ полос (уменьшение копии)
+    """
+    factor = int(radius / BLUR_REDUCED_RADIUS)
+    if factor < 2:
+        factor = 1
+    # Три прохода box-blur - до radius + 1 пикселя каждый (на копии - её пикселей),
+    # ещё по блоку на reduce и билинейное растяжение
+    halo = math.ceil(3 * radius) + 5 * factor
+    return -(-halo // factor) * factor, factor
+
+def working_size(size, max_side):
+    """Размер с длинной стороной не больше max_side (пропорции сохраняются)"""
+    width, height = size
+    if max_side <= 0 or max(width, height) <= max_side:
+        return width, height
+    scale = max_side / max(width, height)
+    return max(1, round(width * scale)), max(1, round(height * scale))
+
+def decode_source(image, max_side=0):
+    """
+    Декодирует исходник (байты или путь к файлу) в массив RGB или RGBA.
+    Файл читается лениво: Pillow декодирует прямо с диска, а несжатые
+    форматы отображает в память (mmap), не копируя файл целиком.
+    max_side > 0 ограничивает рабочее разрешение: JPEG сразу декодируется
+    в уменьшенном масштабе (draft - 1/2, 1/4 или 1/8 прямо в DCT),
+    остаток доводится ресэмплингом.
+    Снимок поворачивается по EXIF Orientation (результат кодируется
+    без EXIF - иначе вернулся бы повёрнутым).
+    Возвращает (массив, исходный размер с учётом поворота)
+    """
+    # Открываем изображение (пиксели ещё не декодированы)
+    if isinstance(image, (bytes, bytearray)):
+        image = BytesIO(image)
+    image = Image.open(image)
+    transpose = EXIF_TRANSPOSE.get(image.getexif().get(ExifTags.Base.Orientation))
+    original_size = image.size
+    target = working_size(original_size, max_side)
+    
+    if target != original_size:
+        # Масштаб draft выбирается так, чтобы не стать меньше target
+        image.draft(image.mode, target)
+    
+    # Конвертируем в RGB если нужно
+    if image.mode not in ('RGB', 'RGBA'):
+        image = image.convert('RGB')
+    
+    if image.size != target:
+        # Крупное уменьшение уже сделали draft или reduce - хватает узкого фильтра
+        image = image.resize(target, Image.Resampling.HAMMING, reducing_gap=3.0)
+    
+    # Поворачиваем уже уменьшенный кадр: draft работает только
+    # в ориентации файла, и её же держат target и original_size
+    if transpose is not None:
+        image = image.transpose(transpose)
+        if transpose in (Image.Transpose.TRANSPOSE, Image.Transpose.TRANSVERSE,
+                         Image.Transpose.ROTATE_90, Image.Transpose.ROTATE_270):
+            original_size = original_size[::-1]
+    
+    return np.asarray(image), original_size
+
+class GlyphAtlas:
+    """
+    Лениво заполняемый кэш отрендеренных эмодзи:
+    (шрифт, эмодзи) -> RGBA-плитка со смещением относительно точки вывода текста
+    """
+    
+    def __init__(self, max_tiles=4096):
+        self.max_tiles = max_tiles
+        self._tiles = OrderedDict()
+    
+    def get(self, font_key, font, emoji):
+        """Плитка (left, top, rgb (h, w, 3), alpha (h, w)) или None для пустого глифа"""
+        key = (font_key, emoji)
+        if key in self._tiles:
+            self._tiles.move_to_end(key)
+            return self._tiles[key]
+        
+        tile = self._render(font, emoji)
+        self._tiles[key] = tile
+        if len(self._tiles) > self.max_tiles:
+            self._tiles.popitem(last=False)
+        return tile
+    
+    def warm(self, font_key, font, emojis):
+        """Заранее рендерит набор эмодзи для шрифта"""
+        for emoji in emojis:
+            self.get(font_key, font, emoji)
+    
+    @staticmethod
+    def _render(font, emoji):
+        # Цветные глифы (COLR/CBDT/sbix) рендерим в цвете, остальные - белым
+        color = isinstance(font, ImageFont.FreeTypeFont)
+        probe = ImageDraw.Draw(Image.new('RGBA', (1, 1)))
+        left, top, right, bottom = probe.textbbox((0, 0), emoji, font=font, embedded_color=color)
+        if right <= left or bottom <= top:
+            return None
+        
+        tile = Image.new('RGBA', (right - left, bottom - top), (255, 255, 255, 0))
+        ImageDraw.Draw(tile).text(
+            (-left, -top), emoji, font=font,
+            fill=(255, 255, 255, 255), embedded_color=color
+        )
+        return left, top, np.asarray(tile.convert('RGB')), np.asarray(tile.getchannel('A'))
+
+class Canvas:
+    """
+    Рабочий буфер варианта - кадр CanvasStack: пиксели RGBA в массиве uint8
+    (H, W, 4) и Image поверх той же памяти - эффекты на numpy и Pillow меняют
+    одни и те же пиксели по месту, без переходов PIL <-> numpy. scratch - второй
+    такой же буфер (фон, сведение прозрачности)
+    """
+    
+    def __init__(self, stack, index):
+        self.stack = stack
+        self.index = index
+        self.width = self.height = 0
+        # Альфа везде 255 - прозрачность можно не учитывать
+        self.opaque = True
+        # Генераторы варианта (random.Random, np.random.Generator) - все
+        # случайные величины эффектов тянутся из них
+        self.rng, self.np_rng = variants.variant_rngs()
+    
+    def reset(self, opaque=True):
+        """Размечает кадр под текущий размер стека"""
+        stack = self.stack
+        self.width, self.height = stack.width, stack.height
+        self.opaque = opaque
+        self.array = stack.array[self.index]
+        self.scratch = stack.scratch[self.index]
+        self.image = self.wrap(self.array)
+        self.scratch_image = self.wrap(self.scratch)
+    
+    @staticmethod
+    def wrap(array, mode='RGBA'):
+        """Image поверх массива (H, W, 4) без копирования"""
+        height, width = array.shape[:2]
+        image = Image.frombuffer(mode, (width, height), array, 'raw', mode, 0, 1)
+        # frombuffer помечает картинку read-only, и Pillow скопировал бы её
+        # перед первым изменением; память наша и доступна на запись
+        image.readonly = 0
+        return image
+
+class CanvasStack:
+    """
+    Буферы пачки вариантов одного размера в одном блоке памяти:
+    array и scratch - (N, H, W, 4), pixels и scratch_pixels - они же
+    плоско (N, H * W * 4), кадры - Canvas поверх них. Память выделяется
+    на frames кадров по capacity пикселей и переиспользуется пачками
+    любого размера не больше неё
+    """
+    
+    def __init__(self, capacity, frames=1):
+        self.capacity = capacity
+        self.frames = frames
+        self._memory = np.empty((2, frames, capacity * 4), dtype=np.uint8)
+        self.canvases = [Canvas(self, index) for index in range(frames)]
+        self.width = self.height = self.count = 0
+        # Кадров, которые ещё не вернули (release_canvas)
+        self.pending = 0
+    
+    def reset(self, width, height, count=1):
+        """Размечает стек под count кадров width x height, возвращает кадры"""
+        self.width, self.height, self.count = width, height, count
+        size = width * height * 4
+        self.pixels = self._memory[0, :count, :size]
+        self.scratch_pixels = self._memory[1, :count, :size]
+        self.array = self.pixels.reshape(count, height, width, 4)
+        self.scratch = self.scratch_pixels.reshape(count, height, width, 4)
+        self.pending = count
+        return self.canvases[:count]
+
 class PhotoUniqulizer:
-    def __init__(self):
+    def __init__(self, encode_threads=0, stack_bytes=0, tile_pixels=0, tile_bytes=0):
         # Лица и смайлы
         self.smiles_faces = [
             '😀', '😃', '😄', '😁', '😆', '😅', '🤣', '😂', '🙂', '🙃',
@@ -189,214 +496,786 @@ class PhotoUniqulizer:
             self.flags
         )
         
-    def add_noise(self, image):
-        """Добавляет шум на изображение"""
-        img_array = np.array(image)
-        noise = np.random.randint(-30, 30, img_array.shape, dtype='int16')
-        noisy_img = np.clip(img_array + noise, 0, 255).astype('uint8')
-        return Image.fromarray(noisy_img)
+        # Кэш отрендеренных эмодзи
+        self.glyph_atlas = GlyphAtlas()
+        
+        # Маски кругов под эмодзи по размеру
+        self._ellipse_masks = {}
+        
+        # Замеры стадий последнего вызова uniqualize/uniqualize_batch:
+        # (kind, name, seconds); render_batch только дописывает
+        # в список - сбрасывает вызывающий
+        self.timings = []
+        
+        # Кодирование результатов в пуле потоков (0 - в этом же потоке)
+        self.encoder = encoder.Encoder(encode_threads)
+        
+        # Память под стек буферов пачки вариантов (0 - по одному варианту)
+        self.stack_bytes = stack_bytes
+        
+        # Кадры от tile_pixels пикселей обрабатываются полосами под бюджет
+        # tile_bytes на промежуточные копии (0 - всегда целиком)
+        self.tile_pixels = tile_pixels
+        self.tile_bytes = tile_bytes
+        
+        # Свободные стеки буферов: пачка держит свой, пока все её варианты не закодированы
+        self._stacks = []
+        self._canvas_lock = threading.Lock()
+        
+        if Image.core.get_blocks_max() < PIL_BLOCKS_MAX:
+            Image.core.set_blocks_max(PIL_BLOCKS_MAX)
+        
+    @contextmanager
+    def timed(self, kind, name, count=1):
+        """
+        Замеряет блок: kind = 'stage' (decode/encode) или 'effect';
+        count - на сколько вариантов делится время (эффект на весь стек)
+        """
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            seconds = (time.perf_counter() - start) / count
+            self.timings.extend([(kind, name, seconds)] * count)
+    
+    def stack_frames(self, width, height, count):
+        """Сколько из count вариантов width x height влезает в один стек (stack_bytes)"""
+        # Кадр - два буфера RGBA: пиксели и scratch
+        frame_bytes = width * height * 8
+        return max(1, min(count, self.stack_bytes // frame_bytes))
+    
+    def tiled(self, width, height):
+        """Кадр width x height обрабатывается полосами"""
+        return 0 < self.tile_pixels <= width * height
+    
+    def tile_strips(self, width, height, halo=0, align=1):
+        """
+        Полосы кадра width x height под бюджет tile_bytes: (top, bottom).
+        halo - запас строк над и под полосой, align - кратность границ
+        """
+        rows = self.tile_bytes // (width * 4 * TILE_COPIES) - 2 * halo
+        rows = max(rows, TILE_MIN_ROWS, halo)
+        rows = -(-rows // align) * align
+        for top in range(0, height, rows):
+            yield top, min(top + rows, height)
+    
+    def filter_tiled(self, canvas, apply, halo, align=1):
+        """
+        Фильтр apply(Image) -> Image (размытие, резкость) по полосам кадра, по месту.
+        Полоса фильтруется вместе с halo строк соседей прямо из буфера; её
+        результат пишется в кадр после следующей полосы - её запас ещё не тронут
+        """
+        width, height = canvas.width, canvas.height
+        pending = None
+        for top, bottom in self.tile_strips(width, height, halo, align):
+            start, end = max(top - halo, 0), min(bottom + halo, height)
+            filtered = apply(Canvas.wrap(canvas.array[start:end]))
+            if pending is not None:
+                canvas.image.paste(*pending)
+            pending = filtered.crop((0, top - start, width, bottom - start)), (0, top)
+        if pending is not None:
+            canvas.image.paste(*pending)
+    
+    def acquire_stack(self, width, height, count=1):
+        """Свободный стек буферов под count кадров width x height"""
+        pixels = width * height
+        with self._canvas_lock:
+            fitting = [
+                stack for stack in self._stacks
+                if stack.capacity >= pixels and stack.frames >= count
+            ]
+            stack = min(fitting, key=lambda stack: stack.capacity * stack.frames) if fitting else None
+            if stack is not None:
+                self._stacks.remove(stack)
+        if stack is None:
+            stack = CanvasStack(pixels, count)
+        stack.reset(width, height, count)
+        return stack
+    
+    def acquire_canvas(self, width, height, opaque=True):
+        """Свободный рабочий буфер под размер width x height"""
+        canvas = self.acquire_stack(width, height).canvases[0]
+        canvas.reset(opaque)
+        return canvas
+    
+    def release_canvas(self, canvas):
+        """
+        Возвращает кадр (после кодирования варианта); стек уходит
+        в пул, когда вернулись все его кадры
+        """
+        stack = canvas.stack
+        with self._canvas_lock:
+            stack.pending -= 1
+            if stack.pending > 0:
+                return
+            self._stacks.append(stack)
+            # Одновременно в работе не больше пачек, чем потоков кодирования + 1;
+            # оставляем самые большие стеки
+            self._stacks.sort(key=lambda stack: stack.capacity * stack.frames, reverse=True)
+            del self._stacks[self.encoder.threads + 1:]
+    
+    def load_canvas(self, image):
+        """Рабочий буфер с копией image (RGB или RGBA)"""
+        canvas = self.acquire_canvas(image.width, image.height, opaque=image.mode != 'RGBA')
+        canvas.image.paste(image)
+        return canvas
+    
+    def blend(self, canvas, left, top, source, alpha, mask=None, size=None):
+        """
+        Смешивает по месту source - цвет (r, g, b) или плитку (h, w, 3) -
+        с прямоугольником буфера от (left, top) с непрозрачностью alpha (0-255),
+        умноженной на mask (h, w), если она есть; size - размер прямоугольника
+        для цвета без маски. Выходящее за края обрезается, временные массивы -
+        размером с прямоугольник
+        """
+        height, width = mask.shape if mask is not None else source.shape[:2] if size is None else size[::-1]
+        x0, y0 = max(left, 0), max(top, 0)
+        x1, y1 = min(left + width, canvas.width), min(top + height, canvas.height)
+        if x0 >= x1 or y0 >= y1:
+            return
+        box = (slice(y0 - top, y1 - top), slice(x0 - left, x1 - left))
+        
+        if mask is None:
+            weight = alpha
+        else:
+            weight = (mask[box].astype(np.uint16) * alpha // 255)[..., None]
+        if isinstance(source, np.ndarray):
+            source = source[box].astype(np.uint16)
+        else:
+            source = np.array(source, dtype=np.uint16)
+        
+        region = canvas.array[y0:y1, x0:x1]
+        # (x * (255 - w) + s * w) / 255 с округлением; максимум 255 * 255 + 127 влезает в uint16
+        mixed = region[..., :3].astype(np.uint16)
+        mixed *= 255 - weight
+        mixed += source * weight
+        mixed += 127
+        mixed //= 255
+        region[..., :3] = mixed
+        
+        if not canvas.opaque:
+            # Нарисованное непрозрачно - альфа тоже смешивается с 255
+            covered = region[..., 3:].astype(np.uint16)
+            covered *= 255 - weight
+            covered += 255 * weight + 127
+            covered //= 255
+            region[..., 3:] = covered
     
-    def add_stripes(self, image):
+    def add_noise(self, canvas):
+        """Добавляет шум на изображение (по месту, с насыщением в uint8)"""
+        self.add_noise_stack(canvas.stack, [canvas])
+        return canvas
+    
+    def add_noise_stack(self, stack, canvases):
+        """
+        Шум на кадры canvases стека - из генератора кадра: у каждого варианта
+        свой, и по чужому его не вычесть. Шум генерируется кусками по кадру:
+        одна операция на кусок сразу всех кадров (N, кусок) медленнее -
+        рабочий набор вылезает из L2
+        """
+        total = stack.width * stack.height
+        center = 1 << (NOISE_BITS - 1)
+        mask = (1 << NOISE_BITS) - 1
+        buffer = np.empty(min(total, SEGMENT_PIXELS) * 4, dtype=np.int16)
+        for canvas in canvases:
+            pixels = stack.pixels[canvas.index]
+            for start, stop in segments(total):
+                chunk = pixels[start:stop]
+                noise = random_bytes(canvas.np_rng, stop - start)
+                noise &= mask
+                # Альфа не шумит
+                noise[3::4] = center
+                # Сумма в int16 и обратно с насыщением
+                summed = buffer[:stop - start]
+                np.add(chunk, noise, out=summed, dtype=np.int16)
+                summed -= center
+                np.clip(summed, 0, 255, out=summed)
+                chunk[:] = summed
+    
+    def add_stripes(self, canvas):
         """Добавляет случайные полосы"""
-        draw = ImageDraw.Draw(image, 'RGBA')
-        width, height = image.size
+        width, height = canvas.width, canvas.height
+        rng = canvas.rng
         
-        num_stripes = random.randint(3, 8)
+        num_stripes = rng.randint(3, 8)
         
         for _ in range(num_stripes):
-            if random.choice([True, False]):
+            if rng.choice([True, False]):
                 # Вертикальные
-                x = random.randint(0, width)
-                stripe_width = random.randint(1, 5)
-                color = (random.randint(0, 255), random.randint(0, 255), 
-                        random.randint(0, 255), random.randint(10, 50))
-                draw.rectangle([x, 0, x + stripe_width, height], fill=color)
+                x = rng.randint(0, width)
+                stripe_width = rng.randint(1, 5)
+                color = (rng.randint(0, 255), rng.randint(0, 255), 
+                        rng.randint(0, 255))
+                alpha = rng.randint(10, 50)
+                self.blend(canvas, x, 0, color, alpha, size=(stripe_width + 1, height))
             else:
                 # Горизонтальные
-                y = random.randint(0, height)
-                stripe_height = random.randint(1, 5)
-                color = (random.randint(0, 255), random.randint(0, 255), 
-                        random.randint(0, 255), random.randint(10, 50))
-                draw.rectangle([0, y, width, y + stripe_height], fill=color)
+                y = rng.randint(0, height)
+                stripe_height = rng.randint(1, 5)
+                color = (rng.randint(0, 255), rng.randint(0, 255), 
+                        rng.randint(0, 255))
+                alpha = rng.randint(10, 50)
+                self.blend(canvas, 0, y, color, alpha, size=(width, stripe_height + 1))
         
-        return image
+        return canvas
+    
+    def pick_emoji_font(self, font_size):
+        """Первый доступный шрифт из EMOJI_FONTS: (ключ кэша, шрифт)"""
+        for path, size in EMOJI_FONTS:
+            size = size or font_size
+            font = load_font(path, size)
+            if font is not None:
+                return (path, size), font
+        
+        if 'default' not in _font_cache:
+            _font_cache['default'] = ImageFont.load_default()
+        return 'default', _font_cache['default']
+    
+    def warm_glyphs(self):
+        """
+        Заранее рендерит все эмодзи в атлас (для процесса-воркера - первый
+        вариант не ждёт глифов). Шрифт со случайным размером на вариант
+        заполняет атлас лениво: все его размеры в атлас не влезут
+        """
+        for path, size in EMOJI_FONTS:
+            if size is None:
+                if load_font(path, 20) is not None:
+                    return
+                continue
+            font = load_font(path, size)
+            if font is not None:
+                self.glyph_atlas.warm((path, size), font, self.all_emojis)
+                return
+    
+    def ellipse_mask(self, size):
+        """Маска круга size x size (рисуется один раз на размер)"""
+        mask = self._ellipse_masks.get(size)
+        if mask is None:
+            image = Image.new('L', (size, size), 0)
+            ImageDraw.Draw(image).ellipse([0, 0, size - 1, size - 1], fill=255)
+            mask = self._ellipse_masks[size] = np.asarray(image)
+        return mask
     
-    def add_smiles(self, image):
+    def add_smiles(self, canvas):
         """Добавляет эмодзи на изображение"""
-        draw = ImageDraw.Draw(image, 'RGBA')
-        width, height = image.size
+        width, height = canvas.width, canvas.height
+        rng = canvas.rng
         
-        # Пытаемся загрузить шрифт
-        try:
-            font_size = random.randint(20, 50)
-            font = ImageFont.truetype("seguiemj.ttf", font_size)
-        except:
-            try:
-                font = ImageFont.truetype("/usr/share/fonts/truetype/dejavu/DejaVuSans.ttf", 30)
-            except:
-                try:
-                    font = ImageFont.truetype("/System/Library/Fonts/Apple Color Emoji.ttc", 30)
-                except:
-                    font = ImageFont.load_default()
+        # Шрифт берём из кэша процесса
+        font_size = rng.randint(20, 50)
+        font_key, font = self.pick_emoji_font(font_size)
         
         # Добавляем от 3 до 10 эмодзи
-        num_emojis = random.randint(3, 10)
+        num_emojis = rng.randint(3, 10)
         
         for _ in range(num_emojis):
-            emoji = random.choice(self.all_emojis)
-            x = random.randint(0, max(0, width - 60))
-            y = random.randint(0, max(0, height - 60))
+            emoji = rng.choice(self.all_emojis)
+            x = rng.randint(0, max(0, width - 60))
+            y = rng.randint(0, max(0, height - 60))
             
             # Опциональный фон под эмодзи
-            if random.choice([True, False]):
-                opacity = random.randint(100, 200)
-                bg_size = random.randint(40, 70)
-                draw.ellipse([x-5, y-5, x+bg_size, y+bg_size], 
-                           fill=(random.randint(0, 255), 
-                                random.randint(0, 255), 
-                                random.randint(0, 255), 
-                                random.randint(50, 100)))
+            if rng.choice([True, False]):
+                bg_size = rng.randint(40, 70)
+                color = (rng.randint(0, 255), 
+                         rng.randint(0, 255), 
+                         rng.randint(0, 255))
+                self.blend(
+                    canvas, x - 5, y - 5, color, rng.randint(50, 100),
+                    mask=self.ellipse_mask(bg_size + 6)
+                )
             
-            draw.text((x, y), emoji, font=font, fill=(255, 255, 255, random.randint(150, 255)))
+            text_alpha = rng.randint(150, 255)
+            
+            # Готовая плитка из атласа вместо раскладки текста
+            tile = self.glyph_atlas.get(font_key, font, emoji)
+            if tile is None:
+                continue
+            left, top, rgb, alpha = tile
+            self.blend(canvas, x + left, y + top, rgb, text_alpha, mask=alpha)
         
-        return image
+        return canvas
+    
+    def change_background(self, canvas, bg_type=None):
+        """Меняет/добавляет фоновый слой (bg_type по умолчанию - случайный)"""
+        self.add_backgrounds(canvas.stack, [canvas], [bg_type])
+        return canvas
     
-    def change_background(self, image):
-        """Меняет/добавляет фоновый слой"""
-        width, height = image.size
-        
-        # Разные варианты фона
-        bg_type = random.choice(['solid', 'gradient', 'noise'])
-        
-        if bg_type == 'solid':
-            # Однотонный фон
-            background = Image.new('RGB', (width, height), 
-                                  (random.randint(0, 255), 
-                                   random.randint(0, 255), 
-                                   random.randint(0, 255)))
-        elif bg_type == 'gradient':
-            # Градиентный фон
-            background = Image.new('RGB', (width, height))
-            draw = ImageDraw.Draw(background)
-            r1, g1, b1 = random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)
-            r2, g2, b2 = random.randint(0, 255), random.randint(0, 255), random.randint(0, 255)
+    def add_backgrounds(self, stack, canvases, bg_types=None):
+        """
+        Фоновый слой под кадры canvases стека, bg_types - тип фона на кадр
+        (None - случайный). Фон собирается в scratch: заливки одного типа -
+        одной операцией на все кадры, пиксель пишется целиком (uint32) вместе
+        с альфой - в разы быстрее записи трёх каналов из четырёх
+        """
+        bg_types = [
+            bg_type or canvas.rng.choice(BACKGROUNDS)
+            for canvas, bg_type in zip(canvases, bg_types or [None] * len(canvases))
+        ]
+        
+        # Делаем оригинальное изображение немного прозрачным
+        opacities = [canvas.rng.uniform(0.9, 0.98) for canvas in canvases]
+        # Альфа фона - маска смешивания: фон проступает на 1 - альфа исходника * opacity
+        alphas = np.array([255 - round(255 * opacity) for opacity in opacities], dtype=np.uint8)
+        
+        height, width = stack.height, stack.width
+        words = stack.scratch_pixels.view(np.uint32).reshape(stack.count, height, width)
+        
+        for bg_type in BACKGROUNDS:
+            chosen = [number for number, kind in enumerate(bg_types) if kind == bg_type]
+            if not chosen:
+                continue
+            frames = [canvases[number].index for number in chosen]
+            
+            if bg_type == 'solid':
+                # Однотонный фон: цвет на кадр растягивается на весь кадр
+                colors = np.empty((len(chosen), 1, 4), dtype=np.uint8)
+                colors[:, 0, :3] = [canvases[number].np_rng.integers(0, 256, 3) for number in chosen]
+                colors[:, 0, 3] = alphas[chosen]
+                words[frames] = colors.view(np.uint32)
+            elif bg_type == 'gradient':
+                # Градиентный фон: вертикальная линейная рампа, столбец растягивается на ширину
+                ends = np.array(
+                    [canvases[number].np_rng.integers(0, 256, (2, 3)) for number in chosen],
+                    dtype=np.float32
+                ).transpose(1, 0, 2)[:, :, None]
+                ramp = np.arange(height, dtype=np.float32)[:, None] / height
+                columns = np.empty((len(chosen), height, 4), dtype=np.uint8)
+                columns[..., :3] = ends[0] + (ends[1] - ends[0]) * ramp
+                columns[..., 3] = alphas[chosen, None]
+                words[frames] = columns.view(np.uint32)
+            else:
+                # Шумовой фон - из генератора кадра, кусками в кэше
+                total = width * height
+                for number, frame in zip(chosen, frames):
+                    pixels = stack.scratch_pixels[frame]
+                    for start, stop in segments(total):
+                        pixels[start:stop] = random_bytes(canvases[number].np_rng, stop - start)
+                    stack.scratch[frame, ..., 3] = alphas[number]
+        
+        for canvas, opacity in zip(canvases, opacities):
+            if not canvas.opaque:
+                lut = (255 - np.round(np.arange(256) * opacity)).astype(np.uint8)
+                np.take(lut, canvas.array[..., 3], out=canvas.scratch[..., 3], mode='clip')
             
-            for i in range(height):
-                r = int(r1 + (r2 - r1) * i / height)
-                g = int(g1 + (g2 - g1) * i / height)
-                b = int(b1 + (b2 - b1) * i / height)
-                draw.line([(0, i), (width, i)], fill=(r, g, b))
+            # Накладываем одним смешиванием по маске
+            canvas.image.paste(canvas.scratch_image, (0, 0), canvas.scratch_image)
+            canvas.array[..., 3] = 255
+            canvas.opaque = True
+    
+    def apply_blur(self, canvas, radius):
+        """Применяет размытие (большой кадр - полосами)"""
+        if radius <= 0:
+            return canvas
+        if self.tiled(canvas.width, canvas.height):
+            self.filter_tiled(canvas, lambda image: gaussian_blur(image, radius), *blur_halo(radius))
         else:
-            # Шумовой фон
-            background = Image.new('RGB', (width, height))
-            bg_array = np.random.randint(0, 255, (height, width, 3), dtype='uint8')
-            background = Image.fromarray(bg_array)
+            canvas.image.paste(gaussian_blur(canvas.image, radius))
+        return canvas
+    
+    def geometric_transform(self, image, angle, scale, crop_percent):
+        """
+        Поворот, масштаб и кроп одним аффинным преобразованием -
+        изображение пересэмплируется только один раз
+        """
+        return image.transform(
+            image.size,
+            Image.Transform.AFFINE,
+            self.transform_matrix(image.size, angle, scale, crop_percent),
+            resample=Image.Resampling.BILINEAR,
+            fillcolor=(255, 255, 255)
+        )
+    
+    def transform_matrix(self, size, angle, scale, crop_percent):
+        """Аффинная матрица geometric_transform для кадра size"""
+        width, height = size
+        cx, cy = width / 2, height / 2
         
-        # Делаем оригинальное изображение немного прозрачным
-        if image.mode != 'RGBA':
-            image = image.convert('RGBA')
+        # Шаг выборки < 1 = увеличение (кроп по краям + зум-джиттер)
+        step = (1 - 2 * crop_percent) * scale
         
-        # Изменяем прозрачность
-        alpha = image.split()[3]
-        alpha = ImageEnhance.Brightness(alpha).enhance(random.uniform(0.9, 0.98))
-        image.putalpha(alpha)
+        a = math.radians(angle)
+        cos_a, sin_a = math.cos(a), math.sin(a)
         
-        # Накладываем
-        background.paste(image, (0, 0), image)
+        # Обратное отображение выход -> вход относительно центра (как в Image.rotate)
+        return (
+            step * cos_a, -step * sin_a, cx - step * (cos_a * cx - sin_a * cy),
+            step * sin_a, step * cos_a, cy - step * (sin_a * cx + cos_a * cy)
+        )
+    
+    def transform_strip(self, base, matrix, width, top, bottom):
+        """
+        Строки top..bottom результата geometric_transform шириной width
+        из массива base: в Image переводится только кусок исходника под полосой
+        """
+        a, b, c, d, e, f = matrix
+        # Полоса берёт выборку из параллелограмма - рамка по его углам,
+        # с запасом в 2 пикселя на соседей билинейной выборки
+        xs = [a * x + b * y + c for x in (0, width) for y in (top, bottom)]
+        ys = [d * x + e * y + f for x in (0, width) for y in (top, bottom)]
+        source_height, source_width = base.shape[:2]
+        x0 = min(max(math.floor(min(xs)) - 2, 0), source_width - 1)
+        y0 = min(max(math.floor(min(ys)) - 2, 0), source_height - 1)
+        x1 = max(min(math.ceil(max(xs)) + 2, source_width), x0 + 1)
+        y1 = max(min(math.ceil(max(ys)) + 2, source_height), y0 + 1)
         
-        return background
+        # Та же матрица, сдвинутая к началу полосы и куска
+        matrix = (a, b, c + b * top - x0, d, e, f + e * top - y0)
+        return Image.fromarray(base[y0:y1, x0:x1]).transform(
+            (width, bottom - top),
+            Image.Transform.AFFINE,
+            matrix,
+            resample=Image.Resampling.BILINEAR,
+            fillcolor=(255, 255, 255)
+        )
     
-    def apply_blur(self, image, radius):
-        """Применяет размытие"""
-        if radius > 0:
-            return image.filter(ImageFilter.GaussianBlur(radius=radius))
-        return image
+    def adjust_colors(self, image, brightness, contrast, color):
+        """
+        Яркость, контраст и насыщенность одной цветовой матрицей
+        (эквивалент цепочки ImageEnhance.Brightness/Contrast/Color за один проход:
+        без сдвига яркости, до 1 уровня на канал, редкие пиксели - 2. Кроме
+        тех, что цепочка обрезает до 0..255 на промежуточных стадиях, -
+        матрица обрезает только результат)
+        """
+        return self.apply_color_matrix(image, self.color_matrix(image, brightness, contrast, color))
+    
+    def color_matrix(self, image, brightness, contrast, color):
+        """Цветовая матрица adjust_colors (контраст - относительно средней яркости image)"""
+        # Средняя яркость для контраста - по уменьшенной копии, её хватает
+        small = image.reduce(max(1, min(image.size) // 64))
+        channel_means = ImageStat.Stat(small).mean
+        mean = brightness * sum(w * m for w, m in zip(LUMA, channel_means[:3]))
+        
+        # x' = S * (c * b * x + (1 - c) * mean), S = s * I + (1 - s) * 1 * LUMA^T
+        gain = contrast * brightness
+        # Image.blend в цепочке ImageEnhance отбрасывает дробную часть (в среднем
+        # -0.5 на стадию, ошибка яркости дальше умножается на c), а convert
+        # с матрицей округляет - без поправки результат светлее на ~1.5 уровня
+        offset = (1 - contrast) * mean - 0.5 * (contrast + 2)
+        
+        matrix = []
+        for row in range(3):
+            for col in range(3):
+                weight = (1 - color) * LUMA[col] + (color if row == col else 0)
+                matrix.append(weight * gain)
+            # Сумма весов строки S равна 1, поэтому серое смещение проходит без изменений
+            matrix.append(offset)
+        return tuple(matrix)
     
-    def basic_modifications(self, image):
-        """Базовые модификации для уникализации"""
-        # Поворот на случайный угол
-        angle = random.uniform(-2, 2)
-        image = image.rotate(angle, expand=False, fillcolor=(255, 255, 255))
+    def apply_color_matrix(self, image, matrix):
+        """Цветовая матрица на RGB или RGBA (альфа не меняется)"""
+        if image.mode == 'RGBA':
+            alpha = image.getchannel('A')
+            image = image.convert('RGB').convert('RGB', matrix)
+            image.putalpha(alpha)
+            return image
         
-        # Изменение яркости
-        enhancer = ImageEnhance.Brightness(image)
-        image = enhancer.enhance(random.uniform(0.95, 1.05))
+        return image.convert('RGB', matrix)
+    
+    def sharpness_kernel(self, factor):
+        """Ядро 3x3, эквивалентное ImageEnhance.Sharpness(factor)"""
+        # blend(SMOOTH(x), x, factor) = factor * x + (1 - factor) * SMOOTH(x)
+        side = (1 - factor) / 13
+        center = factor + (1 - factor) * 5 / 13
+        return ImageFilter.Kernel((3, 3), [side] * 4 + [center] + [side] * 4, scale=1)
+    
+    def basic_modifications(self, image, blur_radius=0, rng=random):
+        """
+        Базовые модификации для уникализации, случайные величины - из rng
+        (random.Random варианта или модуль random).
+        Если передан blur_radius, размытие применяется сразу
+        и сворачивается с изменением резкости в одну операцию
+        """
+        angle, brightness, contrast, color, sharpness, resize_factor, crop_percent = (
+            self.random_modifications(rng)
+        )
         
-        # Изменение контраста
-        enhancer = ImageEnhance.Contrast(image)
-        image = enhancer.enhance(random.uniform(0.95, 1.05))
+        # Поворот, масштаб и случайный crop - за один ресэмплинг
+        image = self.geometric_transform(image, angle, resize_factor, crop_percent)
         
-        # Изменение насыщенности
-        enhancer = ImageEnhance.Color(image)
-        image = enhancer.enhance(random.uniform(0.95, 1.05))
+        # Яркость, контраст и насыщенность - за один проход
+        image = self.adjust_colors(image, brightness, contrast, color)
+        
+        if blur_radius > 0:
+            return gaussian_blur(image, self.fused_blur_radius(blur_radius, sharpness))
         
         # Изменение резкости
-        enhancer = ImageEnhance.Sharpness(image)
-        image = enhancer.enhance(random.uniform(0.9, 1.1))
-        
-        # Небольшой ресайз и обратно (артефакты сжатия)
-        original_size = image.size
-        resize_factor = random.uniform(0.95, 0.99)
-        temp_size = (int(original_size[0] * resize_factor), int(original_size[1] * resize_factor))
-        image = image.resize(temp_size, Image.Resampling.LANCZOS)
-        image = image.resize(original_size, Image.Resampling.LANCZOS)
-        
-        # Случайный crop и resize обратно
-        if random.choice([True, False]):
-            crop_percent = random.uniform(0.01, 0.03)
-            left = int(original_size[0] * crop_percent)
-            top = int(original_size[1] * crop_percent)
-            right = int(original_size[0] * (1 - crop_percent))
-            bottom = int(original_size[1] * (1 - crop_percent))
-            image = image.crop((left, top, right, bottom))
-            image = image.resize(original_size, Image.Resampling.LANCZOS)
+        return image.filter(self.sharpness_kernel(sharpness))
+    
+    def basic_modifications_tiled(self, canvas, base, blur_radius=0, rng=random):
+        """
+        basic_modifications для большого кадра: массив base обрабатывается
+        полосами (tile_strips) прямо в canvas, без копий кадра целиком.
+        Результат тот же, что у basic_modifications (с точностью до округления
+        в сдвинутой матрице поворота: отдельные пиксели на 1 уровень)
+        """
+        angle, brightness, contrast, color, sharpness, resize_factor, crop_percent = (
+            self.random_modifications(rng)
+        )
+        width, height = canvas.width, canvas.height
         
-        return image
+        matrix = self.transform_matrix((width, height), angle, resize_factor, crop_percent)
+        for top, bottom in self.tile_strips(width, height):
+            canvas.image.paste(self.transform_strip(base, matrix, width, top, bottom), (0, top))
+        
+        # Контраст считается от средней яркости всего кадра - цвет вторым проходом.
+        # Яркость - по RGBX: reduce на RGBA копирует кадр целиком ради альфы
+        # (у прозрачного кадра средняя тогда без учёта альфы)
+        matrix = self.color_matrix(Canvas.wrap(canvas.array, 'RGBX'), brightness, contrast, color)
+        for top, bottom in self.tile_strips(width, height):
+            # Альфа непрозрачного кадра и так 255 - не переносим её
+            strip = Canvas.wrap(canvas.array[top:bottom], 'RGBX' if canvas.opaque else 'RGBA')
+            if canvas.opaque:
+                strip = strip.convert('RGB')
+            canvas.image.paste(self.apply_color_matrix(strip, matrix), (0, top))
+        
+        if blur_radius > 0:
+            radius = self.fused_blur_radius(blur_radius, sharpness)
+            self.filter_tiled(canvas, lambda image: gaussian_blur(image, radius), *blur_halo(radius))
+        else:
+            kernel = self.sharpness_kernel(sharpness)
+            self.filter_tiled(canvas, lambda image: image.filter(kernel), 1)
+    
+    def random_modifications(self, rng):
+        """
+        Случайные величины базовых модификаций: (angle, brightness, contrast,
+        color, sharpness, resize_factor, crop_percent)
+        """
+        # Все случайные величины тянем в прежнем порядке
+        angle = rng.uniform(-2, 2)
+        brightness = rng.uniform(0.95, 1.05)
+        contrast = rng.uniform(0.95, 1.05)
+        color = rng.uniform(0.95, 1.05)
+        sharpness = rng.uniform(0.9, 1.1)
+        resize_factor = rng.uniform(0.95, 0.99)
+        crop_percent = 0
+        if rng.choice([True, False]):
+            crop_percent = rng.uniform(0.01, 0.03)
+        return angle, brightness, contrast, color, sharpness, resize_factor, crop_percent
+    
+    def fused_blur_radius(self, blur_radius, sharpness):
+        """Радиус одного размытия вместо изменения резкости и размытия blur_radius"""
+        # Резкость меняет дисперсию ядра на (1 - sharpness) * SMOOTH_VARIANCE,
+        # гауссово размытие - на radius^2: складываем их в одно размытие
+        variance = blur_radius ** 2 + (1 - sharpness) * SMOOTH_VARIANCE
+        return math.sqrt(max(variance, 0))
+    
+    def prepare_source(self, image_bytes, max_side=0):
+        """
+        Декодирует исходник один раз и возвращает его
+        как read-only массив, общий для всех вариантов,
+        и исходный размер изображения
+        """
+        with self.timed('stage', 'decode'):
+            base, original_size = decode_source(image_bytes, max_side)
+        base.flags.writeable = False
+        return base, original_size
+    
+    def render_variant(self, base, params, output_size=None, output_format='jpeg', max_bytes=0):
+        """
+        Рендерит один вариант из подготовленного исходника.
+        output_size - до какого размера растянуть результат при кодировании
+        (эффекты считаются в рабочем разрешении base);
+        output_format, max_bytes - формат и лимит размера результата (encoder.encode)
+        """
+        canvas = self.apply_effects(base, params)
+        return self.encode_variant(canvas, output_size, output_format, max_bytes)
     
-    def uniqualize(self, image_bytes, params):
+    def apply_effects(self, base, params):
         """
-        Главная функция уникализации
+        Применяет к исходнику эффекты варианта, возвращает Canvas
+        (после кодирования - обратно в пул через release_canvas).
         params = {
             'noise': bool,
             'stripes': bool,
             'smiles': bool,
             'background': bool,
-            'blur_radius': int (0-10)
+            'blur_radius': int (0-10),
+            'variant': str - ID варианта (variants.variant_id), необязательно
         }
         """
-        # Открываем изображение
-        image = Image.open(BytesIO(image_bytes))
-        
-        # Конвертируем в RGB если нужно
-        if image.mode not in ('RGB', 'RGBA'):
-            image = image.convert('RGB')
+        result, = self.apply_effects_batch(base, [params])
+        if isinstance(result, Exception):
+            raise result
+        return result
+    
+    def apply_effects_batch(self, base, params_list):
+        """
+        Применяет эффекты к пачке вариантов одного исходника в одном стеке
+        буферов: базовые модификации, полосы, смайлы и размытие - по кадру,
+        фон и шум - сразу по всем кадрам стека. Большой кадр (tile_pixels)
+        идёт полосами: базовые модификации пишут прямо в буфер кадра.
+        Генератор по вариантам: Canvas (после кодирования - release_canvas)
+        или исключение, на котором вариант упал
+        """
+        height, width = base.shape[:2]
+        stack = self.acquire_stack(width, height, len(params_list))
+        canvases = stack.canvases[:len(params_list)]
+        errors = {}
         
-        # Базовые модификации всегда применяем
-        image = self.basic_modifications(image)
+        # Исходник не трогаем: базовые модификации пишут в новые картинки
+        # (по полосам - кусками из самого массива, без копии целиком)
+        tiled = self.tiled(width, height)
+        source = None if tiled else Image.fromarray(base)
+        for canvas, params in zip(canvases, params_list):
+            # ID варианта (variants.variant_id) задаёт все его случайные величины:
+            # вариант с тем же ID повторяется байт в байт
+            canvas.rng, canvas.np_rng = variants.variant_rngs(params.get('variant'))
+            
+            # Если между базовыми модификациями и размытием нет других эффектов,
+            # размытие сворачивается с изменением резкости
+            has_overlays = any(
+                params.get(effect, False)
+                for effect in ('background', 'noise', 'stripes', 'smiles')
+            )
+            fused_blur = params.get('blur_radius', 0) if not has_overlays else 0
+            
+            try:
+                if tiled:
+                    canvas.reset(opaque=base.shape[2] != 4)
+                    with self.timed('effect', 'basic'):
+                        self.basic_modifications_tiled(canvas, base, fused_blur, canvas.rng)
+                    continue
+                
+                # Базовые модификации всегда применяем
+                with self.timed('effect', 'basic'):
+                    image = self.basic_modifications(source, fused_blur, canvas.rng)
+                # Дальше все эффекты меняют буфер кадра по месту
+                canvas.reset(opaque=image.mode != 'RGBA')
+                canvas.image.paste(image)
+                del image
+            except Exception as e:
+                errors[canvas.index] = e
         
-        # Применяем параметры в определенном порядке
-        if params.get('background', False):
-            image = self.change_background(image)
+        def chosen(effect):
+            return [
+                canvas for canvas, params in zip(canvases, params_list)
+                if canvas.index not in errors and params.get(effect, False)
+            ]
         
-        if params.get('noise', False):
-            image = self.add_noise(image)
+        # Применяем параметры в определенном порядке: фон и шум - на весь стек
+        for effect, apply in (('background', self.add_backgrounds), ('noise', self.add_noise_stack)):
+            selected = chosen(effect)
+            if not selected:
+                continue
+            try:
+                with self.timed('effect', effect, len(selected)):
+                    apply(stack, selected)
+            except Exception as e:
+                # Падает эффект стека - падают варианты, к которым он применялся
+                for canvas in selected:
+                    errors[canvas.index] = e
         
+        for canvas, params in zip(canvases, params_list):
+            error = errors.get(canvas.index)
+            if error is None:
+                try:
+                    self.apply_overlays(canvas, params)
+                except Exception as e:
+                    error = e
+            if error is not None:
+                self.release_canvas(canvas)
+                yield error
+            else:
+                yield canvas
+    
+    def apply_overlays(self, canvas, params):
+        """Эффекты варианта после фона и шума: полосы, смайлы, размытие"""
         if params.get('stripes', False):
-            image = self.add_stripes(image)
+            with self.timed('effect', 'stripes'):
+                self.add_stripes(canvas)
         
         if params.get('smiles', False):
-            image = self.add_smiles(image)
+            with self.timed('effect', 'smiles'):
+                self.add_smiles(canvas)
         
-        # Размытие применяем в конце
+        # Размытие применяем в конце (без других эффектов оно уже свёрнуто с резкостью)
         blur_radius = params.get('blur_radius', 0)
-        if blur_radius > 0:
-            image = self.apply_blur(image, blur_radius)
+        has_overlays = any(
+            params.get(effect, False)
+            for effect in ('background', 'noise', 'stripes', 'smiles')
+        )
+        if blur_radius > 0 and has_overlays:
+            with self.timed('effect', 'blur'):
+                self.apply_blur(canvas, blur_radius)
+    
+    def encode_variant(self, canvas, output_size=None, output_format='jpeg', max_bytes=0):
+        """
+        Кодирует результат варианта в bytes и возвращает буфер в пул
+        (безопасно звать из потоков пула)
+        """
+        try:
+            with self.timed('stage', 'encode'):
+                if not canvas.opaque:
+                    # В JPEG нет альфы - прозрачное кладём на белый, как поля после поворота
+                    canvas.scratch.fill(255)
+                    canvas.scratch_image.paste(canvas.image, (0, 0), canvas.image)
+                    pixels = canvas.scratch
+                else:
+                    pixels = canvas.array
+                # Четвёртый канал кодек пропускает - без конвертации в RGB
+                image = Canvas.wrap(pixels, 'RGBX')
+                
+                if output_size is not None and image.size != tuple(output_size):
+                    image = image.resize(tuple(output_size), Image.Resampling.BICUBIC)
+                
+                # Случайное качество для дополнительной уникализации
+                quality = canvas.rng.randint(85, 98)
+                return encoder.encode(image, output_format, quality, max_bytes)
+        finally:
+            self.release_canvas(canvas)
+    
+    def uniqualize(self, image_bytes, params, max_side=0, upscale=False, output_format='jpeg', max_bytes=0):
+        """Главная функция уникализации"""
+        self.timings = []
+        base, original_size = self.prepare_source(image_bytes, max_side)
+        return self.render_variant(
+            base, params, original_size if upscale else None, output_format, max_bytes
+        )
+    
+    def uniqualize_batch(self, image_bytes, params_list, max_side=0, upscale=False,
+                         output_format='jpeg', max_bytes=0):
+        """
+        Декодирует исходник один раз и рендерит из него
+        по варианту на каждый элемент params_list.
+        max_side - ограничение рабочего разрешения (0 - без ограничения),
+        upscale - вернуть результаты в исходном размере.
+        На месте упавших вариантов возвращает None
+        """
+        self.timings = []
+        base, original_size = self.prepare_source(image_bytes, max_side)
+        return self.render_batch(
+            base, params_list, original_size if upscale else None, output_format, max_bytes
+        )
+    
+    def render_batch(self, base, params_list, output_size=None, output_format='jpeg', max_bytes=0):
+        """
+        Рендерит пачку вариантов из уже декодированного исходника
+        (например, из shared memory). На месте упавших вариантов - None.
+        Варианты идут стеками по stack_frames (память stack_bytes):
+        фон и шум считаются сразу на весь стек. Эффекты идут в этом потоке,
+        кодирование - в пуле encoder: пока кодируется вариант, уже считаются
+        эффекты следующего
+        """
+        height, width = base.shape[:2]
+        frames = self.stack_frames(width, height, len(params_list))
         
-        # Конвертируем обратно в bytes
-        output = BytesIO()
-        # Случайное качество JPEG для дополнительной уникализации
-        quality = random.randint(85, 98)
-        image.save(output, format='JPEG', quality=quality)
-        output.seek(0)
+        pending = []
+        for start in range(0, len(params_list), frames):
+            for result in self.apply_effects_batch(base, params_list[start:start + frames]):
+                if isinstance(result, Exception):
+                    logger.error(f"Error rendering variant: {result}")
+                    pending.append(None)
+                    continue
+                pending.append(self.encoder.submit(
+                    self.encode_variant, result, output_size, output_format, max_bytes
+                ))
+        
+        results = []
+        for future in pending:
+            try:
+                results.append(future.result() if future is not None else None)
+            except Exception as e:
+                logger.error(f"Error encoding variant: {e}")
+                results.append(None)
         
-        return output.getvalue()
+        return results
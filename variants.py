@@ -0,0 +1,62 @@
+# variants.py
+
+import random
+import secrets
+
+import numpy as np
+
+# ID варианта - seed задачи и индекс варианта в ней, одним числом в base36:
+# seed занимает старшие биты, индекс (вариант альбома k * n + s) - младшие
+JOB_SEED_BITS = 48
+VARIANT_INDEX_BITS = 12
+MAX_VARIANTS = 1 << VARIANT_INDEX_BITS
+
+# Назначение потока случайных чисел варианта: у параметров авто-режима
+# и у рендера потоки разные, но оба выводятся из seed задачи
+RENDER = 0
+PARAMS = 1
+
+_DIGITS = "0123456789abcdefghijklmnopqrstuvwxyz"
+
+
+def new_job_seed():
+    """Случайный seed задачи"""
+    return secrets.randbits(JOB_SEED_BITS)
+
+
+def variant_id(seed, index):
+    """Компактный ID варианта index задачи с seed (до 13 символов base36)"""
+    if not 0 <= index < MAX_VARIANTS:
+        raise ValueError(f"Variant index out of range: {index}")
+    number = (seed << VARIANT_INDEX_BITS) | index
+    digits = []
+    while True:
+        number, digit = divmod(number, 36)
+        digits.append(_DIGITS[digit])
+        if not number:
+            return "".join(reversed(digits))
+
+
+def parse_variant_id(variant):
+    """Обратное к variant_id: (seed, index)"""
+    number = int(variant, 36)
+    return number >> VARIANT_INDEX_BITS, number & (MAX_VARIANTS - 1)
+
+
+def variant_rngs(variant=None, stream=RENDER):
+    """
+    Генераторы варианта: (random.Random, np.random.Generator).
+    Из одного ID всегда выходят одни и те же последовательности, на любом
+    воркере; у разных вариантов и назначений они независимы (SeedSequence
+    с ключом (индекс, назначение)). variant=None - случайные генераторы
+    """
+    if variant is None:
+        return random.Random(), np.random.default_rng()
+
+    seed, index = parse_variant_id(variant)
+    python_state = np.random.SeedSequence(seed, spawn_key=(index, stream, 0)).generate_state(4)
+    numpy_sequence = np.random.SeedSequence(seed, spawn_key=(index, stream, 1))
+    return (
+        random.Random(int.from_bytes(python_state.tobytes(), 'little')),
+        np.random.default_rng(numpy_sequence)
+    )
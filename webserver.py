@@ -0,0 +1,97 @@
+# webserver.py
+
+import logging
+
+from aiogram import BaseMiddleware
+from aiogram.webhook.aiohttp_server import SimpleRequestHandler, setup_application
+from aiohttp import web
+
+import metrics
+
+logger = logging.getLogger(__name__)
+
+WEBHOOK_REJECTED = metrics.registry.counter(
+    "uniq_webhook_rejected_total", "Апдейты, отбитые из-за перегрузки (Telegram повторит)"
+)
+
+
+class UpdateLimiter(BaseMiddleware):
+    """
+    Outer-middleware диспетчера: считает апдейты, ещё не принятые в работу.
+    По счётчику webhook решает, принимать ли новые. Долгий хэндлер (задача
+    рендера - это минуты) освобождает место, как только его задача начала
+    рендериться: зовёт admitted() из данных хэндлера. Иначе идущие задачи
+    забили бы лимит, и 503 получали бы даже кнопки и команды
+    """
+
+    def __init__(self, max_pending=100):
+        self.max_pending = max_pending
+        self.pending = 0
+
+    @property
+    def saturated(self):
+        return self.pending >= self.max_pending
+
+    async def __call__(self, handler, event, data):
+        self.pending += 1
+        released = False
+
+        def admitted():
+            nonlocal released
+            if not released:
+                released = True
+                self.pending -= 1
+
+        data['admitted'] = admitted
+        try:
+            return await handler(event, data)
+        finally:
+            admitted()
+
+
+def backpressure_middleware(limiter, path):
+    """
+    Пока max_pending апдейтов не приняты в работу, webhook отвечает 503:
+    Telegram держит апдейт у себя и повторит доставку позже,
+    вместо того чтобы копить рендеры в памяти процесса
+    """
+    @web.middleware
+    async def middleware(request, handler):
+        if request.path == path and limiter.saturated:
+            WEBHOOK_REJECTED.inc()
+            return web.Response(status=503, headers={"Retry-After": "1"})
+        return await handler(request)
+
+    return middleware
+
+
+def create_web_app(health_handler=None, client_max_size=1024 ** 2):
+    """
+    aiohttp-приложение со служебными маршрутами /metrics и /health.
+    client_max_size - предел тела запроса (пачки JPEG от воркеров)
+    """
+    app = web.Application(client_max_size=client_max_size)
+    metrics.setup_metrics_routes(app)
+    if health_handler is not None:
+        app.router.add_get("/health", health_handler)
+    return app
+
+
+def setup_webhook(app, dp, bot, path, secret, limiter):
+    """Вешает на приложение приём апдейтов Telegram с backpressure"""
+    app.middlewares.append(backpressure_middleware(limiter, path))
+    # Обработка в фоне: Telegram получает 200 сразу, а не через минуту рендера
+    SimpleRequestHandler(
+        dispatcher=dp, bot=bot, secret_token=secret, handle_in_background=True
+    ).register(app, path=path)
+    # startup/shutdown диспетчера вместе с приложением
+    setup_application(app, dp, bot=bot)
+
+
+async def start_web_server(app, host, port):
+    """Запускает приложение, возвращает runner для остановки"""
+    runner = web.AppRunner(app, access_log=None)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"HTTP server listening on {host}:{port}")
+    return runner
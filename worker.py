@@ -0,0 +1,225 @@
+# worker.py
+"""
+Внешний воркер рендера для RENDER_BACKEND=queue.
+
+Забирает пачки вариантов у бота, рендерит их своим пулом процессов
+и отправляет результаты обратно. Воркеров можно запускать сколько угодно,
+на любых машинах, и перезапускать в любой момент: несданные пачки
+бот сам вернёт в очередь.
+
+Запуск:
+    RENDER_QUEUE_TOKEN=secret python worker.py --url http://bot-host:9090
+"""
+
+import argparse
+import asyncio
+import logging
+import os
+import signal
+import socket
+from collections import OrderedDict
+
+import aiohttp
+
+from job_queue import encode_results
+from render_engine import RenderEngine
+
+logging.basicConfig(
+    level=logging.INFO,
+    format='%(asctime)s - %(name)s - %(levelname)s - %(message)s'
+)
+logger = logging.getLogger(__name__)
+
+
+class RenderWorker:
+    """Цикл "арендовать пачку - отрендерить - сдать" на каждый процесс пула"""
+
+    # Сколько исходников держим в памяти (пачки одной задачи идут подряд)
+    SOURCE_CACHE_SIZE = 8
+
+    def __init__(self, url, token, processes=0, encode_threads=0, stack_bytes=0,
+                 tile_pixels=0, tile_bytes=0, prefix="/render"):
+        self.base_url = url.rstrip("/") + prefix
+        self.engine = RenderEngine(
+            processes, encode_threads=encode_threads, stack_bytes=stack_bytes,
+            tile_pixels=tile_pixels, tile_bytes=tile_bytes
+        )
+        self.worker_id = f"{socket.gethostname()}-{os.getpid()}"
+        self.headers = {
+            "Authorization": f"Bearer {token}",
+            "X-Worker-Id": self.worker_id,
+        }
+        # source_id -> Future с исходником (SharedSource или None, если задачу отменили)
+        self._sources = OrderedDict()
+        self._stopping = asyncio.Event()
+
+    def stop(self):
+        """Доделать текущие пачки и выйти"""
+        logger.info("Stopping after current tasks...")
+        self._stopping.set()
+
+    async def run(self):
+        self.engine.start()
+        timeout = aiohttp.ClientTimeout(total=None, sock_read=60)
+        try:
+            async with aiohttp.ClientSession(headers=self.headers, timeout=timeout) as session:
+                loops = [self._loop(session) for _ in range(self.engine.workers)]
+                await asyncio.gather(*loops)
+        finally:
+            for opening in self._sources.values():
+                self._close(opening)
+            self.engine.shutdown()
+
+    async def _loop(self, session):
+        delay = 1.0
+        while not self._stopping.is_set():
+            try:
+                task = await self._lease(session)
+                if task is not None:
+                    await self._process(session, task)
+                delay = 1.0
+            except (aiohttp.ClientError, asyncio.TimeoutError) as e:
+                logger.warning(f"Queue unavailable ({e}), retry in {delay:.0f}s")
+                await asyncio.sleep(delay)
+                delay = min(30.0, delay * 2)
+
+    async def _lease(self, session):
+        # Ждём задачу (long-poll), но не дольше, чем до сигнала остановки
+        lease = asyncio.ensure_future(session.post(f"{self.base_url}/lease"))
+        stopping = asyncio.ensure_future(self._stopping.wait())
+        done, _ = await asyncio.wait({lease, stopping}, return_when=asyncio.FIRST_COMPLETED)
+        stopping.cancel()
+        if lease not in done:
+            lease.cancel()
+            return None
+
+        async with lease.result() as response:
+            if response.status == 204:
+                return None
+            response.raise_for_status()
+            return await response.json()
+
+    async def _source(self, session, task):
+        """
+        Исходник задачи, один раз скачанный и декодированный в shared memory.
+        Пачки одной задачи обычно арендуют сразу несколько циклов - запись
+        в _sources появляется до первого await, и все ждут одну загрузку
+        """
+        source_id = task["source_id"]
+        opening = self._sources.get(source_id)
+        if opening is not None:
+            self._sources.move_to_end(source_id)
+        else:
+            opening = asyncio.ensure_future(self._open_source(session, task))
+            opening.add_done_callback(lambda _: self._forget_failed(source_id, opening))
+            self._sources[source_id] = opening
+            while len(self._sources) > self.SOURCE_CACHE_SIZE:
+                _, evicted = self._sources.popitem(last=False)
+                self._close(evicted)
+        # Отмена одного ждущего не должна отменять общую загрузку
+        return await asyncio.shield(opening)
+
+    async def _open_source(self, session, task):
+        async with session.get(f"{self.base_url}/sources/{task['source_id']}") as response:
+            if response.status == 404:
+                return None
+            response.raise_for_status()
+            image_bytes = await response.read()
+
+        return self.engine.open_source(
+            image_bytes, task["mode"], task.get("max_side", 0), task.get("upscale", False)
+        )
+
+    def _forget_failed(self, source_id, opening):
+        """Не удалось скачать (или задачу отменили) - следующая пачка попробует заново"""
+        if opening.cancelled() or opening.exception() is not None or opening.result() is None:
+            if self._sources.get(source_id) is opening:
+                del self._sources[source_id]
+
+    def _close(self, opening):
+        """Закрывает исходник из _sources; ещё открывается - когда откроется"""
+        if not opening.done():
+            opening.add_done_callback(self._close)
+        elif not opening.cancelled() and opening.exception() is None and opening.result() is not None:
+            self.engine.close_source(opening.result())
+
+    def _drop_broken(self, source_id, source):
+        """Исходник не декодировался - убираем его, а не отдаём следующим пачкам"""
+        ready = source.ready
+        if not ready.done() or ready.cancelled() or ready.exception() is None:
+            return
+        opening = self._sources.get(source_id)
+        if opening is not None and opening.done() and opening.result() is source:
+            del self._sources[source_id]
+            self._close(opening)
+
+    async def _process(self, session, task):
+        source = None
+        try:
+            source = await self._source(session, task)
+            if source is None:
+                # Задачу отменили, пока пачка ждала в очереди
+                return
+
+            results, timings = await self.engine.submit_raw(
+                source, task["params"],
+                task.get("output_format", "jpeg"), task.get("max_output_bytes", 0)
+            )
+        except (aiohttp.ClientError, asyncio.TimeoutError):
+            raise
+        except Exception as e:
+            # Битый исходник или упавший рендер: сдаём пачку пустой, чтобы бот
+            # сразу отказал этим вариантам, а не отдавал пачку следующему воркеру
+            logger.error(f"Task {task['task_id']} failed: {e!r}")
+            if source is not None:
+                self._drop_broken(task["source_id"], source)
+            results, timings = [None] * len(task["params"]), []
+
+        body = encode_results(results, timings)
+        url = f"{self.base_url}/tasks/{task['task_id']}/result"
+        async with session.post(url, data=body) as response:
+            if response.status == 410:
+                # Пачку сдал другой воркер или задачу отменили
+                return
+            response.raise_for_status()
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Воркер рендера для очереди бота")
+    parser.add_argument("--url", default=os.getenv("RENDER_QUEUE_URL", "http://127.0.0.1:9090"),
+                        help="адрес HTTP-сервера бота")
+    parser.add_argument("--token", default=os.getenv("RENDER_QUEUE_TOKEN", ""))
+    parser.add_argument("--processes", type=int, default=int(os.getenv("RENDER_WORKERS", "0")),
+                        help="процессов рендера (0 = по числу ядер)")
+    parser.add_argument("--encode-threads", type=int, default=int(os.getenv("ENCODE_THREADS", "0")),
+                        help="потоков кодирования в каждом процессе (0 = без пула)")
+    parser.add_argument("--stack-memory", type=int,
+                        default=int(os.getenv("RENDER_STACK_MEMORY", str(128 * 1024 * 1024))),
+                        help="байт под стек вариантов в каждом процессе (0 = по одному варианту)")
+    parser.add_argument("--tile-pixels", type=int,
+                        default=int(os.getenv("RENDER_TILE_PIXELS", str(12 * 1000 * 1000))),
+                        help="с какого числа пикселей рендерить кадр полосами (0 = всегда целиком)")
+    parser.add_argument("--tile-memory", type=int,
+                        default=int(os.getenv("RENDER_TILE_MEMORY", str(32 * 1024 * 1024))),
+                        help="байт под полосы кадра на вариант")
+    args = parser.parse_args()
+
+    if not args.token:
+        parser.error("нужен --token или RENDER_QUEUE_TOKEN")
+
+    async def run():
+        worker = RenderWorker(
+            args.url, args.token, args.processes, args.encode_threads, args.stack_memory,
+            args.tile_pixels, args.tile_memory
+        )
+        loop = asyncio.get_running_loop()
+        for sig in (signal.SIGINT, signal.SIGTERM):
+            loop.add_signal_handler(sig, worker.stop)
+        logger.info(f"Worker {worker.worker_id}: {worker.engine.workers} processes -> {args.url}")
+        await worker.run()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()